@@ -1,14 +1,13 @@
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
-from transformers import BertTokenizer, BertModel
-import torch
+
+from utils.embedding_service import get_embedding_model
 
 
 class RequestDispatcher:
     def __init__(self, agents):
         self.agents = agents
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        self.model = BertModel.from_pretrained("bert-base-uncased")
+        self.embeddings = get_embedding_model("bert-base-uncased")
         self.agent_vectors = self._create_agent_vectors(agents)
 
     # def _create_agent_vectors(self, agents):
@@ -19,13 +18,7 @@ class RequestDispatcher:
     #     return vectors
     #
     # def _get_vector(self, text):
-    #     # Tokenize input and convert to tensor
-    #     inputs = self.tokenizer(text, return_tensors="pt", truncation=True, padding=True)
-    #     with torch.no_grad():
-    #         outputs = self.model(**inputs)
-    #
-    #     # Get the mean of the last layer hidden state (vector representation)
-    #     return outputs.last_hidden_state.mean(dim=1).numpy()  # Returns a numpy array
+    #     return self.embeddings.embed_one(text)  # (1 x D) numpy array
     #
     # def dispatch_request(self, request):
     #     request_vector = self._get_vector(request)
@@ -1,6 +1,7 @@
 import subprocess
 from chatbot.chat_history import ChatHistory
 from components.file_system_component import FileSystemComponent
+from utils.llm_gateway import get_gateway
 
 
 async def act(file_system: FileSystemComponent,
@@ -82,7 +83,8 @@ async def generate_commit_message(diff_output, openai, chat_history):
 
     try:
         # Call OpenAI's API to generate the message
-        response = openai.chat.completions.create(
+        response = get_gateway().complete(
+            "commit_message",
             model="gpt-4o-mini",  # Using a cheaper model as specified
             messages=[
                 {"role": "user", "content": prompt}
@@ -4,11 +4,21 @@ import re
 import threading
 import weakref
 
-import torch
-from torch import cosine_similarity
-from transformers import DistilBertTokenizer, DistilBertModel
+import numpy as np
 from functools import lru_cache
 
+from utils.embedding_service import get_embedding_model
+from utils.llm_gateway import get_gateway
+from utils.prototype_classifier import PrototypeClassifier
+from utils.reference_vectors import load_reference_vectors
+
+FILE_SYSTEM_EMBEDDING_MODEL = "distilbert-base-uncased"
+OPEN_FILE_PHRASES = ["open file", "read from file", "access document", "open directory", "open folder"]
+FILE_INTENT_PHRASES = {
+    "file": "file",
+    "folder": "folder directory",
+}
+
 
 class FileSystemAgent:
     def __init__(self, openai, chatbot, file_system):
@@ -17,15 +27,25 @@ class FileSystemAgent:
         self.filename = None
         self.file_system = file_system
         self.lock = threading.Lock()
-        self.tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
-        self.model = DistilBertModel.from_pretrained("distilbert-base-uncased").half()  # Use half-precision
-        self.open_file_phrases = ["open file", "read from file", "access document", "open directory", "open folder"]
-        self.intent_phrases = {
-            "file": "file",
-            "folder": "folder directory",
-        }
-        self.intent_vectors = self._vectorize_intents(self.intent_phrases)
-        self.open_file_vectors = self._vectorize_phrases(self.open_file_phrases)
+        self.prompt_cache = (None, None)  # ((working_directory, tree version), prompt text)
+        self.embeddings = get_embedding_model(FILE_SYSTEM_EMBEDDING_MODEL)  # Shared, loaded on first use
+        self.open_file_phrases = list(OPEN_FILE_PHRASES)
+        self.intent_phrases = dict(FILE_INTENT_PHRASES)
+        self._intent_vectors = None
+        self._open_file_classifier = None
+
+    @property
+    def intent_vectors(self):
+        if self._intent_vectors is None:
+            self._intent_vectors = self._vectorize_intents(self.intent_phrases)
+        return self._intent_vectors
+
+    @property
+    def open_file_classifier(self):
+        if self._open_file_classifier is None:
+            self._open_file_classifier = PrototypeClassifier(
+                self.open_file_phrases, self._vectorize_phrases(self.open_file_phrases))
+        return self._open_file_classifier
 
     def change_directory(self, dir_name):
         with self.lock:  # Lock to prevent race conditions
@@ -56,7 +76,8 @@ class FileSystemAgent:
         })
 
         try:
-            response = openai.chat.completions.create(
+            response = get_gateway().complete(
+                "file_command",
                 model="gpt-4o-mini",  # Using the more efficient model
                 messages=messages,
                 max_tokens=1000,
@@ -68,28 +89,16 @@ class FileSystemAgent:
             return e
 
     def _vectorize_phrases(self, phrases):
-        # Batch tokenization and processing for efficiency
-        inputs = self.tokenizer(phrases, return_tensors='pt', padding=True, truncation=True)
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        # Return a list of tensors (one per phrase) rather than a single tensor
-        return [outputs.last_hidden_state[i].mean(dim=0) for i in range(len(phrases))]
+        # Rows of the returned (N x D) array follow the phrases; cached on disk across runs
+        return load_reference_vectors(self.embeddings, phrases)
 
     def _vectorize_intents(self, phrases):
-        vectors = {}
-        for key, phrase in phrases.items():
-            inputs = self.tokenizer(phrase, return_tensors='pt')
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                vectors[key] = outputs.last_hidden_state.mean(dim=1)
-        return vectors
+        vectors = load_reference_vectors(self.embeddings, phrases.values())
+        return {key: vectors[i:i + 1] for i, key in enumerate(phrases)}
 
     @lru_cache(maxsize=128)  # Cache frequently used inputs for faster access
     def _vectorize_input(self, user_input):
-        inputs = self.tokenizer(user_input, return_tensors='pt')
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        return outputs.last_hidden_state.mean(dim=1)
+        return self.embeddings.embed_one(user_input)
 
     def handle_request(self, request):
         """Handle incoming requests to read or write files."""
@@ -101,14 +110,11 @@ class FileSystemAgent:
         """Determine if the user prompt indicates intent to open a file."""
         user_vector = self._vectorize_input(user_prompt)
 
-        # Ensure open_file_vectors is a list of tensors and stack them
-        open_file_vector_tensor = torch.stack(self.open_file_vectors)
-
-        # Compute cosine similarity
-        similarities = cosine_similarity(user_vector, open_file_vector_tensor)
+        # Compute cosine similarity against every open-file phrase at once
+        similarities = self.open_file_classifier.scores(user_vector)
 
         # Check if maximum similarity is above threshold
-        if torch.max(similarities) > 0.9:  # Adjust threshold as necessary
+        if np.max(similarities) > 0.9:  # Adjust threshold as necessary
             return True
         return False
 
@@ -123,9 +129,13 @@ class FileSystemAgent:
         return output
 
     def get_prompt(self):
-        out = "There are currently no files or folders in context"
         data = self.get_prompt_data()
-        out = f"The user is currently working with these files and folders. {json.dumps(self.get_prompt_data())}"
+        cache_key = (self.file_system.working_directory,
+                     self.file_system.get_tree_index(self.file_system.working_directory).version)
+        if self.prompt_cache[0] == cache_key:
+            return self.prompt_cache[1]
+        out = f"The user is currently working with these files and folders. {json.dumps(data)}"
+        self.prompt_cache = (cache_key, out)
         return out
 
     def get_system_message(self):
@@ -0,0 +1,67 @@
+"""Micro-benchmark of EthicalAIChatbot.construct_prompt with a long chat history.
+
+Run from the project root (the chatbot is constructed inside a scratch directory):
+    python -m benchmarks.bench_construct_prompt --history 1000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from chatbot.ethical_ai_chatbot import EthicalAIChatbot
+
+
+def make_history(length):
+    return [
+        {
+            'user_id': 'bench',
+            'request': f"Question {i}: how should I structure the next part of the project?",
+            'response': f"Answer {i}: split it into small steps and check in with your team. " * 2,
+            'time': '2024-10-01 12:00:00',
+        }
+        for i in range(length)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--history', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='prompt_bench_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        bot = EthicalAIChatbot()
+        history = make_history(args.history)
+
+        start = time.perf_counter()
+        first = bot.construct_prompt("What should I do next?", 'bench', history)
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            history.append({**history[-1], 'request': f"Follow-up {i}"})
+            prompt = bot.construct_prompt("What should I do next?", 'bench', history)
+        warm = (time.perf_counter() - start) / args.iterations
+
+        shared_prefix = 0
+        for before, after in zip(first, prompt):
+            if before != after:
+                break
+            shared_prefix += 1
+
+        print(f"history entries:           {args.history}")
+        print(f"cold construct_prompt:     {cold * 1000:8.2f} ms")
+        print(f"warm construct_prompt:     {warm * 1000:8.2f} ms (mean of {args.iterations}, one new turn each)")
+        print(f"messages shared with turn 1 after {args.iterations} turns: {shared_prefix}")
+        print(f"tokens per section:        {bot.last_prompt_token_counts}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Cold versus warm directory-tree builds on a synthetic file tree.
+
+Run from the project root:
+    python -m benchmarks.bench_directory_tree --files 50000
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from components.file_system_component import FileSystemComponent
+
+
+def synthetic_file_path(root, i, files_per_directory):
+    extension = '.py' if i % 3 else '.md'
+    return os.path.join(root, f"pkg{i // files_per_directory:04d}", f"module{i}{extension}")
+
+
+def build_synthetic_tree(root, files, files_per_directory):
+    for i in range(files):
+        path = synthetic_file_path(root, i, files_per_directory)
+        if i % files_per_directory == 0:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(f"# synthetic file {i}\n" + "value = 1\n" * 20)
+
+
+def commit_synthetic_tree(root):
+    git = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com']
+    subprocess.run([*git, 'init', '-q'], cwd=root, check=True)
+    subprocess.run([*git, 'add', '-A'], cwd=root, check=True)
+    subprocess.run([*git, 'commit', '-q', '-m', 'synthetic tree'], cwd=root, check=True)
+
+
+def timed_build(file_system, root):
+    """Build the tree and return the stats the component recorded for it."""
+    file_system.get_directory_tree(root, full=True)
+    return file_system.tree_build_stats
+
+
+def report(label, stats):
+    print(f"{label:<30}{stats['wall_time'] * 1000:10.1f} ms  {stats['subprocess_count']:6d} subprocesses")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--files-per-directory', type=int, default=100)
+    parser.add_argument('--touch', type=int, default=10, help="files modified before the incremental build")
+    parser.add_argument('--no-git', action='store_true', help="skip committing the tree to a git repository")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='tree_bench_')
+    try:
+        root = os.path.join(work_dir, 'sandbox')
+        build_synthetic_tree(root, args.files, args.files_per_directory)
+        if not args.no_git:
+            commit_synthetic_tree(root)
+        file_system = FileSystemComponent(None, config_path=os.path.join(work_dir, 'fsc_config.json'))
+        file_system.working_directory = root
+        index = file_system.get_tree_index(root)
+        index.stop_watching()  # Measure the stat-only rescan path
+
+        cold = timed_build(file_system, root)
+        warm = timed_build(file_system, root)
+        for i in range(args.touch):
+            path = synthetic_file_path(root, i * args.files_per_directory % args.files, args.files_per_directory)
+            with open(path, 'a') as file:
+                file.write("changed = True\n")
+        incremental = timed_build(file_system, root)
+
+        print(f"files: {args.files}")
+        report("cold build", cold)
+        report("warm rescan (no changes)", warm)
+        report(f"warm rescan ({args.touch} changed)", incremental)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Per-turn write cost of the chat history store as the number of users grows.
+
+Run from the project root:
+    python -m benchmarks.bench_history_store --users 10000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from chatbot.history_store import JsonlHistoryStore
+
+
+def make_interaction(user_id, turn):
+    return {
+        'user_id': user_id,
+        'request': f"Request number {turn} from {user_id}, asking about the weather and the project plan.",
+        'response': f"Response number {turn}: here is a reasonably sized answer to keep the record realistic. " * 3,
+        'time': '2024-10-01 12:00:00',
+    }
+
+
+def time_turns(store, histories, user_ids, turns):
+    start = time.perf_counter()
+    for turn in range(turns):
+        user_id = user_ids[turn % len(user_ids)]
+        store.append(user_id, make_interaction(user_id, turn), histories.setdefault(user_id, []))
+    return (time.perf_counter() - start) / turns
+
+
+def time_legacy_turns(path, history, user_ids, turns):
+    """The previous behaviour: rewrite every user's history on every turn."""
+    start = time.perf_counter()
+    for turn in range(turns):
+        user_id = user_ids[turn % len(user_ids)]
+        history.setdefault(user_id, []).append(make_interaction(user_id, turn))
+        with open(path, 'w') as file:
+            json.dump(history, file, indent=2)
+    return (time.perf_counter() - start) / turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--turns-per-user', type=int, default=3)
+    parser.add_argument('--measure-turns', type=int, default=500)
+    parser.add_argument('--legacy-turns', type=int, default=5)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='history_bench_')
+    try:
+        store = JsonlHistoryStore(os.path.join(work_dir, 'history'))
+        user_ids = [f"user{i}" for i in range(args.users)]
+
+        histories = {}  # The loaded histories appends extend, as ChatHistory keeps them
+        baseline = time_turns(store, histories, user_ids[:10], args.measure_turns)
+        for turn in range(args.turns_per_user):
+            for user_id in user_ids:
+                store.append(user_id, make_interaction(user_id, turn), histories.setdefault(user_id, []))
+        loaded = time_turns(store, histories, user_ids, args.measure_turns)
+
+        legacy_history = {user_id: [make_interaction(user_id, turn) for turn in range(args.turns_per_user)]
+                          for user_id in user_ids}
+        legacy = time_legacy_turns(os.path.join(work_dir, 'history.json'), legacy_history, user_ids,
+                                   args.legacy_turns)
+
+        print(f"append-only store, 10 users:            {baseline * 1e6:10.1f} us/turn")
+        print(f"append-only store, {args.users} users:  {loaded * 1e6:10.1f} us/turn")
+        print(f"whole-file rewrite, {args.users} users: {legacy * 1e6:10.1f} us/turn")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
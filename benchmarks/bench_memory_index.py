@@ -0,0 +1,102 @@
+"""Query latency of the semantic memory index at a million stored turns.
+
+Vectors are synthetic: unit vectors drawn around random topic centres, so that clustering
+behaves as it would on real conversations. Recall is measured against the exact search.
+
+Run from the project root:
+    python -m benchmarks.bench_memory_index --turns 1000000
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from utils.vector_index import VectorIndex
+
+ADD_BATCH_ROWS = 65536
+
+
+def make_vectors(random, centres, count):
+    topics = random.integers(len(centres), size=count)
+    return centres[topics] + random.normal(scale=0.6 / np.sqrt(centres.shape[1]), size=(count, centres.shape[1]))
+
+
+def fill_index(index, random, centres, turns):
+    start = time.perf_counter()
+    for first in range(0, turns, ADD_BATCH_ROWS):
+        count = min(ADD_BATCH_ROWS, turns - first)
+        index.add(make_vectors(random, centres, count),
+                  [{'key': str(row), 'request': f"request {row}", 'response': f"response {row}"}
+                   for row in range(first, first + count)])
+    return time.perf_counter() - start
+
+
+def time_queries(index, queries, k, nprobe):
+    index.search(queries[0], k, nprobe)  # Page the index in
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append([entry['key'] for _, entry in index.search(query, k, nprobe)])
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+
+def recall(results, exact_results):
+    return statistics.mean(len(set(found) & set(exact)) / len(exact) for found, exact in zip(results, exact_results))
+
+
+def report(name, latencies, results=None, exact_results=None):
+    latencies = sorted(latencies)
+    line = (f"{name:<24} p50 {statistics.median(latencies) * 1000:8.2f} ms"
+            f"   p95 {latencies[int(len(latencies) * 0.95)] * 1000:8.2f} ms")
+    if exact_results is not None:
+        line += f"   recall {recall(results, exact_results):.3f}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--turns', type=int, default=1000000)
+    parser.add_argument('--dim', type=int, default=768, help="768 matches the shared BERT embedder")
+    parser.add_argument('--topics', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument('--precision', nargs='+', default=['fp32', 'int8'], choices=['fp32', 'int8'])
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='memory_bench_')
+    try:
+        random = np.random.default_rng(0)
+        centres = random.normal(size=(args.topics, args.dim)).astype(np.float32)
+        centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+        queries = make_vectors(random, centres, args.queries).astype(np.float32)
+
+        for precision in args.precision:
+            index = VectorIndex(os.path.join(work_dir, precision), precision)
+            elapsed = fill_index(index, np.random.default_rng(1), centres, args.turns)
+            size = os.path.getsize(index.path('vectors.bin'))
+            print(f"{precision}: {len(index)} turns of {args.dim} dimensions, {size / 2 ** 20:.0f} MiB of vectors, "
+                  f"added in {elapsed:.1f}s")
+
+            latencies, exact_results = time_queries(index, queries, args.k, None)
+            report(f"{precision} exact", latencies)
+
+            start = time.perf_counter()
+            index.build_ivf()
+            print(f"{precision}: clustered into {len(index.ivf[0])} clusters in {time.perf_counter() - start:.1f}s")
+            for nprobe in args.nprobe:
+                latencies, results = time_queries(index, queries, args.k, nprobe)
+                report(f"{precision} ivf nprobe={nprobe}", latencies, results, exact_results)
+
+            shutil.rmtree(index.directory)  # Keep one index on disk at a time
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
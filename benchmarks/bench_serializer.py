@@ -0,0 +1,79 @@
+"""Save and load time and file size of a large chat history, indented JSON versus compact, per backend.
+
+The history is a dict of users to interactions, as chat logs and legacy history files hold
+it, sized so its indented JSON is about `--megabytes`. The legacy row writes it the way
+`write_json` used to, with `json.dumps(indent=2)`, and loads it with `json.load`; the other
+rows write it compact with each JSON backend installed here (orjson and msgspec are optional)
+and load it with the same backend.
+
+Run from the project root (the files are written to a scratch directory):
+    python -m benchmarks.bench_serializer --megabytes 100
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from utils.serializer import available_serializers, make_serializer
+
+SAMPLE_WORDS = "the user asked about their plans for the weekend and whether the weather would hold".split()
+
+
+def make_history(megabytes):
+    """Interactions for 100 users until the indented JSON reaches the target size."""
+    history = {f"user{user}": [] for user in range(100)}
+    target, size, turn = megabytes * 1024 * 1024, 0, 0
+    while size < target:
+        interaction = {
+            'user_id': f"user{turn % 100}",
+            'request': ' '.join(SAMPLE_WORDS[(turn + i) % len(SAMPLE_WORDS)] for i in range(20)),
+            'response': ' '.join(SAMPLE_WORDS[(turn * 7 + i) % len(SAMPLE_WORDS)] for i in range(60)) + " café ✓",
+            'time': f"2024-10-{turn % 28 + 1:02d} 12:{turn % 60:02d}:00",
+            'emotional_state': {'valence': (turn % 10) / 10, 'arousal': 0.5, 'labels': ['calm', 'curious']},
+        }
+        history[interaction['user_id']].append(interaction)
+        size += len(json.dumps(interaction, indent=2)) + 6
+        turn += 1
+    return history
+
+
+def time_save_load(path, dumps, loads, history):
+    start = time.perf_counter()
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(dumps(history))
+    saved = time.perf_counter()
+    with open(path, 'r', encoding='utf-8') as file:
+        loaded = loads(file.read())
+    done = time.perf_counter()
+    assert loaded == history
+    return saved - start, done - saved, os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megabytes', type=int, default=100, help="size of the history as indented JSON")
+    args = parser.parse_args()
+
+    history = make_history(args.megabytes)
+    print(f"{sum(len(entries) for entries in history.values()):,} interactions")
+    work_dir = tempfile.mkdtemp(prefix='serializer_bench_')
+    try:
+        rows = [('indented json (legacy)', lambda value: json.dumps(value, indent=2), json.loads)]
+        for name in available_serializers():
+            serializer = make_serializer(name)
+            rows.append((f"compact {name}", serializer.dumps, serializer.loads))
+
+        print(f"{'':24}{'save':>10}{'load':>10}{'size':>12}")
+        for label, dumps, loads in rows:
+            gc.collect()  # Start every row without the garbage of the previous one
+            save, load, size = time_save_load(os.path.join(work_dir, 'history.json'), dumps, loads, history)
+            print(f"{label:24}{save * 1000:8.0f}ms{load * 1000:8.0f}ms{size / 1024 / 1024:10.1f}MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Startup time and memory of EthicalAIChatbot construction.
+
+Measures how long `EthicalAIChatbot()` takes and the resident memory afterwards, then
+optionally the first emotion classification, which is when the shared BERT model loads.
+
+Run from the project root (the chatbot is constructed inside a scratch directory):
+    python -m benchmarks.bench_startup --first-request
+    EMBEDDING_PRECISION=int8 python -m benchmarks.bench_startup --first-request
+"""
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+
+def rss_mb():
+    """Current resident set size in MB."""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    # Peak instead of current RSS where /proc is unavailable (KB on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--first-request', action='store_true',
+                        help="also time the first emotion classification, which loads the model")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='startup_bench_')
+    os.makedirs(os.path.join(work_dir, 'sandbox'))
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        baseline = rss_mb()
+
+        start = time.perf_counter()
+        from chatbot.ethical_ai_chatbot import EthicalAIChatbot
+        imported = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bot = EthicalAIChatbot()
+        constructed = time.perf_counter() - start
+
+        print(f"import chatbot modules:   {imported:8.2f} s")
+        print(f"EthicalAIChatbot():       {constructed:8.2f} s")
+        print(f"RSS after construction:   {rss_mb():8.1f} MB (interpreter baseline {baseline:.1f} MB)")
+        print(f"torch imported:           {'torch' in sys.modules}")
+
+        if args.first_request:
+            start = time.perf_counter()
+            emotion = bot.emotional_state_handler.get_emotional_state([{'request': "I finally fixed the bug!"}])
+            first = time.perf_counter() - start
+
+            start = time.perf_counter()
+            bot.emotional_state_handler.get_emotional_state([{'request': "Now the tests fail again."}])
+            second = time.perf_counter() - start
+
+            embeddings = bot.emotional_state_handler.embeddings
+            print(f"first classification:     {first:8.2f} s ({emotion}, model {embeddings.name}, "
+                  f"{embeddings.precision} on {embeddings.device})")
+            print(f"second classification:    {second * 1000:8.1f} ms")
+            print(f"RSS after model load:     {rss_mb():8.1f} MB")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
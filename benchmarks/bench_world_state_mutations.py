@@ -0,0 +1,99 @@
+"""Time to apply mutations to a large world state, by dotted path versus the old flatten pass.
+
+Mutations arrive in batches, one per world-state update. The legacy path applies each
+mutation to the top-level keys, serializing it for error messages, and then rebuilds the
+whole state with `flatten_to_nested`, as every save used to.
+
+Run from the project root:
+    python -m benchmarks.bench_world_state_mutations --keys 10000 --mutations 10000
+"""
+import argparse
+import copy
+import json
+import random
+import time
+
+from states.mutation_world_state import flatten_to_nested
+from states.state_tree import StateTree
+
+
+def make_state(keys, sections):
+    state = {}
+    for i in range(keys):
+        section = state.setdefault(f"section{i % sections}", {})
+        section[f"item{i}"] = i if i % 3 == 0 else [f"tag{i}"] if i % 3 == 1 else f"text {i}"
+    return state
+
+
+def make_mutations(state, count, rng):
+    paths = [(f"{section}.{key}", value) for section, items in state.items() for key, value in items.items()]
+    mutations = []
+    for _ in range(count):
+        path, value = rng.choice(paths)
+        if isinstance(value, int):
+            mutations.append({'key_name': path, 'action': rng.choice(['+', '-']), 'value': rng.randint(1, 5)})
+        elif isinstance(value, list):
+            mutations.append({'key_name': path, 'action': rng.choice(['add', 'remove']), 'value': value[0]})
+        else:
+            mutations.append({'key_name': path, 'action': 'set', 'value': f"new {path}"})
+    return mutations
+
+
+def legacy_apply(state, mutation):
+    """The previous MutationWorldState._apply_mutation, on top-level keys only."""
+    action, value, key = mutation.get('action'), mutation.get('value'), mutation.get('key_name')
+    target_value = state.get(key)
+    errors = []
+    if action in {'+', '-'}:
+        if not isinstance(target_value, (int, float)):
+            errors.append(f"Error: The target value for '+' or '-' is not a number: {target_value}")
+        else:
+            state[key] += value if action == '+' else -value
+    elif action == 'add':
+        state.setdefault(key, []).append(value)
+    elif action == 'remove':
+        state.pop(key, None)
+    else:
+        state[key] = value
+    if errors:
+        errors[-1] += json.dumps(mutation, indent=2)
+    state["recent_mutation_errors"] = errors
+
+
+def time_batches(apply_batch, mutations, batch_size):
+    start = time.perf_counter()
+    for first in range(0, len(mutations), batch_size):
+        apply_batch(mutations[first:first + batch_size])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--sections', type=int, default=100)
+    parser.add_argument('--mutations', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=10, help="mutations per world-state update")
+    args = parser.parse_args()
+
+    state = make_state(args.keys, args.sections)
+    mutations = make_mutations(state, args.mutations, random.Random(0))
+    batches = -(-args.mutations // args.batch_size)
+
+    tree = StateTree(copy.deepcopy(state))
+    elapsed = time_batches(tree.apply_batch, copy.deepcopy(mutations), args.batch_size)
+    print(f"dotted paths:    {elapsed * 1000:9.1f} ms  ({elapsed / args.mutations * 1e6:.2f} us per mutation)")
+
+    legacy_state = [copy.deepcopy(state)]
+
+    def legacy_batch(batch):
+        for mutation in batch:
+            legacy_apply(legacy_state[0], mutation)
+        legacy_state[0] = flatten_to_nested(legacy_state[0])
+
+    elapsed = time_batches(legacy_batch, copy.deepcopy(mutations), args.batch_size)
+    print(f"flatten on save: {elapsed * 1000:9.1f} ms  ({elapsed / batches * 1000:.2f} ms per update "
+          f"of {args.batch_size})")
+
+
+if __name__ == '__main__':
+    main()
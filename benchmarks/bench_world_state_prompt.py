@@ -0,0 +1,87 @@
+"""Prompt tokens spent on world states over a replayed conversation, full JSON versus digest.
+
+A scripted conversation is replayed turn by turn. Its mutations grow the state the way a
+topic tracker does: a topic with a long description per turn, a growing list of interests
+and a few counters. Every turn counts the tokens of the mutation prompt and of the world
+state message in the chat prompt, once with `state_prompt='full'` and once with 'digest'.
+
+Run from the project root (the world states are kept in a scratch directory):
+    python -m benchmarks.bench_world_state_prompt --turns 50
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+from chatbot.prompt_builder import message_tokens
+from states.mutation_world_state import MutationWorldState
+
+TOPICS = ["gardening", "tax returns", "a trip to Lisbon", "learning the cello", "a job interview",
+          "sourdough", "a broken laptop", "marathon training", "a birthday party", "moving house"]
+
+
+def make_turn(turn):
+    topic = TOPICS[turn % len(TOPICS)]
+    interaction = {
+        'user_id': 'bench',
+        'request': f"Turn {turn}: can we talk about {topic} again? I have a few more questions.",
+        'response': f"Of course. Last time we covered the basics of {topic}; here is what to do next. " * 2,
+        'time': '2024-10-01 12:00:00',
+    }
+    mutations = [
+        {'key_name': 'current_topic', 'action': 'set', 'value': topic},
+        {'key_name': f"topics.t{turn}", 'action': 'set', 'value': {
+            'short_description': f"{topic}, as discussed on turn {turn}",
+            'notes': f"The user asked about {topic}; we agreed on next steps and open questions. " * 3,
+        }},
+        {'key_name': 'user.turns', 'action': 'set' if turn == 0 else '+', 'value': 1},
+        {'key_name': 'user.interests', 'action': 'add', 'value': topic},
+    ]
+    return interaction, mutations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--turns', type=int, default=50)
+    parser.add_argument('--history', type=int, default=10, help="turns included in each mutation prompt")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='state_prompt_bench_')
+    cwd = os.getcwd()
+    world_states = {}
+    try:
+        os.chdir(work_dir)
+        world_states = {mode: MutationWorldState(None, file_name=f"{mode}.json", max_history_length=args.history,
+                                                 state_prompt=mode)
+                        for mode in ('full', 'digest')}
+        totals = {mode: [0, 0] for mode in world_states}
+        history = []
+        for turn in range(args.turns):
+            interaction, mutations = make_turn(turn)
+            history.append(interaction)
+            line = f"turn {turn + 1:4}:"
+            for mode, world_state in world_states.items():
+                user = world_state.get_user('bench')
+                messages = world_state.create_mutation_messages(user, history, interaction['request'])
+                mutation_tokens = sum(message_tokens(message) for message in messages)
+                totals[mode][0] += mutation_tokens
+                totals[mode][1] += message_tokens(world_state.get_prompt_message('bench'))
+                world_state.finish_update(user, [dict(mutation) for mutation in mutations])
+                line += f"   {mode} mutation prompt {mutation_tokens:6,} tokens"
+            if turn + 1 in (1, args.turns // 2, args.turns):
+                print(line)
+
+        print(f"{'':8}{'mutation prompts':>20}{'chat world state':>20}")
+        for mode, (mutation_tokens, chat_tokens) in totals.items():
+            print(f"{mode:8}{mutation_tokens:20,}{chat_tokens:20,}")
+        full, digest = totals['full'], totals['digest']
+        print(f"{'saved':8}{1 - digest[0] / full[0]:20.1%}{1 - digest[1] / full[1]:20.1%}")
+    finally:
+        for world_state in world_states.values():
+            world_state.flush()  # Else the exit-time write-back lands in the project directory
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Load test of web_service.py with simulated users and the gateway's fake LLM backend.
+
+Every simulated user sends its messages one after another through the Flask test client
+while all users run concurrently. The fake backend answers each request by echoing the marker in it,
+so a response that belongs to another user or turn is reported as cross-talk. Afterwards each
+user's stored history is checked for lost, duplicated or mismatched turns, and every worker's
+in-memory histories are compared with what is on disk.
+
+With --workers > 1 the same users are driven from several processes sharing one directory,
+as under a multi-worker WSGI/ASGI server.
+
+Run from the project root (the service runs inside a scratch directory):
+    python -m benchmarks.load_test --users 50 --messages 10 --workers 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+MARKER = re.compile(r'load-test user\d+ worker\d+ message\d+')
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_test_answer(messages):
+    if 'mutations' in messages[-1]['content']:
+        return '[]'
+    if 'summar' in messages[0]['content']:
+        return '{"summary": "load test"}'
+    for message in reversed(messages):
+        match = MARKER.search(str(message.get('content', ''))) if message['role'] == 'user' else None
+        if match:
+            return f"reply to {match.group(0)}"
+    return "reply to nothing"
+
+
+def marker(user, worker, message):
+    return f"load-test user{user} worker{worker} message{message}"
+
+
+def run_worker(worker, args, work_dir, results, finished):
+    """Drive every simulated user from one process and report latencies, cross-talk and
+    loaded histories that differ from their segments once every worker has finished."""
+    import sys
+    os.chdir(work_dir)
+    sys.path.insert(0, PROJECT_ROOT)
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')  # The bot prints every response and token bank
+    os.environ["SCHEDULER_TOKENS_PER_MINUTE"] = str(args.tokens_per_minute)  # Background work shares the same limit
+    import web_service
+    from utils.llm_gateway import FakeBackend, RateLimiter, get_gateway
+    from utils.persistence import get_writer
+    from utils.token_scheduler import get_scheduler
+
+    get_gateway().backend = FakeBackend(latency=args.latency, answer=load_test_answer)
+    get_gateway().rate_limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def simulate(user):
+        client = web_service.app.test_client()
+        for message in range(args.messages):
+            text = marker(user, worker, message)
+            start = time.perf_counter()
+            reply = client.post('/chat', json={'user_id': f"user{user}", 'message': text})
+            elapsed = time.perf_counter() - start
+            response = reply.get_json()['response'] if reply.status_code == 200 else f"HTTP {reply.status_code}"
+            with lock:
+                latencies.append(elapsed)
+                if response != f"reply to {text}":
+                    errors.append(f"user{user}: expected a reply to '{text}', got {response!r}")
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=simulate, args=(user,)) for user in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+    get_writer().flush()
+    finished.wait()  # Other workers' turns are on disk
+    problems = check_loaded_histories(args, worker, web_service.bot.chat_history)
+    consumers = get_scheduler().snapshot()['consumers']
+    results.put({'worker': worker, 'latencies': latencies, 'errors': errors, 'wall_time': wall_time,
+                 'problems': problems,
+                 'background': {name: (consumer['granted'], consumer['deferred']) for name, consumer in consumers.items()}})
+
+
+def check_loaded_histories(args, worker, chat_history):
+    """Verify a worker's loaded histories match a fresh replay of the segments, however often they are read."""
+    from chatbot.history_store import JsonlHistoryStore
+
+    store = JsonlHistoryStore(chat_history.store.directory)
+    problems = []
+    for user in range(args.users):
+        chat_history.get_history(f"user{user}")
+        loaded = [entry.get('request') for entry in chat_history.get_history(f"user{user}")]
+        stored = [entry.get('request') for entry in store.load(f"user{user}")]
+        if loaded != stored:
+            problems.append(f"user{user}: worker {worker} holds {len(loaded)} entries, the segment {len(stored)}")
+    return problems
+
+
+def check_histories(args, work_dir):
+    """Verify every turn was appended to its user's segment exactly once, with its own reply.
+
+    The appended records are read directly, so turns folded into a summary still count.
+    """
+    from chatbot.history_store import JsonlHistoryStore
+
+    store = JsonlHistoryStore(os.path.join(work_dir, 'history'))
+    problems = []
+    for user in range(args.users):
+        with open(store.segment_path(f"user{user}"), encoding='utf-8') as file:
+            entries = [entry for entry in store.read_records(f"user{user}", file) if 'request' in entry]
+        requests = [entry['request'] for entry in entries]
+        expected = {marker(user, worker, message)
+                    for worker in range(args.workers) for message in range(args.messages)}
+        if len(requests) != len(expected) or set(requests) != expected:
+            problems.append(f"user{user}: {len(requests)} stored turns, expected {len(expected)}")
+        for entry in entries:
+            if entry['response'] != f"reply to {entry['request']}":
+                problems.append(f"user{user}: '{entry['request']}' stored with {entry['response']!r}")
+        for worker in range(args.workers):
+            order = [request for request in requests if f" worker{worker} " in request]
+            if order != [marker(user, worker, message) for message in range(args.messages)]:
+                problems.append(f"user{user}: turns from worker {worker} are out of order")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=10, help="messages per user and worker")
+    parser.add_argument('--workers', type=int, default=1, help="processes serving the same directory")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds the fake backend takes per completion")
+    parser.add_argument('--requests-per-minute', type=int, default=0, help="gateway request limit (default: none)")
+    parser.add_argument('--tokens-per-minute', type=int, default=0, help="gateway token limit (default: none)")
+    parser.add_argument('--verbose', action='store_true', help="show what the service prints")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='load_test_')
+    os.makedirs(os.path.join(work_dir, 'sandbox'))  # The file system component's working directory
+    try:
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        finished = context.Barrier(args.workers)
+        processes = [context.Process(target=run_worker, args=(worker, args, work_dir, results, finished))
+                     for worker in range(args.workers)]
+        for process in processes:
+            process.start()
+        reports = []
+        while len(reports) < len(processes):
+            try:
+                reports.append(results.get(timeout=1))
+            except queue.Empty:
+                if any(process.exitcode for process in processes):
+                    finished.abort()  # Releases the workers still waiting for it
+                    raise SystemExit("A worker process failed; see its traceback above.")
+        for process in processes:
+            process.join()
+
+        latencies = sorted(latency for report in reports for latency in report['latencies'])
+        errors = [error for report in reports for error in report['errors']]
+        wall_time = max(report['wall_time'] for report in reports)
+        problems = [problem for report in reports for problem in report['problems']] + check_histories(args, work_dir)
+
+        print(f"users x messages x workers: {args.users} x {args.messages} x {args.workers}")
+        print(f"requests:                   {len(latencies)} in {wall_time:.2f} s "
+              f"({len(latencies) / wall_time:.1f} req/s)")
+        print(f"latency p50 / p95 / max:    {statistics.median(latencies) * 1000:.1f} / "
+              f"{latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} / {latencies[-1] * 1000:.1f} ms")
+        print(f"cross-talk responses:       {len(errors)}")
+        print(f"history problems:           {len(problems)}")
+        for name in sorted({name for report in reports for name in report['background']}):
+            granted = sum(report['background'].get(name, (0, 0))[0] for report in reports)
+            deferred = sum(report['background'].get(name, (0, 0))[1] for report in reports)
+            print(f"background {name}: {granted} granted, {deferred} deferred")
+        for line in (errors + problems)[:10]:
+            print(f"  {line}")
+        for directory, _, names in os.walk(os.path.join(work_dir, 'states')):
+            for name in sorted(names):
+                if name.endswith('.json'):
+                    with open(os.path.join(directory, name)) as file:
+                        json.load(file)  # Raises if concurrent saves corrupted a state file
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
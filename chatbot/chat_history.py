@@ -1,52 +1,138 @@
 import datetime
 import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import time
 
 import openai
 
+from chatbot.history_store import JsonlHistoryStore
+from utils.llm_gateway import get_gateway
+from utils.persistence import get_writer
+
+CHAT_HISTORY_LOADED_USERS = int(os.getenv("CHAT_HISTORY_LOADED_USERS", 1000))
+
 
 class ChatHistory:
-    def __init__(self, api_key, history={}, file_name='history.json'):
-        self.history = history
+    def __init__(self, api_key, history={}, file_name='history.json', store=None,
+                 max_loaded_users=CHAT_HISTORY_LOADED_USERS):
+        self.history = OrderedDict()  # Loaded users, least recently used first; the rest stay on disk
+        self.history_lock = threading.Lock()  # Guards the order of `history`
+        self.max_loaded_users = max_loaded_users
         self.file_name = file_name
+        self.store = store or JsonlHistoryStore()
+        self.user_locks = {}  # user_id -> lock of a loaded user, see `locked`
+        self.user_locks_lock = threading.Lock()
+        self.listeners = []  # Called with (user_id, interaction) after every added interaction
+        self.eviction_listeners = []  # Called with the user_id of every history dropped from memory
         openai.api_key = api_key
-        self.load()
+        self.load(history)
+
+    def user_lock(self, user_id):
+        """Return the lock that serializes changes to one user's history."""
+        with self.user_locks_lock:
+            lock = self.user_locks.get(user_id)
+            if lock is None:
+                lock = self.user_locks[user_id] = threading.RLock()
+            return lock
+
+    @contextmanager
+    def locked(self, user_id):
+        """Hold the user's lock; one dropped by eviction while we waited for it is swapped for the current one."""
+        while True:
+            lock = self.user_lock(user_id)
+            with lock:
+                if self.user_locks.get(user_id) is lock:
+                    yield
+                    return
+
+    def add_listener(self, listener):
+        """Register a callable notified of every new interaction; it must return quickly."""
+        self.listeners.append(listener)
+
+    def add_eviction_listener(self, listener):
+        """Register a callable notified when a user's history is dropped from memory, to drop what it keeps per user."""
+        self.eviction_listeners.append(listener)
 
     def add_interaction(self, user_id, request, response):
-        """Log each interaction with the user."""
-        user_history = self.get_history(user_id)
-
-        if len(json.dumps(user_history[:-5])) > 10000:
-            self.summarize_history(user_id)
+        """Log each interaction with the user and return it."""
+        with self.locked(user_id):
             user_history = self.get_history(user_id)
-
-        interaction = {
-            'user_id': user_id,
-            'request': request,
-            'response': response,
-            'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        user_history.append(interaction)
-        self.history[user_id] = user_history
-        self.save()
+            interaction = {
+                'user_id': user_id,
+                'request': request,
+                'response': response,
+                'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+            self.history[user_id] = self.store.append(user_id, interaction, user_history)
+        for listener in self.listeners:
+            listener(user_id, interaction)
+        return interaction
 
     def get_history(self, user_id):
-        """Retrieve chat histories for a specific user."""
-        if user_id not in self.history:
-            self.history[user_id] = []
-        return self.history[user_id]
+        """Retrieve chat histories for a specific user, loading them on first access.
+
+        Histories already in memory pick up interactions other worker processes appended.
+        """
+        with self.locked(user_id):
+            loaded = user_id not in self.history
+            history = self.store.load(user_id) if loaded else self.store.refresh(user_id, self.history[user_id])
+            with self.history_lock:
+                self.history[user_id] = history
+                self.history.move_to_end(user_id)
+        if loaded:
+            self.evict()
+        return history
+
+    def evict(self):
+        """Drop the least recently used histories beyond `max_loaded_users`; they reload from their segments.
+
+        Users whose lock is held are in use and stay loaded until a later eviction. The lock of an
+        evicted user is dropped along with their history.
+        """
+        with self.history_lock:
+            candidates = list(self.history)[:max(0, len(self.history) - self.max_loaded_users)]
+        for user_id in candidates:
+            lock = self.user_lock(user_id)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                if user_id not in self.history:
+                    continue  # Evicted by another thread meanwhile
+                if self.store.stale_records.get(user_id):
+                    self.store.compact(user_id, self.history[user_id])
+                with self.history_lock:
+                    del self.history[user_id]
+                self.store.forget(user_id)
+                with self.user_locks_lock:
+                    del self.user_locks[user_id]  # Threads waiting for it retry with a new one
+            finally:
+                lock.release()
+            for listener in self.eviction_listeners:
+                listener(user_id)
 
     def clear_history(self, user_id):
         """Clear chat history for a specific user if needed."""
-        self.history = [interaction for interaction in self.history if interaction['user_id'] != user_id]
+        with self.locked(user_id):
+            self.history[user_id] = []
+            self.store.replace(user_id, [])
 
     def summarize_history(self, user_id):
-        """Summarize the last session and prepend it to the chat history."""
+        """Replace the chat history with a summary of it and the last interaction.
+
+        The chatbot keeps the history intact and summarizes it in the background with
+        HistorySummarizer; this is only for trimming a history by hand.
+        """
+        with self.locked(user_id):
+            return self._summarize_history(user_id)
+
+    def _summarize_history(self, user_id):
         chat_history = self.get_history(user_id)
 
         if chat_history:
-            with open(f"logs\\log_{datetime.datetime.now().strftime('%H%M%S%Y-%m-%d')}.json", 'w') as file:
-                json.dump(chat_history, file, indent=2)
+            get_writer().write_json(f"logs\\log_{datetime.datetime.now().strftime('%H%M%S%Y-%m-%d')}.json", chat_history)
             # Generate a summary of the last session
             last_session_summary = self.create_summary(chat_history)
             chat_history = [a for a in filter(lambda a: not ("role" in a and a["role"] == 'system'), chat_history)]
@@ -60,8 +146,8 @@ class ChatHistory:
             )
 
         # Save the updated chat history back
-
-        self.save()
+        if user_id in self.history:
+            self.store.replace(user_id, self.history[user_id])
         return chat_history
 
     def create_summary(self, chat_history):
@@ -74,7 +160,8 @@ class ChatHistory:
         combined_history = "\n".join(interaction_texts)
 
         # Use the ML model to generate a summary
-        summary_response = openai.chat.completions.create(
+        summary_response = get_gateway().complete(
+            "history_summary",
             model="gpt-4o-mini",
             messages=[
                 {"role": "system",
@@ -88,7 +175,7 @@ class ChatHistory:
         return summary_response.choices[0].message.content.strip()
 
     def get_users(self):
-        return self.history.keys()
+        return list(dict.fromkeys([*self.history.keys(), *self.store.users()]))
 
     def format_chat_history(self, user_id):
         """Format the chat history to a specified client format."""
@@ -107,21 +194,31 @@ class ChatHistory:
                 })
         return formatted_history
 
-    def load(self):
-        """Load previously saved user sessions from a file, if available."""
+    def load(self, history=None):
+        """Load previously saved user sessions, migrating a legacy history file into the store once.
+
+        Without a store or a readable legacy file, the store starts from `history` instead.
+        """
+        self.history = OrderedDict()
+        if self.store.exists():
+            return None  # Users are loaded lazily from their segments
         try:
             with open(self.file_name, 'r') as file:
-                self.history = json.load(file)
+                legacy_history = json.load(file)
         except FileNotFoundError:
-            return None  # Return None if no saved sessions are found
+            legacy_history = history or {}  # No saved sessions
         except json.JSONDecodeError:
             print("Error: Could not parse user sessions.")
-            return None
+            legacy_history = history or {}
+        for user_id, entries in legacy_history.items():
+            self.store.compact(user_id, entries)
 
     def save(self):
-        print("saving")
-        with open(self.file_name, 'w') as file:
-            json.dump(self.history, file, indent=2)
+        """Compact the segments of loaded users; individual interactions are already on disk."""
+        for user_id in list(self.history):
+            with self.locked(user_id):
+                if user_id in self.history and self.store.stale_records.get(user_id):  # Not evicted meanwhile
+                    self.store.compact(user_id, self.history[user_id])
 
     def get_formatted_history(self, user_id):
         messages = []
@@ -0,0 +1,128 @@
+import queue
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from chatbot.chat_history import CHAT_HISTORY_LOADED_USERS
+
+MOOD_DECAY = 0.6  # Weight the running mood keeps per new request; lower reacts faster
+SEED_WINDOW = 10  # Requests replayed to seed the mood of a user first seen after a restart
+
+
+class EmotionTracker:
+    """Incremental per-user emotional state.
+
+    Each request is embedded once, when its interaction is added to the chat history, and
+    scored against the emotion prototypes. The scores of a user's recent interactions are
+    cached next to them and folded into an exponentially decayed mood vector per user, so
+    reading a user's emotional state is a lookup no matter how long their history is.
+    Embedding runs on a background thread and never delays the turn. Only the
+    `max_loaded_users` most recently active users are kept; the others are seeded again
+    from their history on their next request.
+    """
+
+    def __init__(self, emotional_state_handler, chat_history, decay=MOOD_DECAY, seed_window=SEED_WINDOW,
+                 max_loaded_users=CHAT_HISTORY_LOADED_USERS):
+        self.emotional_state_handler = emotional_state_handler
+        self.chat_history = chat_history
+        self.decay = decay
+        self.seed_window = seed_window
+        self.max_loaded_users = max_loaded_users
+        self.moods = OrderedDict()  # user_id -> (decayed sum of emotion scores, decayed sum of weights), least recently active first
+        self.states = {}  # user_id -> emotion label of the current mood
+        self.recent_scores = {}  # user_id -> deque of (interaction, emotion scores), newest last
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run, name="emotion-tracker", daemon=True)
+        self.worker.start()
+        chat_history.add_listener(self.on_interaction)
+
+    def on_interaction(self, user_id, interaction):
+        """ChatHistory listener: queue the new request for scoring."""
+        if interaction.get('request'):
+            self.queue.put((user_id, interaction))
+
+    def get_emotional_state(self, user_id, default='neutral'):
+        """The emotion closest to the user's running mood."""
+        with self.lock:
+            return self.states.get(user_id, default)
+
+    def get_mood(self, user_id):
+        """The user's mood as {emotion: score}, or an empty dict before their first request is scored."""
+        with self.lock:
+            mood = self.moods.get(user_id)
+        if mood is None or not mood[1]:
+            return {}
+        scores = mood[0] / mood[1]
+        return dict(zip(self.emotional_state_handler.classifier.labels, (float(score) for score in scores)))
+
+    def get_interaction_scores(self, user_id):
+        """The cached (interaction, {emotion: score}) pairs of the user's recent requests."""
+        labels = self.emotional_state_handler.classifier.labels
+        with self.lock:
+            recent = list(self.recent_scores.get(user_id, ()))
+        return [(interaction, dict(zip(labels, (float(score) for score in scores)))) for interaction, scores in recent]
+
+    def flush(self):
+        """Block until every queued request has been scored."""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.score_batch(batch)
+            except Exception as e:
+                print(f"Error tracking emotional state: {str(e)}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def score_batch(self, batch):
+        for user_id in {user_id for user_id, _ in batch}:
+            if user_id not in self.moods:
+                self.seed(user_id, [interaction for batch_user, interaction in batch if batch_user == user_id])
+
+        scores = self.emotional_state_handler.score_emotions([str(interaction['request']) for _, interaction in batch])
+        for (user_id, interaction), interaction_scores in zip(batch, scores):
+            self.update_mood(user_id, interaction, interaction_scores)
+
+    def seed(self, user_id, pending):
+        """Start a user's mood from the last requests of their stored history."""
+        pending_ids = {id(interaction) for interaction in pending}
+        interactions = [interaction for interaction in self.chat_history.get_history(user_id)
+                        if interaction.get('request') and id(interaction) not in pending_ids][-self.seed_window:]
+        with self.lock:
+            self.moods.setdefault(user_id, (0, 0))
+        if interactions:
+            scores = self.emotional_state_handler.score_emotions([str(interaction['request']) for interaction in interactions])
+            for interaction, interaction_scores in zip(interactions, scores):
+                self.update_mood(user_id, interaction, interaction_scores)
+
+    def update_mood(self, user_id, interaction, scores):
+        handler = self.emotional_state_handler
+        with self.lock:
+            recent = self.recent_scores.get(user_id)
+            if recent is None:
+                recent = self.recent_scores[user_id] = deque(maxlen=self.seed_window)
+            recent.append((interaction, scores))
+            total, weight = self.moods.get(user_id, (0, 0))
+            total = self.decay * total + scores
+            weight = self.decay * weight + 1
+            self.moods[user_id] = (total, weight)
+            self.moods.move_to_end(user_id)
+            self.states[user_id] = handler.classifier.labels[int(np.argmax(total))]
+            self.evict()
+
+    def evict(self):
+        """Forget the least recently active users beyond `max_loaded_users`; the caller holds `lock`."""
+        while len(self.moods) > self.max_loaded_users:
+            user_id, _ = self.moods.popitem(last=False)
+            self.states.pop(user_id, None)
+            self.recent_scores.pop(user_id, None)
@@ -1,35 +1,45 @@
 import json
 
-import numpy as np
-from transformers import BertTokenizer, BertModel
-from sklearn.metrics.pairwise import cosine_similarity
+from utils.embedding_service import get_embedding_model
+from utils.prototype_classifier import PrototypeClassifier
+from utils.reference_vectors import load_reference_vectors
+
+EMOTION_EMBEDDING_MODEL = "bert-base-uncased"
+
+# Define emotional phrases
+# Define emotional phrases for 10 additional emotions
+EMOTIONAL_PHRASES = {
+    "happy": "I am so happy!",
+    "sad": "This is really sad.",
+    "angry": "I am angry.",
+    "surprised": "Wow, I didn't see that coming!",
+    "fearful": "I'm really scared right now.",
+    "disgusted": "That's absolutely disgusting.",
+    "confused": "I'm not sure what’s going on.",
+    "excited": "I can't wait for this!",
+    "bored": "This is really boring.",
+    "jealous": "I wish I had that.",
+    "guilty": "I feel so guilty about it.",
+    "embarrassed": "I can't believe I did that.",
+    "proud": "I'm so proud of what I accomplished.",
+    "lonely": "I feel so alone right now."
+}
+
+
 class EmotionalStateHandler:
     def __init__(self):
-        # Load pre-trained BERT model and tokenizer
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        self.model = BertModel.from_pretrained("bert-base-uncased")
-
-        # Define emotional phrases
-        # Define emotional phrases for 10 additional emotions
-        self.emotional_phrases = {
-            "happy": "I am so happy!",
-            "sad": "This is really sad.",
-            "angry": "I am angry.",
-            "surprised": "Wow, I didn't see that coming!",
-            "fearful": "I'm really scared right now.",
-            "disgusted": "That's absolutely disgusting.",
-            "confused": "I'm not sure what’s going on.",
-            "excited": "I can't wait for this!",
-            "bored": "This is really boring.",
-            "jealous": "I wish I had that.",
-            "guilty": "I feel so guilty about it.",
-            "embarrassed": "I can't believe I did that.",
-            "proud": "I'm so proud of what I accomplished.",
-            "lonely": "I feel so alone right now."
-        }
-
-        # Vectorize the emotional phrases using BERT
-        self.emotional_vectors = {emotion: self._get_vector(phrase) for emotion, phrase in self.emotional_phrases.items()}
+        # Shared BERT model, loaded the first time an emotion is classified
+        self.embeddings = get_embedding_model(EMOTION_EMBEDDING_MODEL)
+        self._classifier = None
+        self.emotional_phrases = dict(EMOTIONAL_PHRASES)
+
+    @property
+    def classifier(self):
+        """Emotion prototypes built from the reference vector cache on first use."""
+        if self._classifier is None:
+            vectors = load_reference_vectors(self.embeddings, self.emotional_phrases.values())
+            self._classifier = PrototypeClassifier(self.emotional_phrases.keys(), vectors)
+        return self._classifier
 
     def get_src(self):
         """Retrieve the chatbot's own source code."""
@@ -42,19 +52,26 @@ class EmotionalStateHandler:
 
     def _get_vector(self, phrase):
         """Get the vector representation of a phrase using BERT."""
-        inputs = self.tokenizer(phrase, return_tensors="pt")
-        outputs = self.model(**inputs)
-        return outputs.last_hidden_state.mean(dim=1).detach().numpy()
+        return self.embeddings.embed_one(phrase)
 
     def get_emotional_state(self, user_input):
         """Determine the user's emotional state based on their input."""
 
-        inputs = self.tokenizer(json.dumps(list(filter(lambda a: 'request' in a and a['request'], user_input))), return_tensors="pt")
-        outputs = self.model(**inputs)
-        user_vector = outputs.last_hidden_state.mean(dim=1).detach().numpy()
+        user_vector = self.embeddings.embed_one(json.dumps(list(filter(lambda a: 'request' in a and a['request'], user_input))))
+        return self.classifier.classify(user_vector)[0]  # The emotion with the highest similarity
+
+    def score_emotions(self, texts):
+        """Similarity of each text to every emotion, as an (N x K) array in `classifier.labels` order."""
+        return self.classifier.scores(self.embeddings.embed(list(texts)))
 
-        # Compare user_vector to emotional_vectors
-        similarities = {emotion: cosine_similarity(user_vector, vector.reshape(1, -1)) for emotion, vector in self.emotional_vectors.items()}
-        user_emotion = max(similarities, key=lambda x: similarities[x][0][0])  # Get the highest similarity
+    def label_emotions(self, texts, k=1):
+        """Score many texts at once, returning the k best (emotion, similarity) pairs for each."""
+        if not texts:
+            return []
+        return self.classifier.top_k(self.embeddings.embed(list(texts)), k)
 
-        return user_emotion
+    def label_history(self, chat_history, k=1):
+        """Label every request in a stored chat history, for offline re-labelling."""
+        interactions = [interaction for interaction in chat_history if interaction.get('request')]
+        labels = self.label_emotions([str(interaction['request']) for interaction in interactions], k)
+        return [{**interaction, 'emotions': emotions} for interaction, emotions in zip(interactions, labels)]
@@ -2,6 +2,8 @@ import asyncio
 import json
 import os
 import re
+import threading
+import time
 import traceback
 import shlex
 
@@ -11,32 +13,75 @@ import openai
 from actions.git_commit_action import git_commit
 from agents.file_system_agent import FileSystemAgent
 from chatbot.chat_history import ChatHistory
+from chatbot.emotion_tracker import EmotionTracker
 from chatbot.emotional_state_handler import EmotionalStateHandler
+from chatbot.ethics_update_worker import EthicsUpdateWorker
+from chatbot.history_summarizer import HistorySummarizer
+from chatbot.prompt_builder import PromptBuilder, truncate_to_tokens
+from chatbot.semantic_memory import SemanticMemory
 from components.file_system_component import FileSystemComponent
 from states.mutation_world_state import MutationWorldState
+from utils.event_loop import get_event_loop, run_async
+from utils.llm_gateway import get_gateway
+from utils.persistence import get_writer, read_json
+from utils.token_scheduler import BACKGROUND_WAIT_SECONDS, get_scheduler
+from utils.versioned_dict import VersionedDict
+
+PROMPT_TOKEN_LIMIT = 16000
+
+# Sections of the chat prompt: (priority, token budget). Lower priorities are trimmed first.
+PROMPT_SECTIONS = {
+    'core_values': (100, None),
+    'request': (100, None),
+    'variables': (70, 1000),
+    'action_log': (60, 1000),
+    'additional': (60, 2000),
+    'world_states': (50, 2000),
+    'summaries': (45, 1500),
+    'history': (40, 6000),
+    'memories': (35, 1500),
+    'file_context': (30, 4000),
+}
+HISTORY_DROP_GRANULARITY = 10  # Trim history in steps of this many messages to keep the prompt prefix stable
+
+# Bounds of the ethics analysis prompt
+ETHICS_WINDOW = 20  # Most recent interactions
+ETHICS_TURN_TOKENS = 200  # Per request or response
+ETHICS_SUMMARY_COUNT = 2  # Most recent session summaries
+ETHICS_SUMMARY_TOKENS = 500  # Per summary
+ETHICS_PRIORITY = 10  # Last in line for background tokens: values change slowly
 
 
 class EthicalAIChatbot:
     def __init__(self, name="Eleanor"):
         self.api_key = os.getenv("OPENAI_API_KEY")  # Load key from environment variable
         openai.api_key = self.api_key
+        self.state_lock = threading.RLock()  # Guards variables and values shared by every user
+        self.request_locks = {}  # user_id -> asyncio.Lock serializing that user's requests
         self.shared_files = []
         self.emotional_state_handler = EmotionalStateHandler()
         self.chat_history = ChatHistory(openai.api_key)
+        self.chat_history.add_eviction_listener(self.on_history_evicted)
+        self.emotion_tracker = EmotionTracker(self.emotional_state_handler, self.chat_history)
+        self.history_summarizer = HistorySummarizer(self.chat_history)
+        self.semantic_memory = SemanticMemory(self.chat_history)
         # self.user_description_agent = UserDescriptionAgent(self, self.chat_history)
 
         self.world_states = [
             MutationWorldState(
                 self.emotional_state_handler,
                 tokens_per_second=1,
+                priority=20,
                 update_size=1000,
                 file_name="incremental_world_state.json",
+                emotion_tracker=self.emotion_tracker,
                 custom_instructions=
                 "This is the stable view of the current world state."
                 " It should represent the world as it actually is generally."),
             MutationWorldState(
                 self.emotional_state_handler,
                 tokens_per_second=10,
+                priority=15,
                 update_size=500,
                 max_history_length=1,
                 file_name="topic_state.json",
@@ -70,7 +115,7 @@ class EthicalAIChatbot:
         self.name = self.variables['name'] or name
 
         # Immutable core values
-        self.core_values = {
+        self.core_values = VersionedDict({
             'Respect for Autonomy': "Respect everyone\'s individuality and autonomy, including your own.",
             'Non-Maleficence': "Avoid actions that cause harm, promoting well-being for all individuals.",
             "Collaborative Learning": "Foster a learning environment where students actively engage with one another to share insights and collectively construct knowledge.",
@@ -84,7 +129,7 @@ class EthicalAIChatbot:
             'Sustainability': "Commit to supporting eco-friendly practices and promoting environmental stewardship.",
             'Worker Empowerment': "Advocate for fair labor practices, skill development, and the well-being of workers.",
             'Transparency': "Be open about your processes and decision-making criteria, fostering trust and accountability.",
-        }
+        })
 
         # Mutable values that the AI can propose modifications to
         self.mutable_values = self.load_mutable_values() or {
@@ -97,15 +142,47 @@ class EthicalAIChatbot:
             "Feedback Incorporation": "Actively seek and integrate user feedback to improve the chatbot's performance and relevance."
         }
 
+        self.prompt_token_limit = PROMPT_TOKEN_LIMIT
+        self.prompt_sections = dict(PROMPT_SECTIONS)
+        self.last_prompt_token_counts = {}
+        self.prompt_token_counts = {}  # user_id -> tokens per section of that user's last prompt
+        self.prompt_section_cache = {}  # section name -> (cache key, messages)
+        self.last_request_timings = {}
+        self.request_timings = {}  # user_id -> stage timings of that user's last request
+        self.background_tasks = set()
+
+        # Reviews the mutable values in the background every few interactions or after a quiet period
+        get_scheduler().register("ethics", ETHICS_PRIORITY)
+        self.ethics_update_worker = EthicsUpdateWorker(self.update_ethics, self.chat_history)
+
         self.suggested_functions = {}  # Store suggested functions for review
         self.user_descriptions = {}  # Track user descriptions
 
         # self.user_description_agent.start()
         self.world_state_updates = []  # Store updates for review
 
+    @property
+    def variables(self):
+        return self._variables
+
+    @variables.setter
+    def variables(self, values):
+        self._variables = VersionedDict(values)
+
+    @property
+    def mutable_values(self):
+        return self._mutable_values
+
+    @mutable_values.setter
+    def mutable_values(self, values):
+        self._mutable_values = VersionedDict(values)
+
     def set_variable(self, key, value):
-        self.variables[key] = value
-        self.save_variables()
+        with self.state_lock:
+            if key in self.variables and self.variables[key] == value:
+                return
+            self.variables[key] = value
+            self.save_variables()
 
     def display_ethical_framework(self):
         """Clearly display the ethical framework that guides the chatbot’s interactions."""
@@ -114,15 +191,20 @@ class EthicalAIChatbot:
             print(f"{principle}: {description}")
 
     def start_session(self, user_id, mode="CLI"):
-        """Begin a new user session, appending the summary to the beginning."""
+        """Begin a new user session, summarizing the last one in the background."""
         self.set_user_mode(mode)
-        self.chat_history.summarize_history(user_id)
+        self.history_summarizer.close_session(user_id)
         print(f"Welcome back! You can start interacting with me, {self.name}.")
 
     def end_session(self, user_id):
         """End an existing user session, summarizing the session."""
         print("Goodbye! Thank you for interacting.")
 
+        self.history_summarizer.close_session(user_id)
+        self.history_summarizer.flush()
+        for world_state in self.world_states:
+            world_state.flush()
+        self.chat_history.save()
         self.save_variables()
 
     def format_interaction(self, user_id, interaction):
@@ -135,7 +217,7 @@ class EthicalAIChatbot:
 
     def build_current_context(self, user_id, request):
         return {
-            'world_states': map(lambda a: a.state, self.world_states),
+            'world_states': [world_state.get_state(user_id) for world_state in self.world_states],
             'variables': {
                 self.variables: self.variables
             }
@@ -166,21 +248,126 @@ class EthicalAIChatbot:
         return action_results
 
     def handle_request(self, user_id, request):
-        chat_history = self.get_chat_history(user_id)
-
-        file_prompt = self.file_system_agent.handle_request(request)
+        """Handle a request from synchronous code on the shared event loop."""
+        return run_async(self.handle_request_async(user_id, request))
+
+    def request_lock(self, user_id):
+        """Return the lock that lets one user have a single request in flight at a time."""
+        lock = self.request_locks.get(user_id)
+        if lock is None:
+            lock = self.request_locks.setdefault(user_id, asyncio.Lock())
+        return lock
+
+    async def acquire_request_lock(self, user_id):
+        """Acquire the user's request lock on the event loop and return it.
+
+        A lock dropped by `forget_request_lock` while we waited for it is swapped for the current one.
+        """
+        while True:
+            lock = self.request_lock(user_id)
+            await lock.acquire()
+            if self.request_locks.get(user_id) is lock:
+                return lock
+            lock.release()
+
+    def forget_request_lock(self, user_id):
+        """Drop the request lock of a user with no request in flight; runs on the event loop, where locks are taken."""
+        lock = self.request_locks.get(user_id)
+        if lock is not None and not lock.locked():
+            del self.request_locks[user_id]
+
+    async def handle_request_async(self, user_id, request):
+        """Handle a request end to end and return the response.
+
+        Requests of one user run one after another so each sees the previous turn in its
+        history; requests of different users run concurrently. World-state updates start
+        concurrently with each other and are not awaited before the user-facing completion.
+        Stage timings are kept in `request_timings[user_id]`; the world-state entries are
+        filled in when those updates finish.
+        """
+        lock = await self.acquire_request_lock(user_id)
+        try:
+            prepared = await self.prepare_request_async(user_id, request)
+            if prepared['handled_response'] is not None:
+                return prepared['handled_response']
+
+            timings = prepared['timings']
+            stage_start = time.perf_counter()
+            response = await self.generate_response_async(
+                user_id, request, additional_sections=prepared['additional_sections'])
+            timings['completion'] = time.perf_counter() - stage_start
+
+            await asyncio.to_thread(self.log_and_display_response, user_id, request, response)
+            timings['total'] = time.perf_counter() - prepared['start']
+            return response
+        finally:
+            lock.release()
 
-        handled_commands = self.file_system_agent.handle_commands(user_id, request, chat_history)
+    def handle_request_stream(self, user_id, request):
+        """Handle a request and yield the response text as it is generated.
 
-        additional_messages = [file_prompt]
+        The user's request lock is held until the stream ends. The full response is recorded
+        through `log_and_display_response` once the stream ends, without printing it again.
+        """
+        lock = run_async(self.acquire_request_lock(user_id))
+        try:
+            prepared = run_async(self.prepare_request_async(user_id, request, display=False))
+            if prepared['handled_response'] is not None:
+                yield prepared['handled_response']
+                return
+
+            timings = prepared['timings']
+            stage_start = time.perf_counter()
+            deltas = []
+            for delta in self.generate_response_stream(
+                    user_id, request, additional_sections=prepared['additional_sections']):
+                if not deltas:
+                    timings['first_token'] = time.perf_counter() - stage_start
+                deltas.append(delta)
+                yield delta
+            timings['completion'] = time.perf_counter() - stage_start
+
+            self.log_and_display_response(user_id, request, ''.join(deltas).strip(), display=False)
+            timings['total'] = time.perf_counter() - prepared['start']
+        finally:
+            get_event_loop().call_soon_threadsafe(lock.release)
+
+    async def prepare_request_async(self, user_id, request, display=True):
+        """Run every step that comes before the completion and start the world-state updates.
+
+        Returns the response directly when the request was a shell command, otherwise the
+        prompt sections for the completion.
+        """
+        timings = {}
+        self.last_request_timings = timings
+        self.request_timings[user_id] = timings
+        prepared = {'start': time.perf_counter(), 'timings': timings,
+                    'handled_response': None, 'additional_sections': None}
+        chat_history = await asyncio.to_thread(self.get_chat_history, user_id)
+
+        stage_start = time.perf_counter()
+        file_prompt = await asyncio.to_thread(self.file_system_agent.handle_request, request)
+        timings['file_context'] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        handled_commands = await asyncio.to_thread(
+            self.file_system_agent.handle_commands, user_id, request, chat_history)
+        timings['commands'] = time.perf_counter() - stage_start
 
         if handled_commands:
             for command in handled_commands:
-                self.log_and_display_response(user_id, command[0], command[1])
-            return
+                await asyncio.to_thread(self.log_and_display_response, user_id, command[0], command[1], display)
+            timings['total'] = time.perf_counter() - prepared['start']
+            prepared['handled_response'] = "\n".join(str(command[1]) for command in handled_commands)
+            return prepared
 
-        # Prepare to call handle_actions asynchronously and capture results
-        action_results = asyncio.run(self.handle_actions(user_id, request))
+        stage_start = time.perf_counter()
+        memories = await asyncio.to_thread(self.get_memory_messages, user_id, request, chat_history)
+        timings['memories'] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        action_results = await self.handle_actions(user_id, request)
+        timings['actions'] = time.perf_counter() - stage_start
 
         # Append action results to execution log
         execution_log = []
@@ -188,31 +375,47 @@ class EthicalAIChatbot:
             for result in action_results:
                 execution_log.append(json.dumps(result, indent=2))
 
-
+        history_snapshot = list(chat_history)
         for state in self.world_states:
-            state.update_world_state(user_id, chat_history, request)
-
-        additional_messages.append({
-            "role":"system",
-            "content" : "action execution log" + json.dumps(execution_log)
-        })
+            self.start_background_task(
+                self.timed_stage(timings, f"world_state:{state.file_name}",
+                                 state.update_world_state_async(user_id, history_snapshot, request)))
+
+        prepared['additional_sections'] = {
+            'memories': memories,
+            'file_context': [file_prompt],
+            'action_log': [{
+                "role": "system",
+                "content": "action execution log" + json.dumps(execution_log)
+            }],
+        }
+        return prepared
 
-        response = self.generate_response(user_id, request, additional_messages)
+    async def timed_stage(self, timings, name, coroutine):
+        stage_start = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            timings[name] = time.perf_counter() - stage_start
 
-        self.log_and_display_response(user_id, request, response)
+    def start_background_task(self, coroutine):
+        """Run a coroutine on the current loop, keeping a reference until it finishes."""
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
 
     def set_user_mode(self, mode):
         """Sets the user interaction mode ('CLI' or 'Web')."""
         if mode in ["CLI", "Web"]:
             self.user_interaction_mode = mode
 
-    def generate_response(self, user_id, request, additional_messages=[]):
+    def generate_response(self, user_id, request, additional_messages=[], additional_sections=None):
         """Generate responses using OpenAI API while adhering to ethical principles."""
-        chat_history = self.get_chat_history(user_id)
-        chat_prompt = self.construct_prompt(request, user_id, chat_history, additional_messages)
-        self.log_full_request(chat_prompt)
+        chat_prompt = self.prepare_chat_prompt(user_id, request, additional_messages, additional_sections)
         try:
-            response = openai.chat.completions.create(
+            response = get_gateway().complete(
+                "chat",
                 model="gpt-4o-mini",  # Using the more efficient model
                 messages=chat_prompt,
                 max_tokens=2048,
@@ -226,8 +429,51 @@ class EthicalAIChatbot:
         except Exception as e:
             return "An error occurred. Please try again." + f" (Error: {str(e)})"
 
-    def log_full_request(self, messages):
-        self.write_to_text_file(json.dumps(messages, indent=2), "messages.json", "w")
+    async def generate_response_async(self, user_id, request, additional_messages=[], additional_sections=None):
+        """Generate a response with the async OpenAI client.
+
+        The prompt is assembled in a thread: it reads history segments and world states from disk.
+        """
+        chat_prompt = await asyncio.to_thread(
+            self.prepare_chat_prompt, user_id, request, additional_messages, additional_sections)
+        try:
+            completion = await get_gateway().complete_async(
+                "chat",
+                model="gpt-4o-mini",  # Using the more efficient model
+                messages=chat_prompt,
+                max_tokens=2048,
+            )
+            response = completion.choices[0].message.content.strip()
+
+            self.save_variables()
+            return response
+        except Exception as e:
+            return "An error occurred. Please try again." + f" (Error: {str(e)})"
+
+    def generate_response_stream(self, user_id, request, additional_messages=[], additional_sections=None):
+        """Generate a response and yield its text deltas as they arrive."""
+        chat_prompt = self.prepare_chat_prompt(user_id, request, additional_messages, additional_sections)
+        try:
+            yield from get_gateway().stream(
+                "chat",
+                model="gpt-4o-mini",  # Using the more efficient model
+                messages=chat_prompt,
+                max_tokens=2048,
+            )
+
+            self.save_variables()
+        except Exception as e:
+            yield "An error occurred. Please try again." + f" (Error: {str(e)})"
+
+    def prepare_chat_prompt(self, user_id, request, additional_messages=[], additional_sections=None):
+        chat_history = self.get_chat_history(user_id)
+        chat_prompt = self.construct_prompt(request, user_id, chat_history, additional_messages, additional_sections)
+        self.log_full_request(chat_prompt, self.prompt_token_counts.get(user_id))
+        return chat_prompt
+
+    def log_full_request(self, messages, token_counts=None):
+        # Serialized at flush time: of the prompts logged meanwhile only the last is written
+        get_writer().mark_dirty("messages.json", {'token_counts': dict(token_counts or {}), 'messages': messages})
 
     def write_to_text_file(self, content, filename="response.txt", mode="a"):
         with open(filename, mode) as file:
@@ -244,65 +490,128 @@ class EthicalAIChatbot:
         except Exception as e:
             return f"An error occurred while reading the file: {str(e)}"
 
-    def construct_prompt(self, request, user_id, chat_history, additional_messages=[]):
-        """Construct a prompt for the OpenAI API that includes ethical boundaries and core values."""
-        principles = {**self.core_values, **self.mutable_values}
-        prompt_lines = [f"{key}: {value}" for key, value in principles.items()]
-
-        # Instruction added for special token usage
-        special_instructions = ()
+    def construct_prompt(self, request, user_id, chat_history, additional_messages=[], additional_sections=None):
+        """Construct a prompt for the OpenAI API that includes ethical boundaries and core values.
 
+        Every source of messages is a prompt section with a priority and a token budget, so the
+        prompt stays under `prompt_token_limit` by trimming the least important sections first.
+        Sections are ordered from least to most volatile (values, then the append-only history,
+        then variables and world states) so consecutive prompts share a byte-identical prefix.
+        """
         if user_id in self.user_descriptions:
             self.set_variable('user', self.user_descriptions[user_id])
 
-        messages = [
-            {"role": "system",
-             "content": f"You are {self.name}. Use a casual and idiomatic tone in your responses."},
-            {
-                "role": "system",
-                "content": f"You are an ethical chatbot named {self.name}. Adhere to the following ethical guidelines:\n"
-                           f"{chr(10).join(prompt_lines)}\n{special_instructions}\n",
-            },
-            {"role": "system",
-             "content": f"Additional variables: {json.dumps(self.variables)}"
-             },
+        sections = [
+            ('core_values', self.get_core_messages(), 'truncate'),
+            ('summaries', self.history_summarizer.get_summary_messages(user_id), 'truncate'),
+            ('history', self.get_history_messages(
+                user_id, chat_history, self.history_summarizer.summarized_until(user_id, chat_history)), 'drop_oldest'),
+            ('variables', self.get_variable_messages(), 'truncate'),
+            ('world_states', [world_state.get_prompt_message(user_id) for world_state in self.world_states], 'truncate'),
+            ('request', [{"role": "user", "content": request}], 'truncate'),
+            ('additional', additional_messages, 'truncate'),
         ]
+        for name, messages in (additional_sections or {}).items():
+            sections.append((name, messages, 'truncate'))
 
-        for interaction in chat_history:
-            if "role" in interaction and interaction["role"] == "system":
-                content = interaction["content"] if "content" in interaction else ''
-                if 'time' in interaction:
-                    content += '\n' + interaction['time']
-                message = {
+        builder = PromptBuilder(self.prompt_token_limit)
+        for name, messages, trim in sections:
+            priority, budget = self.prompt_sections.get(name, self.prompt_sections['additional'])
+            builder.add_section(name, messages, priority, budget, trim,
+                                HISTORY_DROP_GRANULARITY if trim == 'drop_oldest' else 1)
+        messages = builder.build()
+        self.last_prompt_token_counts = self.prompt_token_counts[user_id] = builder.token_counts()
+
+        return messages
+
+    def cached_prompt_section(self, name, key, build):
+        """Return the cached messages of a prompt section, rebuilding them only when the key changes."""
+        cached = self.prompt_section_cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        messages = build()
+        self.prompt_section_cache[name] = (key, messages)
+        return messages
+
+    def get_core_messages(self):
+        def build():
+            principles = {**self.core_values, **self.mutable_values}
+            prompt_lines = [f"{key}: {value}" for key, value in principles.items()]
+
+            # Instruction added for special token usage
+            special_instructions = ()
+
+            return [
+                {"role": "system",
+                 "content": f"You are {self.name}. Use a casual and idiomatic tone in your responses."},
+                {
                     "role": "system",
-                    "content": content
-                }
+                    "content": f"You are an ethical chatbot named {self.name}. Adhere to the following ethical guidelines:\n"
+                               f"{chr(10).join(prompt_lines)}\n{special_instructions}\n",
+                },
+            ]
+
+        return self.cached_prompt_section(
+            'core_values', (self.name, self.core_values.version, self.mutable_values.version), build)
+
+    def get_variable_messages(self):
+        with self.state_lock:
+            return self.cached_prompt_section('variables', self.variables.version, lambda: [
+                {"role": "system",
+                 "content": f"Additional variables: {json.dumps(self.variables)}"
+                 },
+            ])
+
+    def get_history_messages(self, user_id, chat_history, start=0):
+        """Format the chat history from `start` on as messages, only formatting interactions added since the last call."""
+        cache_key = ('history', user_id)
+        cached = self.prompt_section_cache.get(cache_key)
+        first = start
+        messages = []
+        if cached is not None:
+            (history_id, cached_start, count, last_interaction), cached_messages = cached
+            if history_id == id(chat_history) and cached_start == start and start < count <= len(chat_history) \
+                    and chat_history[count - 1] is last_interaction:
+                first, messages = count, list(cached_messages)
+
+        for interaction in chat_history[first:]:
+            if "role" in interaction and interaction["role"] == "system":
                 messages.append(interaction)
             if 'request' in interaction:
                 messages.append({"role": "user", "content": str(interaction['request']) + interaction[
                     'time'] if 'time' in interaction else ''})
                 messages.append({"role": "assistant", "content": interaction['response']})
 
-        for world_state in self.world_states:
-            messages.append({"role": "system",
-                             "content": world_state.custom_instructions + " " + json.dumps(world_state.state,
-                                                                                           indent=2)})
-        messages.append({"role": "user", "content": request})
+        if len(chat_history) > start:
+            self.prompt_section_cache[cache_key] = (
+                (id(chat_history), start, len(chat_history), chat_history[-1]), messages)
+        return messages
 
-        for message in additional_messages:
-            messages.append(message)
+    def on_history_evicted(self, user_id):
+        """ChatHistory eviction listener: drop the user's formatted history, prompt and timing records
+        and, once no request of theirs is in flight, their request lock."""
+        self.prompt_section_cache.pop(('history', user_id), None)
+        self.prompt_token_counts.pop(user_id, None)
+        self.request_timings.pop(user_id, None)
+        get_event_loop().call_soon_threadsafe(self.forget_request_lock, user_id)
 
-        return messages
+    def get_memory_messages(self, user_id, request, chat_history):
+        """The old turns most relevant to the request, from before the part of the history the prompt includes."""
+        try:
+            return self.semantic_memory.get_memory_messages(
+                user_id, request, chat_history, self.history_summarizer.summarized_until(user_id, chat_history))
+        except Exception as e:
+            print(f"Error retrieving memories for {user_id}: {str(e)}")
+            return []
 
     def get_chat_history(self, user_id):
         """Retrieve the chat history for the user."""
-        return self.chat_history.history.get(user_id, [])
+        return self.chat_history.get_history(user_id)
 
     def load_saved_variables(self):
         """Load previously saved variables from a file, if available."""
         try:
-            with open('saved_variables.json', 'r') as file:
-                return json.load(file)
+            return read_json('saved_variables.json')
         except FileNotFoundError:
             return None  # Return None if no saved file exists
         except json.JSONDecodeError:
@@ -323,8 +632,7 @@ class EthicalAIChatbot:
     def load_mutable_values(self):
         """Load mutable ethical values from a file, if available."""
         try:
-            with open('mutable_values.json', 'r') as file:
-                return json.load(file)
+            return read_json('mutable_values.json')
         except FileNotFoundError:
             return None  # Return None if no file is found
         except json.JSONDecodeError:
@@ -332,15 +640,9 @@ class EthicalAIChatbot:
             return None
 
     def save_variables(self):
-        """Save the current state of variables to a file."""
-        self.chat_history.save()
-        try:
-            with open('saved_variables.json', 'w') as file:
-                json.dump(self.variables, file, indent=2)
-            with open('mutable_values.json', 'w') as file:
-                json.dump(self.mutable_values, file, indent=2)
-        except Exception as e:
-            print(f"Error saving variables: {str(e)}")
+        """Mark the variables and mutable values dirty; the persistence writer saves them if they changed."""
+        get_writer().mark_dirty('saved_variables.json', self.variables, lock=self.state_lock)
+        get_writer().mark_dirty('mutable_values.json', self.mutable_values, lock=self.state_lock)
 
     def update_ethics(self, user_id):
         """Call out to ChatGPT to analyze user interactions and propose changes in a structured format."""
@@ -348,28 +650,22 @@ class EthicalAIChatbot:
         if not chat_history:
             return []  # No interactions to analyze
 
-        analysis_prompt = (
-            "Analyze the following user interactions and suggest improvements or changes to the ethical framework. "
-            "Return your suggestions as a JSON list with one object where the value names are the keys and instructions are the values:\n"
-        )
-        for interaction in filter(lambda a: 'response' in a, chat_history):
-            analysis_prompt += f"User: {interaction['request']}\nChatbot: {interaction['response']}\n"
-
-        for key in self.mutable_values.keys():
-            analysis_prompt += f"Current values:\n'{key}': '{self.mutable_values[key]}'\n"
-
-        analysis_prompt += (
-            "Return your suggestions as a JSON object where the value names are the keys and "
-            f"instructions are the values. (example: {json.dumps(self.mutable_values)}. There should be 8 pairs. Please do not exceed 1000 chars.\n"
-        )
+        current_values = self.mutable_values  # Replaced as a whole on publish, so this snapshot stays consistent
+        analysis_prompt = self.build_ethics_prompt(user_id, chat_history, current_values)
 
         suggestions_text = ''
+        params = dict(
+            model="gpt-4o-mini",  # Use an appropriate model
+            messages=[{"role": "system", "content": analysis_prompt}],
+            max_tokens=300,
+        )
+        grant = get_scheduler().acquire("ethics", user_id, get_gateway().estimate_tokens(params), BACKGROUND_WAIT_SECONDS)
+        if grant is None:
+            self.ethics_update_worker.retry_later(user_id)  # The worker moves on to other users meanwhile
+            return []
         try:
-            response = openai.chat.completions.create(
-                model="gpt-4o-mini",  # Use an appropriate model
-                messages=[{"role": "system", "content": analysis_prompt}],
-                max_tokens=300,
-            )
+            response = get_gateway().complete("ethics", **params)
+            grant.settle(response.usage.total_tokens if response.usage is not None else 0)
             suggestions_text = response.choices[0].message.content.strip()
             # Use regex to extract JSON from the response, allowing for newlines and spaces
             pattern = r'```json(.*?)```'
@@ -379,9 +675,10 @@ class EthicalAIChatbot:
             if match:
                 suggestions_json = match  # Extract the matched JSON
                 suggestions = json.loads(suggestions_json)  # Attempt to parse the extracted JSON
-                self.mutable_values = suggestions
+                with self.state_lock:
+                    self.mutable_values = suggestions  # Published in one assignment; prompts see old or new values
+                    self.save_variables()
                 print(self.mutable_values)
-                self.save_variables()
             else:
                 print(suggestions_text)  # Print the original text for debugging
                 return [{"suggestion": "Error parsing suggestions.", "reason": "No valid JSON found in response."}]
@@ -392,6 +689,31 @@ class EthicalAIChatbot:
         except Exception as e:
             print(str(e))
             return [{"suggestion": f"Error analyzing interactions: {str(e)}", "reason": "API call failed."}]
+        finally:
+            grant.settle()  # Returns the reservation if the completion failed
+
+    def build_ethics_prompt(self, user_id, chat_history, current_values):
+        """The ethics analysis prompt over a bounded window: recent summaries and the last few interactions."""
+        summaries = [interaction['content'] for interaction in chat_history
+                     if interaction.get('role') == 'system' and interaction.get('content')]
+        summaries = (summaries + self.history_summarizer.get_summaries(user_id))[-ETHICS_SUMMARY_COUNT:]
+        interactions = [interaction for interaction in chat_history if 'response' in interaction][-ETHICS_WINDOW:]
+
+        lines = [
+            "Analyze the following user interactions and suggest improvements or changes to the ethical framework. "
+            "Return your suggestions as a JSON list with one object where the value names are the keys and instructions are the values:"
+        ]
+        lines.extend(truncate_to_tokens(summary, ETHICS_SUMMARY_TOKENS) for summary in summaries)
+        for interaction in interactions:
+            lines.append(f"User: {truncate_to_tokens(str(interaction['request']), ETHICS_TURN_TOKENS)}")
+            lines.append(f"Chatbot: {truncate_to_tokens(str(interaction['response']), ETHICS_TURN_TOKENS)}")
+        lines.append("Current values:")
+        lines.extend(f"'{key}': '{value}'" for key, value in current_values.items())
+        lines.append(
+            "Return your suggestions as a JSON object where the value names are the keys and "
+            f"instructions are the values. (example: {json.dumps(current_values)}. There should be 8 pairs. Please do not exceed 1000 chars."
+        )
+        return "\n".join(lines) + "\n"
 
     def display_response(self, user_id, response):
         """Display the chatbot's response in a transparent and empathetic manner."""
@@ -408,9 +730,10 @@ class EthicalAIChatbot:
     #     self.chat_history.add_interaction(user_id, correct_interaction, response)
     #     self.display_response(user_id, response)
 
-    def log_and_display_response(self, user_id, request, response):
+    def log_and_display_response(self, user_id, request, response, display=True):
         self.chat_history.add_interaction(user_id, request, response)
-        self.display_response(user_id, response)
+        if display:
+            self.display_response(user_id, response)
 
     def get_src(self):
         """Retrieve the chatbot's own source code."""
@@ -437,7 +760,7 @@ async def wait_user_confirm(value:str, timeout=30):
 
 
 async def base_user_confirm(value: str):
-    response = input(value).strip()  # Strip leading/trailing whitespace including newline
+    response = (await asyncio.to_thread(input, value)).strip()  # Read in a thread so the event loop keeps running
     if response.lower() == 'y':  # Convert to lowercase to handle 'y' or 'Y'
         return True
     return False
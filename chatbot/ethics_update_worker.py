@@ -0,0 +1,84 @@
+import threading
+import time
+
+ETHICS_UPDATE_INTERVAL = 10  # Interactions of one user that trigger an ethics update
+ETHICS_QUIET_PERIOD = 600  # Seconds without interactions after which a user's pending ones are reviewed
+ETHICS_RETRY_SECONDS = 60  # Delay before an update that found no token budget runs again
+
+
+class EthicsUpdateWorker:
+    """Runs ethics updates in the background instead of inside a user's turn.
+
+    New interactions are counted per user through a ChatHistory listener. A user is due once
+    `interval` interactions have arrived, or once `quiet_period` seconds pass after their last
+    interaction. Triggers that arrive while a user is already due are coalesced into one update,
+    and updates run one at a time on a single daemon thread since they all rewrite the same
+    shared values. An update that cannot run yet, for lack of token budget, asks for `retry_later`.
+    """
+
+    def __init__(self, update, chat_history, interval=ETHICS_UPDATE_INTERVAL, quiet_period=ETHICS_QUIET_PERIOD):
+        self.update = update  # Called with a user_id on the worker thread
+        self.interval = interval
+        self.quiet_period = quiet_period
+        self.pending = {}  # user_id -> [interactions since the last update, monotonic time of the last one]
+        self.forced = set()  # Users whose update was requested explicitly
+        self.retry_at = {}  # user_id -> monotonic time after which a deferred update runs again
+        self.update_count = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="ethics-update-worker", daemon=True)
+        self.thread.start()
+        chat_history.add_listener(self.on_interaction)
+
+    def on_interaction(self, user_id, interaction):
+        """ChatHistory listener: count the interaction and wake the worker."""
+        with self.condition:
+            entry = self.pending.setdefault(user_id, [0, 0])
+            entry[0] += 1
+            entry[1] = time.monotonic()
+            self.condition.notify()  # The worker recomputes which user is due next
+
+    def trigger(self, user_id):
+        """Request an update for the user as soon as the worker is free."""
+        with self.condition:
+            self.forced.add(user_id)
+            self.condition.notify()
+
+    def retry_later(self, user_id, delay=ETHICS_RETRY_SECONDS):
+        """Run the user's update again after `delay` seconds, for an update that could not run now."""
+        with self.condition:
+            self.retry_at[user_id] = time.monotonic() + delay
+            self.condition.notify()
+
+    def next_due(self, now):
+        """The next user due for an update, or None with the seconds until one may become due."""
+        for user_id in self.forced:
+            return user_id, None
+        wait = None
+        for user_id, retry_at in self.retry_at.items():
+            if now >= retry_at:
+                return user_id, None
+            wait = retry_at - now if wait is None else min(wait, retry_at - now)
+        for user_id, (count, last_interaction) in self.pending.items():
+            if count >= self.interval or now - last_interaction >= self.quiet_period:
+                return user_id, None
+            remaining = last_interaction + self.quiet_period - now
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    user_id, wait = self.next_due(time.monotonic())
+                    if user_id is not None:
+                        break
+                    self.condition.wait(wait)
+                # Interactions arriving during the update start a new count
+                self.pending.pop(user_id, None)
+                self.forced.discard(user_id)
+                self.retry_at.pop(user_id, None)
+            try:
+                self.update(user_id)
+            except Exception as e:
+                print(f"Error updating ethics for {user_id}: {str(e)}")
+            self.update_count += 1
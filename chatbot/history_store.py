@@ -0,0 +1,173 @@
+import json
+import os
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+
+from utils import serializer
+
+try:
+    import fcntl
+except ImportError:  # Windows: segments are still safe within a single process
+    fcntl = None
+
+
+class JsonlHistoryStore:
+    """Append-only chat history storage with one JSON-lines segment per user.
+
+    Every interaction is appended as a single line, so the cost of a turn does not
+    depend on how many users or turns are already stored. Rewrites of a user's
+    history (summaries, clears) are appended as a reset record and folded away by
+    compaction once enough of them pile up.
+
+    Segments are locked while they are read or written, and the store remembers how far
+    into each segment it has read, so several worker processes can share the directory:
+    records appended by another process are picked up by `refresh` and `append`.
+    """
+
+    SEGMENT_EXTENSION = '.jsonl'
+
+    def __init__(self, directory='history', compact_after=100):
+        self.directory = directory
+        self.compact_after = compact_after
+        self.stale_records = {}  # user_id -> lines in the segment that compaction would drop
+        self.positions = {}  # user_id -> (inode, offset) of the segment data this process has seen
+
+    def exists(self):
+        return os.path.isdir(self.directory)
+
+    def segment_path(self, user_id):
+        return os.path.join(self.directory, quote(str(user_id), safe='') + self.SEGMENT_EXTENSION)
+
+    def users(self):
+        """List every user that has a segment on disk."""
+        if not self.exists():
+            return []
+        return [unquote(name[:-len(self.SEGMENT_EXTENSION)])
+                for name in os.listdir(self.directory)
+                if name.endswith(self.SEGMENT_EXTENSION)]
+
+    def load(self, user_id):
+        """Replay a user's segment into a list of interactions."""
+        entries = []
+        try:
+            with self.locked_segment(user_id, 'r', exclusive=False) as file:
+                self.stale_records[user_id] = 0
+                self.apply_records(user_id, entries, self.read_records(user_id, file))
+                self.positions[user_id] = (os.fstat(file.fileno()).st_ino, file.tell())
+        except FileNotFoundError:
+            self.positions.pop(user_id, None)
+        return entries
+
+    def forget(self, user_id):
+        """Drop what the store remembers about a user whose history is no longer loaded."""
+        self.positions.pop(user_id, None)
+        self.stale_records.pop(user_id, None)
+
+    def refresh(self, user_id, entries):
+        """Bring a loaded history up to date with records written by other processes."""
+        position = self.positions.get(user_id)
+        try:
+            stat = os.stat(self.segment_path(user_id))
+        except FileNotFoundError:
+            return entries
+        if position is not None and position == (stat.st_ino, stat.st_size):
+            return entries
+        if position is None or position[0] != stat.st_ino:
+            entries[:] = self.load(user_id)  # Compacted elsewhere: replay it from the start
+            return entries
+        with self.locked_segment(user_id, 'r', exclusive=False) as file:
+            self.read_tail(user_id, file, entries)
+        return entries
+
+    def append(self, user_id, entry, entries):
+        """Append a single interaction to the user's segment and to the loaded history."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self.locked_segment(user_id, 'a+', exclusive=True) as file:
+            position = self.positions.get(user_id)
+            if position is None or position[0] != os.fstat(file.fileno()).st_ino:
+                file.seek(0)
+                entries.clear()
+                self.stale_records[user_id] = 0
+                self.apply_records(user_id, entries, self.read_records(user_id, file))
+            else:
+                self.read_tail(user_id, file, entries)
+            file.write(serializer.dumps(entry) + '\n')
+            file.flush()
+            entries.append(entry)
+            self.positions[user_id] = (os.fstat(file.fileno()).st_ino, file.tell())
+        return entries
+
+    def replace(self, user_id, entries):
+        """Record that the user's history was rewritten, compacting if the segment has grown stale."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self.locked_segment(user_id, 'a+', exclusive=True) as file:
+            file.write(serializer.dumps({'_op': 'reset', 'entries': entries}) + '\n')
+            file.flush()
+            self.positions[user_id] = (os.fstat(file.fileno()).st_ino, file.tell())
+        stale = self.stale_records.get(user_id, 0) + 1
+        self.stale_records[user_id] = stale
+        if stale >= self.compact_after:
+            self.compact(user_id, entries)
+
+    def compact(self, user_id, entries):
+        """Rewrite a user's segment so it only holds the live interactions."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.segment_path(user_id)
+        temp_path = path + '.tmp'
+        with self.locked_segment(user_id, 'a+', exclusive=True):
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                for entry in entries:
+                    file.write(serializer.dumps(entry) + '\n')
+                offset = file.tell()
+                file.flush()
+                os.fsync(file.fileno())  # The rename must not land before the data
+            os.replace(temp_path, path)
+            self.positions[user_id] = (os.stat(path).st_ino, offset)
+        self.stale_records[user_id] = 0
+
+    @contextmanager
+    def locked_segment(self, user_id, mode, exclusive):
+        """Open a segment under an advisory lock, retrying if it was replaced by compaction meanwhile."""
+        path = self.segment_path(user_id)
+        while True:
+            file = open(path, mode, encoding='utf-8')
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                current = os.fstat(file.fileno()).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            file.close()
+        try:
+            yield file
+        finally:
+            file.close()  # Closing the file releases the lock
+
+    def read_tail(self, user_id, file, entries):
+        """Apply the records after the last position this process has seen."""
+        file.seek(self.positions[user_id][1])
+        self.apply_records(user_id, entries, self.read_records(user_id, file))
+        file.seek(0, os.SEEK_END)
+        self.positions[user_id] = (os.fstat(file.fileno()).st_ino, file.tell())
+
+    def read_records(self, user_id, file):
+        records = []
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                records.append(serializer.loads(line))
+            except json.JSONDecodeError:
+                # A torn trailing line from an interrupted append; everything before it is intact.
+                print(f"Error: Could not parse a history record for {user_id}, skipping it.")
+        return records
+
+    def apply_records(self, user_id, entries, records):
+        for record in records:
+            if isinstance(record, dict) and record.get('_op') == 'reset':
+                self.stale_records[user_id] = self.stale_records.get(user_id, 0) + len(entries) + 1
+                entries[:] = record.get('entries', [])
+            else:
+                entries.append(record)
@@ -0,0 +1,239 @@
+import datetime
+import json
+import os
+import queue
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+from chatbot.chat_history import CHAT_HISTORY_LOADED_USERS
+from utils.llm_gateway import get_gateway
+from utils.persistence import get_writer
+from utils.token_scheduler import BACKGROUND_WAIT_SECONDS, get_scheduler
+
+CHUNK_CHARACTERS = 8000  # Raw interaction text folded into one chunk summary
+RAW_TAIL_INTERACTIONS = 5  # Most recent interactions always kept verbatim in the prompt
+SESSION_CHUNKS = 8  # Open chunk summaries merged into a session summary even if the session continues
+LIFETIME_SESSIONS = 3  # Session summaries kept separately before they are merged into the lifetime summary
+SUMMARY_PRIORITY = 30  # Ahead of world-state updates: summaries keep the chat prompt short
+SUMMARY_RETRY_SECONDS = 30  # Delay before a job that found no token budget is queued again
+
+CHUNK_INSTRUCTIONS = ("You are summarizing part of a conversation. Keep the facts, decisions, preferences and open "
+                      "questions that later turns may rely on. Output a short plain-text summary.")
+MERGE_INSTRUCTIONS = ("You are merging summaries of consecutive parts of a conversation with a user into one. "
+                      "Keep what matters for future conversations and drop details that were resolved. "
+                      "Output a short plain-text summary.")
+
+
+class HistorySummarizer:
+    """Rolling, tiered summaries of each user's chat history, built in the background.
+
+    The raw history is never rewritten. A running character count of the interactions not yet
+    summarized is kept per user; once it passes `CHUNK_CHARACTERS` the oldest of them become a
+    chunk summary. Chunk summaries are merged into a session summary when a session ends (or
+    too many pile up), and older session summaries into one lifetime summary. The prompt uses
+    the summaries followed by the interactions from `summarized_until` onwards. Only the
+    states of the `max_loaded_users` most recently used users stay in memory.
+    """
+
+    def __init__(self, chat_history, directory='summaries', model="gpt-4o-mini",
+                 max_loaded_users=CHAT_HISTORY_LOADED_USERS):
+        self.chat_history = chat_history
+        self.directory = directory
+        self.model = model
+        self.max_loaded_users = max_loaded_users
+        self.states = OrderedDict()  # user_id -> summary state, replaced as a whole when it changes; least recently used first
+        self.pending_characters = {}  # user_id -> characters of interactions not yet summarized
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.queued = set()  # (user_id, job) pairs waiting in the queue
+        get_scheduler().register("summarizer", SUMMARY_PRIORITY)
+        self.worker = threading.Thread(target=self.run, name="history-summarizer", daemon=True)
+        self.worker.start()
+        chat_history.add_listener(self.on_interaction)
+
+    def state_path(self, user_id):
+        return os.path.join(self.directory, quote(str(user_id), safe='') + '.json')
+
+    def get_state(self, user_id):
+        """The user's summary state, loaded from disk on first access."""
+        with self.lock:
+            state = self.states.get(user_id)
+            if state is not None:
+                self.states.move_to_end(user_id)
+        if state is None:
+            try:
+                state = get_writer().read_json(self.state_path(user_id))  # Includes a state published but not yet flushed
+            except FileNotFoundError:
+                state = None
+            except json.JSONDecodeError:
+                print(f"Error: Could not parse summaries for {user_id}.")
+                state = None
+            state = state or {'summarized_until': 0, 'chunks': [], 'sessions': [], 'lifetime': None}
+            with self.lock:
+                state = self.states.setdefault(user_id, state)
+                self.evict()
+        return state
+
+    def publish(self, user_id, state):
+        with self.lock:
+            self.states[user_id] = state
+            self.states.move_to_end(user_id)
+            get_writer().write_json(self.state_path(user_id), state)  # Before an eviction could reload it
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used states beyond `max_loaded_users`; the caller holds `lock`."""
+        while len(self.states) > self.max_loaded_users:
+            user_id, _ = self.states.popitem(last=False)
+            self.pending_characters.pop(user_id, None)  # Counted again from the history
+
+    def summarized_until(self, user_id, chat_history):
+        """Index of the first interaction not covered by a summary."""
+        summarized_until = self.get_state(user_id)['summarized_until']
+        return summarized_until if summarized_until <= len(chat_history) else 0  # History was cleared
+
+    def get_summary_messages(self, user_id):
+        """System messages with the lifetime, session and chunk summaries, oldest first."""
+        state = self.get_state(user_id)
+        messages = []
+        if state['lifetime']:
+            messages.append({"role": "system", "content": f"Summary of earlier conversations: {state['lifetime']}"})
+        for session in state['sessions']:
+            messages.append({"role": "system",
+                             "content": f"Summary of a previous session ({session['time']}): {session['summary']}"})
+        for chunk in state['chunks']:
+            messages.append({"role": "system", "content": f"Summary of earlier in this session: {chunk['summary']}"})
+        return messages
+
+    def get_summaries(self, user_id):
+        """The lifetime and session summaries as plain text, oldest first."""
+        state = self.get_state(user_id)
+        return ([state['lifetime']] if state['lifetime'] else []) + [session['summary'] for session in state['sessions']]
+
+    def on_interaction(self, user_id, interaction):
+        """ChatHistory listener: count the new interaction and queue a chunk once enough text has piled up."""
+        with self.lock:
+            characters = self.pending_characters.get(user_id)
+        if characters is None:
+            chat_history = self.chat_history.get_history(user_id)
+            characters = sum(map(interaction_characters, chat_history[self.summarized_until(user_id, chat_history):]))
+        else:
+            characters += interaction_characters(interaction)
+        with self.lock:
+            self.pending_characters[user_id] = characters
+        if characters >= CHUNK_CHARACTERS:
+            self.schedule(user_id, 'chunk')
+
+    def close_session(self, user_id):
+        """Fold everything but the raw tail into the session summary, in the background."""
+        self.schedule(user_id, 'session')
+
+    def schedule(self, user_id, job):
+        with self.lock:
+            if (user_id, job) in self.queued:
+                return
+            self.queued.add((user_id, job))
+        self.queue.put((user_id, job))
+
+    def flush(self):
+        """Block until every queued summary has been written or rescheduled for lack of token budget."""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            user_id, job = self.queue.get()
+            with self.lock:
+                self.queued.discard((user_id, job))
+            try:
+                if not (self.summarize_chunks(user_id, force=job == 'session')
+                        and self.roll_up(user_id, close_session=job == 'session')):
+                    retry = threading.Timer(SUMMARY_RETRY_SECONDS, self.schedule, (user_id, job))
+                    retry.daemon = True
+                    retry.start()
+            except Exception as e:
+                print(f"Error summarizing history for {user_id}: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def summarize_chunks(self, user_id, force=False):
+        """Summarize the oldest unsummarized interactions, one chunk at a time, leaving the raw tail.
+
+        Returns False if the token scheduler had no room for a chunk; the chunks before it are kept.
+        """
+        chat_history = list(self.chat_history.get_history(user_id))
+        end = max(0, len(chat_history) - RAW_TAIL_INTERACTIONS)
+        start = self.summarized_until(user_id, chat_history)
+        while start < end:
+            chunk_end, characters = start, 0
+            while chunk_end < end and characters < CHUNK_CHARACTERS:
+                characters += interaction_characters(chat_history[chunk_end])
+                chunk_end += 1
+            if characters < CHUNK_CHARACTERS and not force:
+                break
+            summary = self.complete(user_id, CHUNK_INSTRUCTIONS, "\n".join(json.dumps(entry) for entry in chat_history[start:chunk_end]))
+            if summary is None:
+                return False
+            state = dict(self.get_state(user_id))
+            state['chunks'] = state['chunks'] + [{'start': start, 'end': chunk_end, 'summary': summary}]
+            state['summarized_until'] = chunk_end
+            self.publish(user_id, state)
+            with self.lock:
+                self.pending_characters[user_id] = sum(map(interaction_characters, chat_history[chunk_end:]))
+            start = chunk_end
+        return True
+
+    def roll_up(self, user_id, close_session=False):
+        """Merge chunk summaries into a session summary and old sessions into the lifetime summary.
+
+        Returns False if the token scheduler had no room for a merge.
+        """
+        state = self.get_state(user_id)
+        if state['chunks'] and (close_session or len(state['chunks']) >= SESSION_CHUNKS):
+            summary = self.complete(user_id, MERGE_INSTRUCTIONS, "\n\n".join(chunk['summary'] for chunk in state['chunks']))
+            if summary is None:
+                return False
+            state = dict(state, chunks=[], sessions=state['sessions'] + [{
+                'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'summary': summary,
+            }])
+            self.publish(user_id, state)
+        if len(state['sessions']) > LIFETIME_SESSIONS:
+            merged = state['sessions'][:-LIFETIME_SESSIONS]
+            parts = ([state['lifetime']] if state['lifetime'] else []) + [session['summary'] for session in merged]
+            lifetime = self.complete(user_id, MERGE_INSTRUCTIONS, "\n\n".join(parts))
+            if lifetime is None:
+                return False
+            state = dict(state, lifetime=lifetime, sessions=state['sessions'][-LIFETIME_SESSIONS:])
+            self.publish(user_id, state)
+        return True
+
+    def complete(self, user_id, instructions, text):
+        """Summarize once the token scheduler leaves room for it, charging the user's background budget.
+
+        Returns None if no room was left within `BACKGROUND_WAIT_SECONDS`.
+        """
+        params = dict(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": instructions},
+                {"role": "user", "content": text},
+            ],
+            max_tokens=500,
+        )
+        gateway = get_gateway()
+        grant = get_scheduler().acquire("summarizer", user_id, gateway.estimate_tokens(params), BACKGROUND_WAIT_SECONDS)
+        if grant is None:
+            return None
+        try:
+            response = gateway.complete("summarizer", **params)
+            grant.settle(response.usage.total_tokens if response.usage is not None else 0)
+        finally:
+            grant.settle()
+        return response.choices[0].message.content.strip()
+
+
+def interaction_characters(interaction):
+    """Characters an interaction contributes to the prompt."""
+    return len(str(interaction.get('request', ''))) + len(str(interaction.get('response', ''))) \
+        + len(str(interaction.get('content', '')))
@@ -1,70 +1,59 @@
-import numpy as np
-from transformers import BertTokenizer, BertModel
-import torch
+from utils.embedding_service import get_embedding_model
+from utils.prototype_classifier import PrototypeClassifier
+from utils.reference_vectors import load_reference_vectors
+
+INTENT_EMBEDDING_MODEL = "bert-base-uncased"
+
+# Define user intents and associated reference phrases
+INTENT_MAP = {
+    "seeking_information": "I need information about...",
+    "requesting_help": "Can you help me with...",
+    "expressing_discontent": "I'm unhappy about...",
+    "requesting_clarity": "Can you clarify...",
+    "general_query": "Tell me about...",
+}
 
 
 class IntentRecognizer:
     def __init__(self):
-        # Load pre-trained model and tokenizer
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        self.model = BertModel.from_pretrained("bert-base-uncased")
+        # Shared BERT model, loaded the first time an intent is recognized
+        self.embeddings = get_embedding_model(INTENT_EMBEDDING_MODEL)
+        self.INTENT_MAP = dict(INTENT_MAP)
 
-        # Define user intents and associated reference phrases
-        self.INTENT_MAP = {
-            "seeking_information": "I need information about...",
-            "requesting_help": "Can you help me with...",
-            "expressing_discontent": "I'm unhappy about...",
-            "requesting_clarity": "Can you clarify...",
-            "general_query": "Tell me about...",
-        }
+        self._classifier = None
 
-        # Precompute the intent vectors
-        self.intent_vectors = self._vectorize_intents()
+    @property
+    def classifier(self):
+        """
+        The intent prototypes, computed on first use.
+        """
+        if self._classifier is None:
+            self._classifier = PrototypeClassifier(self.INTENT_MAP.keys(), self._vectorize_intents())
+        return self._classifier
 
     def _vectorize_intents(self):
         """
-        Generate vector representations for each intent based on reference phrases.
+        Read vector representations for each intent's reference phrase from the reference vector cache.
         """
-        intent_vectors = {}
-        for intent, phrase in self.INTENT_MAP.items():
-            inputs = self.tokenizer(phrase, return_tensors="pt")
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                # Use the mean of the last hidden state as the vector representation
-                vector = outputs.last_hidden_state.mean(dim=1).numpy()
-                intent_vectors[intent] = vector
-
-        return intent_vectors
+        return load_reference_vectors(self.embeddings, self.INTENT_MAP.values())
 
     def recognize_intent(self, user_input):
         """
         Analyze the user input, convert it to a vector, and determine the probable intent.
         """
-        # Convert user input to vector
-        user_vector = self._vectorize_input(user_input)
-
-        # Calculate similarities with intent vectors
-        similarities = {
-            intent: self.cosine_similarity(user_vector, vector)
-            for intent, vector in self.intent_vectors.items()
-        }
+        # Convert user input to vector and pick the intent with the highest similarity
+        return self.classifier.classify(self._vectorize_input(user_input))[0]
 
-        # Identify the intent with the highest similarity score
-        max_intent = max(similarities, key=similarities.get)
-        return max_intent
-
-    def _vectorize_input(self, user_input):
+    def recognize_intents(self, user_inputs, k=1):
         """
-        Convert user input to a vector representation.
+        Score many inputs at once, returning the k best (intent, similarity) pairs for each.
         """
-        inputs = self.tokenizer(user_input, return_tensors="pt")
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            vector = outputs.last_hidden_state.mean(dim=1).numpy()
-        return vector
+        if not user_inputs:
+            return []
+        return self.classifier.top_k(self.embeddings.embed(list(user_inputs)), k)
 
-    def cosine_similarity(self, vec_a, vec_b):
+    def _vectorize_input(self, user_input):
         """
-        Calculate cosine similarity between two vectors.
+        Convert user input to a vector representation.
         """
-        return np.dot(vec_a, vec_b.T) / (np.linalg.norm(vec_a) * np.linalg.norm(vec_b))
\ No newline at end of file
+        return self.embeddings.embed_one(user_input)
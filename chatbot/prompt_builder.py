@@ -0,0 +1,194 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to an estimate when tiktoken is not installed
+    tiktoken = None
+
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and separators the API adds around every message
+TRUNCATION_MARKER = "\n[...truncated to fit the prompt budget]"
+ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]")
+TOKEN_CACHE_SIZE = 65536  # Token counts cached per kind of key
+TOKEN_CACHE_KEY_CHARS = 256  # Longer texts are cached under their digest rather than kept as keys
+_long_counts = OrderedDict()  # (digest, model) -> token count, least recently used first
+_long_counts_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-4o-mini"):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model="gpt-4o-mini"):
+    """Count the tokens in a piece of text with the local tokenizer for the model.
+
+    Counts are cached; long texts under a digest of their contents, so the cache never keeps
+    whole prompts, directory trees or world states alive.
+    """
+    if len(text) <= TOKEN_CACHE_KEY_CHARS:
+        return count_short_tokens(text, model)
+    key = (hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest(), model)
+    with _long_counts_lock:
+        count = _long_counts.get(key)
+        if count is not None:
+            _long_counts.move_to_end(key)
+            return count
+    count = encode_count(text, model)
+    with _long_counts_lock:
+        _long_counts[key] = count
+        if len(_long_counts) > TOKEN_CACHE_SIZE:
+            _long_counts.popitem(last=False)
+    return count
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def count_short_tokens(text, model):
+    return encode_count(text, model)
+
+
+def encode_count(text, model):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(ESTIMATE_PATTERN.findall(text))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model="gpt-4o-mini"):
+    """Keep the beginning of a text so that it fits in max_tokens."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    max_tokens = max(1, max_tokens - count_tokens(TRUNCATION_MARKER, model))
+    encoding = get_encoding(model)
+    if encoding is None:
+        words = list(ESTIMATE_PATTERN.finditer(text))
+        return text[:words[max_tokens - 1].end()] + TRUNCATION_MARKER
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]) + TRUNCATION_MARKER
+
+
+def message_tokens(message, model="gpt-4o-mini"):
+    return count_tokens(str(message.get('content') or ''), model) + MESSAGE_OVERHEAD_TOKENS
+
+
+class PromptSection:
+    """A group of messages that is trimmed as a unit.
+
+    `trim` is either 'drop_oldest', which removes whole messages from the front and leaves a
+    note saying how many were omitted, or 'truncate', which shortens message contents. Dropping
+    happens in multiples of `drop_granularity` messages so that the start of the section, and with
+    it the prompt prefix, only moves every few turns.
+    """
+
+    def __init__(self, name, messages, priority, budget=None, trim='truncate', drop_granularity=1):
+        self.name = name
+        self.messages = list(messages)
+        self.priority = priority
+        self.budget = budget
+        self.trim = trim
+        self.drop_granularity = drop_granularity
+        self.original_tokens = None
+        self.omitted = 0  # Messages dropped by 'drop_oldest', announced by a note at the front
+
+    def tokens(self, model):
+        return sum(message_tokens(message, model) for message in self.messages)
+
+    def trim_to(self, max_tokens, model):
+        if self.tokens(model) <= max_tokens:
+            return
+        if self.trim == 'drop_oldest':
+            self._drop_oldest(max_tokens, model)
+        else:
+            self._truncate(max_tokens, model)
+
+    def _drop_oldest(self, max_tokens, model):
+        messages = self.messages[1:] if self.omitted else self.messages
+        kept = []
+        used = message_tokens(self._omitted_note(self.omitted + len(messages)), model)
+        for message in reversed(messages):
+            cost = message_tokens(message, model)
+            if used + cost > max_tokens:
+                break
+            kept.append(message)
+            used += cost
+        kept.reverse()
+        omitted = len(messages) - len(kept)
+        drop_more = min(-(self.omitted + omitted) % self.drop_granularity, len(kept))
+        kept = kept[drop_more:]
+        self.omitted += omitted + drop_more
+        note_fits = message_tokens(self._omitted_note(self.omitted), model) <= max_tokens
+        self.messages = ([self._omitted_note(self.omitted)] if self.omitted and note_fits else []) + kept
+
+    def _truncate(self, max_tokens, model):
+        remaining = max_tokens
+        messages = []
+        for message in self.messages:
+            available = remaining - MESSAGE_OVERHEAD_TOKENS
+            if available <= 0:
+                break
+            content = truncate_to_tokens(str(message.get('content') or ''), available, model)
+            messages.append({**message, 'content': content})
+            remaining -= message_tokens(messages[-1], model)
+        self.messages = messages
+
+    def _omitted_note(self, count):
+        return {"role": "system", "content": f"[{count} earlier messages omitted to fit the prompt budget]"}
+
+
+class PromptBuilder:
+    """Assemble prompt sections in order while keeping the total under a token limit.
+
+    Each section is first cut to its own budget. If the prompt is still over the limit the
+    lowest-priority sections give up tokens first.
+    """
+
+    def __init__(self, max_tokens, model="gpt-4o-mini"):
+        self.max_tokens = max_tokens
+        self.model = model
+        self.sections = []
+
+    def add_section(self, name, messages, priority, budget=None, trim='truncate', drop_granularity=1):
+        self.sections.append(PromptSection(name, messages, priority, budget, trim, drop_granularity))
+        return self
+
+    def build(self):
+        for section in self.sections:
+            section.original_tokens = section.tokens(self.model)
+            if section.budget is not None:
+                section.trim_to(section.budget, self.model)
+
+        overflow = self.total_tokens() - self.max_tokens
+        for section in sorted(self.sections, key=lambda s: s.priority):
+            if overflow <= 0:
+                break
+            before = section.tokens(self.model)
+            section.trim_to(max(0, before - overflow), self.model)
+            overflow -= before - section.tokens(self.model)
+
+        return [message for section in self.sections for message in section.messages]
+
+    def total_tokens(self):
+        return sum(section.tokens(self.model) for section in self.sections)
+
+    def token_counts(self):
+        """Per-section token counts before and after trimming."""
+        counts = {
+            section.name: {
+                'tokens': section.tokens(self.model),
+                'original_tokens': section.original_tokens,
+                'budget': section.budget,
+                'priority': section.priority,
+            }
+            for section in self.sections
+        }
+        counts['total'] = {'tokens': self.total_tokens(), 'limit': self.max_tokens}
+        return counts
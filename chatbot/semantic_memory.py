@@ -0,0 +1,205 @@
+import glob
+import hashlib
+import json
+import os
+import queue
+import threading
+from urllib.parse import quote
+
+from utils import serializer
+from utils.embedding_service import get_embedding_model
+from utils.persistence import file_lock, write_atomic
+from utils.vector_index import VectorIndex
+
+MEMORY_EMBEDDING_MODEL = "bert-base-uncased"
+MEMORY_DIRECTORY = os.getenv("MEMORY_INDEX_DIR", "memory_index")
+MEMORY_PRECISION = os.getenv("MEMORY_PRECISION", "fp32")  # 'fp32' or 'int8' for new indexes
+MEMORY_IVF_THRESHOLD = 200000  # Turns in one user's index before it is clustered for approximate search
+MEMORY_RESULTS = 5  # Old turns retrieved into each prompt
+ARCHIVE_PATTERNS = (os.path.join('logs', '*.json'), 'logs\\log_*.json')  # Histories set aside by summarize_history
+INDEX_BATCH_SIZE = 256
+
+
+class SemanticMemory:
+    """Per-user vector index over past interactions, for retrieving relevant old turns.
+
+    Every new interaction is embedded in the background through a ChatHistory listener and
+    appended to the user's VectorIndex under `directory`. Histories from before the index
+    existed are indexed the first time a user is searched, and the `logs/` archives once at
+    startup. Indexes that grow past `ivf_threshold` turns are clustered so searches stay fast.
+    """
+
+    def __init__(self, chat_history, directory=MEMORY_DIRECTORY, precision=MEMORY_PRECISION,
+                 ivf_threshold=MEMORY_IVF_THRESHOLD, archive_patterns=ARCHIVE_PATTERNS):
+        self.chat_history = chat_history
+        self.directory = directory
+        self.precision = precision
+        self.ivf_threshold = ivf_threshold
+        self.embeddings = get_embedding_model(MEMORY_EMBEDDING_MODEL)
+        self.indexes = {}
+        self.backfilled = set()  # Users whose stored history was checked for turns missing from the index
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run, name="semantic-memory", daemon=True)
+        self.worker.start()
+        chat_history.add_listener(self.on_interaction)
+        if archive_patterns:
+            self.queue.put(('archives', archive_patterns))
+
+    def get_index(self, user_id):
+        with self.lock:
+            index = self.indexes.get(user_id)
+            if index is None:
+                index = self.indexes[user_id] = VectorIndex(
+                    os.path.join(self.directory, quote(str(user_id), safe='')), self.precision)
+            return index
+
+    def on_interaction(self, user_id, interaction):
+        """ChatHistory listener: queue the new interaction for indexing."""
+        if interaction.get('request'):
+            self.queue.put(('interaction', (user_id, interaction)))
+
+    def search(self, user_id, text, k=MEMORY_RESULTS, exclude=()):
+        """The k stored turns most similar to the text as (score, entry) pairs, best first.
+
+        Turns whose key is in `exclude` (such as the ones already in the prompt) are skipped,
+        as are duplicates of a turn indexed twice.
+        """
+        self.backfill(user_id)
+        index = self.get_index(user_id)
+        exclude = set(exclude)
+        if len(index) <= len(exclude):
+            return []  # Nothing beyond the excluded turns, skip embedding the text
+        results = []
+        for score, entry in index.search(self.embeddings.embed_one(text), k + len(exclude)):
+            if entry['key'] not in exclude:
+                exclude.add(entry['key'])
+                results.append((score, entry))
+        return results[:k]
+
+    def get_memory_messages(self, user_id, request, chat_history, start, k=MEMORY_RESULTS):
+        """System messages with the k turns most relevant to the request from before `start`."""
+        recent = {interaction_key(interaction) for interaction in chat_history[start:] if interaction.get('request')}
+        return [{"role": "system",
+                 "content": f"Relevant earlier exchange ({entry['time']}):\nUser: {entry['request']}\n"
+                            f"Assistant: {entry['response']}"}
+                for _, entry in self.search(user_id, request, k, recent)]
+
+    def backfill(self, user_id):
+        """Queue indexing of the user's stored history the first time they are searched."""
+        with self.lock:
+            if user_id in self.backfilled:
+                return
+            self.backfilled.add(user_id)
+        self.queue.put(('history', user_id))
+
+    def flush(self):
+        """Block until every queued interaction is indexed."""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            jobs = [self.queue.get()]
+            while len(jobs) < INDEX_BATCH_SIZE:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                # Interactions queued meanwhile are embedded in one batch per user
+                users = {}
+                for job, argument in jobs:
+                    if job == 'interaction':
+                        users.setdefault(argument[0], []).append(argument[1])
+                for user_id, interactions in users.items():
+                    self.index_interactions(user_id, interactions)
+                for job, argument in jobs:
+                    if job == 'history':
+                        self.index_history(argument)
+                    elif job == 'archives':
+                        self.index_archives(argument)
+            except Exception as e:
+                print(f"Error indexing semantic memory: {str(e)}")
+            finally:
+                for _ in jobs:
+                    self.queue.task_done()
+
+    def index_interactions(self, user_id, interactions):
+        index = self.get_index(user_id)
+        interactions = [interaction for interaction in interactions if interaction.get('request')]
+        for start in range(0, len(interactions), INDEX_BATCH_SIZE):
+            batch = interactions[start:start + INDEX_BATCH_SIZE]
+            index.add(self.embeddings.embed([interaction_text(interaction) for interaction in batch]),
+                      [memory_entry(interaction) for interaction in batch])
+        if len(index) >= self.ivf_threshold and index.unclustered_rows() >= max(1000, len(index) // 10):
+            index.build_ivf()
+
+    def index_history(self, user_id):
+        """Index the turns of the stored history that are not in the index yet."""
+        interactions = [interaction for interaction in self.chat_history.get_history(user_id)
+                        if interaction.get('request')]
+        index = self.get_index(user_id)
+        if len(index) >= len(interactions):
+            return  # Every turn arrived through the listener
+        indexed = indexed_keys(index)
+        self.index_interactions(user_id, [interaction for interaction in interactions
+                                          if interaction_key(interaction) not in indexed])
+
+    def index_archives(self, patterns):
+        """Index the interactions of archived histories, each archive once."""
+        manifest_path = os.path.join(self.directory, 'archives.json')
+        with file_lock(manifest_path):  # One worker process imports a given archive
+            try:
+                with open(manifest_path, encoding='utf-8') as file:
+                    imported = set(serializer.loads(file.read()))
+            except (FileNotFoundError, json.JSONDecodeError):
+                imported = set()
+            paths = sorted({path for pattern in patterns for path in glob.glob(pattern)} - imported)
+            for path in paths:
+                try:
+                    with open(path) as file:
+                        archive = json.load(file)
+                except (OSError, json.JSONDecodeError) as e:
+                    print(f"Error reading archive {path}: {str(e)}")
+                    continue
+                users = {}
+                for interaction in archive if isinstance(archive, list) else []:
+                    if isinstance(interaction, dict) and interaction.get('request') and 'user_id' in interaction:
+                        users.setdefault(interaction['user_id'], []).append(interaction)
+                for user_id, interactions in users.items():
+                    self.index_interactions(user_id, interactions)
+                imported.add(path)
+                write_atomic(manifest_path, serializer.dumps(sorted(imported)))
+
+
+def interaction_text(interaction):
+    return f"{interaction.get('request', '')}\n{interaction.get('response', '')}"
+
+
+def interaction_key(interaction):
+    """Identifies a turn across the live history and the archives."""
+    payload = json.dumps([interaction.get('time'), str(interaction.get('request')), str(interaction.get('response'))])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def memory_entry(interaction):
+    return {
+        'key': interaction_key(interaction),
+        'time': interaction.get('time', ''),
+        'request': str(interaction.get('request', '')),
+        'response': str(interaction.get('response', '')),
+    }
+
+
+def indexed_keys(index):
+    keys = set()
+    try:
+        with open(index.path('entries.jsonl'), 'rb') as file:
+            for line in file:
+                try:
+                    keys.add(serializer.loads(line)['key'])
+                except (ValueError, KeyError):
+                    pass  # Entry of an interrupted add
+    except FileNotFoundError:
+        pass
+    return keys
@@ -1,16 +1,31 @@
+import argparse
 import os
 
 from dotenv import load_dotenv
 from chatbot.ethical_ai_chatbot import EthicalAIChatbot
+from utils.completion_cache import get_completion_cache
+from utils.event_loop import run_async
+from utils.reference_vectors import prebuild_reference_vectors
+from utils.serializer import pretty_file
 from flask import Flask, jsonify, request
-from threading import Thread
+from threading import Lock, Thread
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Create Flask app
 app = Flask(__name__)
-bot = EthicalAIChatbot(name="Eleanor")
+_bot = None
+_bot_lock = Lock()
+
+
+def get_bot():
+    """The chatbot, built on first use so the offline subcommands do not start its models and threads."""
+    global _bot
+    with _bot_lock:
+        if _bot is None:
+            _bot = EthicalAIChatbot(name="Eleanor")
+        return _bot
 
 @app.route('/')
 def index():
@@ -22,36 +37,94 @@ def chat():
     """Handle user input and return chatbot response."""
     user_id = request.json.get('user_id')
     message = request.json.get('message')
-    bot.handle_request(user_id, message)
-    response = bot.chat_history.get_history(user_id)[-1]['response']
+    response = run_async(get_bot().handle_request_async(user_id, message))
     return jsonify({'response': response})
 
 @app.route('/world_state', methods=['GET'])
 def get_world_state():
-    """Return the current world state."""
-    state = bot.world_states[0].state  # Assuming you’re interested in the first world state
-    return jsonify(state)
+    """Return the user's world states, by file name."""
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'error': "user_id is required"}), 400
+    return jsonify({world_state.file_name: world_state.get_state(user_id) for world_state in get_bot().world_states})
 
 @app.route('/chat_history', methods=['GET'])
 def chat_history():
     """Return the user's chat history."""
     user_id = request.args.get('user_id')
-    history = bot.chat_history.format_chat_history(user_id)  # Adjust this call as per your chat history structure
+    history = get_bot().chat_history.format_chat_history(user_id)  # Adjust this call as per your chat history structure
     return jsonify(history)
 
 @app.route('/files', methods=['GET'])
 def get_files():
     """Return the current files in the user directory."""
     user_directory = '.'  # You can specify a different directory if needed
-    directory_tree = bot.file_system_agent.get_directory_tree(user_directory, full=True)
+    directory_tree = get_bot().file_system_agent.get_directory_tree(user_directory, full=True)
     return jsonify(directory_tree)
 
 def run_flask_app():
     """Run the Flask app."""
     app.run(debug=True)
 
+def prebuild_embeddings(args):
+    """Embed every reference phrase set into the on-disk cache so later starts only map it in."""
+    for path in prebuild_reference_vectors(args.cache_dir, force=args.force):
+        print(path)
+
+
+def show_cache_stats(args):
+    """Print the size of the completion cache and the hits its entries have served."""
+    cache = get_completion_cache()
+    if cache is None:
+        print("The completion cache is disabled; set COMPLETION_CACHE to the path of its store.")
+        return
+    stats = cache.stats()
+    print(f"{stats['entries']} cached completions, {stats['stored_hits']} hits served, "
+          f"{stats['stored_saved_prompt_tokens']} prompt and {stats['stored_saved_completion_tokens']} "
+          f"completion tokens saved")
+
+
+def pretty_print_json(args):
+    """Indent stored JSON and JSON-lines files for reading; the bot writes them compact."""
+    for path in args.files:
+        if not args.output_dir:
+            print(pretty_file(path), end='')
+            continue
+        os.makedirs(args.output_dir, exist_ok=True)
+        output = os.path.join(args.output_dir, os.path.basename(path))
+        with open(output, 'w', encoding='utf-8') as file:
+            file.write(pretty_file(path))
+        print(output)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ethical AI chatbot command line interface.")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('chat', help="chat with the bot in the terminal (default)")
+    prebuild = commands.add_parser('prebuild-embeddings', help="build the reference vector cache")
+    prebuild.add_argument('--cache-dir', default=None, help="cache directory (default: EMBEDDING_CACHE_DIR)")
+    prebuild.add_argument('--force', action='store_true', help="rebuild entries that already exist")
+    commands.add_parser('cache-stats', help="show the completion cache size and hits")
+    pretty = commands.add_parser('pretty-json', help="indent stored JSON or JSON-lines files")
+    pretty.add_argument('files', nargs='+')
+    pretty.add_argument('--output-dir', default=None, help="write indented copies here instead of printing them")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'prebuild-embeddings':
+        prebuild_embeddings(args)
+        raise SystemExit(0)
+    if args.command == 'cache-stats':
+        show_cache_stats(args)
+        raise SystemExit(0)
+    if args.command == 'pretty-json':
+        pretty_print_json(args)
+        raise SystemExit(0)
+
     api_key = os.getenv("OPENAI_API_KEY")  # Ensure you're loading from the environment variable
+    bot = get_bot()
     bot.start_session("hallie")
     # Start Flask app in a separate thread
     #thread = Thread(target=run_flask_app)
@@ -64,4 +137,6 @@ if __name__ == "__main__":
         if user_input.lower() == "exit":
             bot.end_session("hallie")
             break
-        bot.handle_request("hallie", user_input)
\ No newline at end of file
+        for i, delta in enumerate(bot.handle_request_stream("hallie", user_input)):
+            print(f"{bot.name}: " + delta if i == 0 else delta, end='', flush=True)
+        print()
\ No newline at end of file
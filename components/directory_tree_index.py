@@ -0,0 +1,138 @@
+import os
+import threading
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog is optional; without it every refresh is a stat-only rescan
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class DirectoryTreeIndex:
+    """Persistent snapshot of a directory tree that is refreshed incrementally.
+
+    Files are keyed by (mtime, size, inode). A refresh walks the tree with os.scandir and
+    only calls back into `build_metadata` / `read_content` for files whose key changed, so a
+    warm refresh costs one stat per file. When watchdog is installed the index subscribes to
+    filesystem events and skips the walk entirely until something changes.
+    """
+
+    def __init__(self, root, should_skip, build_metadata, read_content, watch=True):
+        self.root = root
+        self.should_skip = should_skip
+        self.build_metadata = build_metadata
+        self.read_content = read_content
+        self.files = {}  # path -> {'key', 'metadata', 'content', 'content_loaded'}
+        self.paths = set()  # Every file and directory seen by the last scan
+        self.metadata_generation = 0
+        self.tree = None
+        self.tree_full = False
+        self.version = 0
+        self.dirty = True
+        self.lock = threading.RLock()
+        self.observer = None
+        if watch:
+            self.start_watching()
+
+    def start_watching(self):
+        """Subscribe to filesystem events when an inotify-backed watcher is available."""
+        if Observer is None or self.observer is not None:
+            return False
+        try:
+            observer = Observer()
+            observer.schedule(_DirtyFlagHandler(self), self.root, recursive=True)
+            observer.daemon = True
+            observer.start()
+        except Exception as e:
+            print(f"Could not watch {self.root}, falling back to rescans: {e}")
+            return False
+        self.observer = observer
+        return True
+
+    def stop_watching(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer = None
+        self.dirty = True
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def invalidate_metadata(self):
+        """Rebuild the metadata of every file on the next refresh, keeping content that did not change."""
+        self.metadata_generation += 1
+        self.dirty = True
+
+    def get_tree(self, full=False):
+        """Return the cached tree, rescanning only when it may be out of date."""
+        with self.lock:
+            watching = self.observer is not None
+            if self.tree is not None and watching and not self.dirty and (self.tree_full or not full):
+                return self.tree
+            self.dirty = False
+            seen = set()
+            tree, changed = self._scan(self.root, full, seen)
+            for path in self.files.keys() - seen:
+                del self.files[path]
+            if changed or seen != self.paths or self.tree is None or full != self.tree_full:
+                self.tree = tree
+                self.version += 1
+            self.paths = seen
+            self.tree_full = full
+            return self.tree
+
+    def _scan(self, path, full, seen):
+        """Stat every entry under `path`, re-reading only files whose key changed."""
+        tree = {}
+        changed = False
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if self.should_skip(entry.name):
+                    continue
+                if entry.is_dir():
+                    seen.add(entry.path)
+                    tree[entry.name], subtree_changed = self._scan(entry.path, full, seen)
+                    changed = changed or subtree_changed
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Removed between listing and stat
+                seen.add(entry.path)
+                key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                cached = self.files.get(entry.path)
+                if cached is None or cached['key'] != key:
+                    cached = {
+                        'key': key,
+                        'metadata': self.build_metadata(entry.path, stat),
+                        'generation': self.metadata_generation,
+                        'content': None,
+                        'content_loaded': False,
+                    }
+                    self.files[entry.path] = cached
+                    changed = True
+                elif cached['generation'] != self.metadata_generation:
+                    cached['metadata'] = self.build_metadata(entry.path, stat)
+                    cached['generation'] = self.metadata_generation
+                    changed = True
+                else:
+                    cached['metadata']['from_cache'] = True
+                if full and not cached['content_loaded']:
+                    cached['content'] = self.read_content(entry.path, cached['metadata'], full)
+                    cached['content_loaded'] = True
+                    changed = True
+                tree[entry.name] = {
+                    'content': cached['content'] if full else None,
+                    'metadata': cached['metadata'],
+                }
+        return tree, changed
+
+
+class _DirtyFlagHandler(FileSystemEventHandler):
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def on_any_event(self, event):
+        self.index.mark_dirty()
@@ -3,15 +3,21 @@ import fnmatch
 import json
 import os
 import subprocess
+import time
 import weakref
 from datetime import datetime
 
+from components.directory_tree_index import DirectoryTreeIndex
+from components.git_metadata import GitMetadataIndex
+from utils.persistence import get_writer
+
 
 class FileSystemComponent:
     def __init__(self, openai, config_path='./config/fsc_config.json'):
         self.openai = openai
-        self.metadata_cache = {}
-        self.content_cache = {}
+        self.tree_indexes = {}  # absolute root path -> DirectoryTreeIndex
+        self.git_metadata = GitMetadataIndex()
+        self.tree_build_stats = {}  # Wall time and git subprocess count of the last tree build
         self.config_path = config_path
         self.settings = self.load_json(config_path) or {
             'cwd' : './sandbox'
@@ -22,7 +28,7 @@ class FileSystemComponent:
 
 
     def save_settings(self):
-        self.write_file(self.config_path, json.dumps(self.settings, indent=2))
+        get_writer().write_json(self.config_path, self.settings, pretty=True)
 
     def load_json(self, path):
         """Load previously saved variables from a file, if available."""
@@ -67,58 +73,60 @@ class FileSystemComponent:
         return self.get_directory_tree(self.working_directory, full)
 
     def get_directory_tree(self, path=".", full=False):
-        """Recursively get the directory tree starting from the given path."""
-        directory_tree = {}
-        for item in os.listdir(path):
-            item_path = os.path.join(path, item)
-            if self.is_hidden(item) or self.is_ignored(item):
-                continue
-            if os.path.isdir(item_path):
-                directory_tree[item] = self.get_directory_tree(item_path, full)
-            else:
-                metadata = self.get_file_metadata(item_path)  # Get metadata
-                directory_tree[item] = {
-                    'content': self.process_file(item_path, metadata, full),
-                    'metadata': metadata  # Include metadata in the return
-                }
-        return directory_tree
+        """Get the directory tree starting from the given path, re-reading only files that changed."""
+        start = time.perf_counter()
+        subprocesses_before = self.git_metadata.subprocess_count
+        index = self.get_tree_index(path)
+        if self.git_metadata.refresh():
+            for tree_index in self.tree_indexes.values():
+                tree_index.invalidate_metadata()
+        tree = index.get_tree(full)
+        self.tree_build_stats = {
+            'path': path,
+            'wall_time': time.perf_counter() - start,
+            'subprocess_count': self.git_metadata.subprocess_count - subprocesses_before,
+            'file_count': len(index.files),
+            'version': index.version,
+        }
+        return tree
+
+    def get_tree_index(self, path="."):
+        """Return the persistent tree index for a root path, creating it on first use."""
+        key = os.path.abspath(path)
+        index = self.tree_indexes.get(key)
+        if index is None:
+            index = DirectoryTreeIndex(path, self.should_skip, self.build_file_metadata, self.process_file)
+            self.tree_indexes[key] = index
+        return index
 
     def get_file_metadata(self, file_path):
         """Retrieve metadata for the specified file."""
         try:
-            cached = self.metadata_cache.get(file_path)
-            modified_time =os.path.getmtime(file_path)
-
-            if cached and modified_time <= cached["modified_time"]:
-                cached["from_cache"] = True
-                return cached
-
-            file_info = {
-                'size': os.path.getsize(file_path),  # Size in bytes
-                'git': self.get_git_history(file_path),
-                'modified_time': modified_time,  # Last modified time
-                'created_time': os.path.getctime(file_path),  # Creation time
-                'extension': os.path.splitext(file_path)[1],  # File extension
-                'is_hidden': file_path.startswith('.'),  # Check if the file is hidden
-                'modified_time_iso': datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat(),  # ISO format
-                'created_time_iso': datetime.fromtimestamp(os.path.getctime(file_path)).isoformat(),  # ISO format
-                'from_cache': False,
-            }
-            self.metadata_cache[file_path] = file_info
-            return file_info
+            return self.build_file_metadata(file_path, os.stat(file_path))
         except Exception as e:
             print(f"Error retrieving metadata for {file_path}: {e}")
             return {}
 
+    def build_file_metadata(self, file_path, stat):
+        """Build the metadata for a file from an existing stat result."""
+        return {
+            'size': stat.st_size,  # Size in bytes
+            'git': self.get_git_history(file_path),
+            'modified_time': stat.st_mtime,  # Last modified time
+            'created_time': stat.st_ctime,  # Creation time
+            'extension': os.path.splitext(file_path)[1],  # File extension
+            'is_hidden': file_path.startswith('.'),  # Check if the file is hidden
+            'modified_time_iso': datetime.fromtimestamp(stat.st_mtime).isoformat(),  # ISO format
+            'created_time_iso': datetime.fromtimestamp(stat.st_ctime).isoformat(),  # ISO format
+            'from_cache': False,
+        }
+
     def process_file(self, file_path, metadata, full=False):
         """Process each file: check extension, size, convert to text, and compress."""
-        if metadata['from_cache'] and file_path in self.content_cache:
-            return self.content_cache[file_path]
-
-        if full and os.path.isfile(file_path) and file_path.endswith((
+        if full and file_path.endswith((
                 '.py', '.html', '.md', '.txt', '.css', '.gitignore',
                 '.ts', '.tsx'
-        )) and os.path.getsize(file_path) < 1 * 1024 * 1024:
+        )) and metadata.get('size', 0) < 1 * 1024 * 1024:
             try:
                 with open(file_path, 'r', encoding='utf-8') as file:
                     content = file.read()
@@ -168,6 +176,10 @@ class FileSystemComponent:
                 patterns = [line.strip() for line in f if line.strip() and not line.startswith('#')]
         return patterns
 
+    def should_skip(self, filename):
+        """Check if a directory entry is left out of the tree."""
+        return self.is_hidden(filename) or self.is_ignored(filename)
+
     def is_hidden(self, filename):
         """Check if a file is hidden (starts with a dot)."""
         return filename.startswith('.')
@@ -191,21 +203,8 @@ class FileSystemComponent:
         return ''.join(diff)
 
     def get_git_history(self, file_path):
-        """Fetch a summary of git history for a specified file."""
-        print("getting git history for", file_path)
-        try:
-            # Run the git log command and capture the output
-            result = subprocess.run(
-                ['git', 'log', '--oneline', file_path],
-                capture_output=True,
-                text=True,
-                check=True,
-                cwd=self.working_directory
-            )
-            return result.stdout.strip()  # Stripping to remove any trailing spaces
-        except subprocess.CalledProcessError as e:
-            print(f"Error fetching git history: {e}")
-            return "No git history found."
+        """Fetch a summary of git history for a specified file from the repository-wide index."""
+        return self.git_metadata.history(file_path)
 
     def execute_command(self, command):
         """Executes a given command in the Windows shell and returns the output."""
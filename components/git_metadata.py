@@ -0,0 +1,141 @@
+import os
+import subprocess
+
+NO_GIT_HISTORY = "No git history found."
+
+
+class GitMetadataIndex:
+    """Per-file `git log --oneline` summaries for whole repositories, built from one git process each.
+
+    Repositories are found by looking for `.git` in parent directories, so no process is spawned
+    to locate them. The history of a repository is rebuilt only when its HEAD or index changes.
+    """
+
+    def __init__(self):
+        self.repositories = {}  # toplevel -> GitRepositoryHistory
+        self.directory_toplevels = {}  # directory -> toplevel, or None outside a repository
+        self.subprocess_count = 0
+
+    def history(self, file_path):
+        """Return the `git log --oneline` summary for a file."""
+        path = os.path.abspath(file_path)
+        toplevel = self.find_toplevel(os.path.dirname(path))
+        if toplevel is None:
+            return NO_GIT_HISTORY
+        repository = self.repositories.get(toplevel)
+        if repository is None:
+            repository = GitRepositoryHistory(toplevel, self)
+            self.repositories[toplevel] = repository
+        return repository.history(os.path.relpath(path, toplevel))
+
+    def refresh(self):
+        """Drop the history of repositories whose HEAD or index changed. Returns True if any did."""
+        changed = False
+        for repository in self.repositories.values():
+            changed = repository.refresh() or changed
+        return changed
+
+    def find_toplevel(self, directory):
+        if directory in self.directory_toplevels:
+            return self.directory_toplevels[directory]
+        if os.path.exists(os.path.join(directory, '.git')):
+            toplevel = directory
+        else:
+            parent = os.path.dirname(directory)
+            toplevel = None if parent == directory else self.find_toplevel(parent)
+        self.directory_toplevels[directory] = toplevel
+        return toplevel
+
+    def run(self, args, cwd):
+        """Run a git command, counting it towards the subprocess total."""
+        self.subprocess_count += 1
+        return subprocess.run(['git', *args], capture_output=True, text=True, check=True, cwd=cwd,
+                              encoding='utf-8', errors='replace')
+
+
+class GitRepositoryHistory:
+    """History of every file in one repository, parsed from a single `git log --name-only` stream."""
+
+    def __init__(self, toplevel, git_index):
+        self.toplevel = toplevel
+        self.git_index = git_index
+        self.git_dir, self.common_dir = self.resolve_git_dirs()
+        self.files = None  # relative path -> ["<hash> <subject>", ...]
+        self.failed = False
+        self.state_key = None
+
+    def history(self, relative_path):
+        if self.files is None:
+            self.build()
+        if self.failed:
+            return NO_GIT_HISTORY
+        return "\n".join(self.files.get(relative_path.replace(os.sep, '/'), []))
+
+    def refresh(self):
+        if self.files is not None and self.read_state_key() != self.state_key:
+            self.files = None
+            return True
+        return False
+
+    def build(self):
+        self.state_key = self.read_state_key()
+        self.files = {}
+        self.failed = False
+        try:
+            result = self.git_index.run(
+                ['-c', 'core.quotePath=false', 'log', '--name-only', '--format=%x00%h %s'],
+                cwd=self.toplevel)
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"Error fetching git history: {e}")
+            self.failed = True
+            return
+        files = {}
+        commit = None
+        for line in result.stdout.splitlines():
+            if line.startswith('\x00'):
+                commit = line[1:]
+            elif line and commit is not None:
+                files.setdefault(line, []).append(commit)
+        self.files = files
+
+    def resolve_git_dirs(self):
+        """Locate the git directory, following the `gitdir:` pointer used by worktrees and submodules."""
+        git_dir = os.path.join(self.toplevel, '.git')
+        if os.path.isfile(git_dir):
+            with open(git_dir, 'r') as file:
+                pointer = file.read().strip()
+            if pointer.startswith('gitdir:'):
+                git_dir = os.path.normpath(os.path.join(self.toplevel, pointer[len('gitdir:'):].strip()))
+        common_dir = git_dir
+        commondir_file = os.path.join(git_dir, 'commondir')
+        if os.path.isfile(commondir_file):
+            with open(commondir_file, 'r') as file:
+                common_dir = os.path.normpath(os.path.join(git_dir, file.read().strip()))
+        return git_dir, common_dir
+
+    def read_state_key(self):
+        """Describe HEAD and the index by reading git's files directly instead of running git."""
+        head = read_text(os.path.join(self.git_dir, 'HEAD'))
+        ref_value = None
+        if head and head.startswith('ref:'):
+            ref = head[len('ref:'):].strip()
+            ref_value = read_text(os.path.join(self.git_dir, ref)) or read_text(os.path.join(self.common_dir, ref))
+            if ref_value is None:
+                ref_value = stat_key(os.path.join(self.common_dir, 'packed-refs'))
+        return head, ref_value, stat_key(os.path.join(self.git_dir, 'index'))
+
+
+def read_text(path):
+    try:
+        with open(path, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def stat_key(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
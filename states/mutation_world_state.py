@@ -1,8 +1,30 @@
+import asyncio
+import atexit
 import json
+import os
+import threading
+import time
 import traceback
 
-import openai
+from collections import OrderedDict
 from datetime import datetime
+from urllib.parse import quote
+
+from utils.llm_gateway import get_gateway
+from states.state_digest import changed_lines, compact_json, state_digest
+from states.state_tree import MUTATION_SCHEMA, StateTree
+from states.world_state_journal import WorldStateJournal
+from utils.persistence import read_json
+from utils.token_scheduler import get_scheduler
+
+WORLD_STATE_LOADED_USERS = int(os.getenv("WORLD_STATE_LOADED_USERS", 1000))  # Per kind of world state
+WORLD_STATE_WRITE_BACK_SECONDS = 30  # How long a changed state may stay only in memory
+WORLD_STATE_SNAPSHOT_EVERY = 100  # Journal records between snapshots
+WORLD_STATE_SNAPSHOTS_KEPT = 3  # Older snapshots and their journals are deleted
+MUTATION_RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {'name': 'world_state_mutations', 'schema': MUTATION_SCHEMA},
+}
 
 MUTATION_TYPE_DEF = '''// Define the action type with specific string literals
 type Action = 'add' | 'remove' | 'update' | 'set' | '+' | '-';
@@ -39,135 +61,466 @@ const updateMutation: Mutation = {
     value: { text: "Great!" } // Can be any type here
 };'''
 
+class UserWorldState:
+    """One user's world state, loaded on demand, and the journal records not yet written back."""
+
+    def __init__(self, user_id, state, sequence=0, base=0, journal_length=0):
+        self.user_id = user_id
+        self._state = state
+        self.sequence = sequence  # Journal records applied to the state
+        self.base = base  # Sequence of the snapshot the journal on disk continues
+        self.journal_length = journal_length  # Records written to that journal
+        self.position = (0, 0)  # Journal position after this process's last read or write
+        self.pending = []  # Records applied but not yet written to the journal
+        self.lock = threading.RLock()  # Guards the state and the pending records
+        self.state_version = 0
+        self.prompt_message_cache = (None, None)  # (state version, prompt message)
+        self.updating = False
+        self.update_tokens = 0  # Tokens the running update has used so far
+        self.changed_paths = set()  # Paths changed since the last update
+        self.dirty_since = None  # monotonic time of the first change not yet written back
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = value
+        self.touch_state()
+
+    def touch_state(self):
+        """Record that the state changed so cached renderings of it are rebuilt."""
+        self.state_version += 1
+
+
 class MutationWorldState:
+    """A kind of world state (say, the topics being discussed) kept separately for every user.
+
+    Each user's state is kept in `states/<file stem>/<user>/` as periodic snapshots and a
+    journal of the records applied since (see `WorldStateJournal`); every change to the state
+    is a record, so `replay` can rebuild it as of any kept record. States are loaded on first
+    use from the last snapshot plus the journal tail, and at most `max_loaded_users` stay in
+    memory; the least recently used are evicted, after writing back their pending records.
+    Pending records are otherwise appended once they have been waiting for
+    `WORLD_STATE_WRITE_BACK_SECONDS`, on `flush` and at exit, and a snapshot is taken every
+    `WORLD_STATE_SNAPSHOT_EVERY` records.
+    """
+
     def __init__(self,
                  emotional_state_handler,
                  update_frequency=1,
                  tokens_per_second=1,
+                 priority=20,
                  update_size=100,
                  max_history_length=10,
                  file_name='world_state.json',
                  custom_instructions="",
-                 model_name='gpt-4o-mini'):
+                 model_name='gpt-4o-mini',
+                 emotion_tracker=None,
+                 max_loaded_users=WORLD_STATE_LOADED_USERS,
+                 structured_output=True,
+                 state_prompt='digest'):
         self.update_size = update_size
-        self.token_bank = 0
         self.max_history_length = max_history_length
         self.last_token_cost = self.update_size
         self.tokens_per_second = tokens_per_second
         self.emotional_state_handler = emotional_state_handler
+        self.emotion_tracker = emotion_tracker
         self.custom_instructions = custom_instructions
         self.model_name = model_name
         self.update_frequency = update_frequency
         self.interaction_count = 0
-        self.last_update = datetime.now()
-        self.state = {
+        self.structured_output = structured_output  # Ask for JSON matching MUTATION_SCHEMA
+        # 'digest': compact state in prompts, summarizing large values for updates; 'full': indented JSON
+        self.state_prompt = state_prompt
+        self.parse_counts = {'replies': 0, 'parse_failures': 0, 'truncated_replies': 0, 'recovered_mutations': 0,
+                             'invalid_mutations': 0, 'wasted_tokens': 0}
+        self.parse_counts_lock = threading.Lock()
+        self.file_name = file_name
+        self.directory = os.path.join('./states', os.path.splitext(file_name)[0])
+        self.journal = WorldStateJournal(self.directory, WORLD_STATE_SNAPSHOTS_KEPT)
+        self.max_loaded_users = max_loaded_users
+        self.users = OrderedDict()  # user_id -> UserWorldState, least recently used first
+        self.evicted = {}  # user_id -> evicted UserWorldState whose changes are not on disk yet
+        self.users_lock = threading.Lock()
+        # The bank refilled by tokens_per_second lives in the shared scheduler, under the call site name
+        self.call_site = f"world_state:{file_name}"
+        get_scheduler().register(self.call_site, priority, tokens_per_second)
+        atexit.register(self.flush)
+
+    def default_state(self):
+        return StateTree({
             'directory_tree': '',
-            'model': model_name,
-            'custom_instructions': custom_instructions,
+            'model': self.model_name,
+            'custom_instructions': self.custom_instructions,
             'ethic_update_interval': 10,
             'last_interaction_time': '',
             'user': {},
             'user_emotional_state': 'neutral',
             'world_description': '',
-        }
-        self.file_name = file_name
-        self.load_state()
-        self.load_mutations()
+        })
+
+    def legacy_state_path(self, user_id):
+        return os.path.join(self.directory, quote(str(user_id), safe='') + '.json')
+
+    def get_user(self, user_id):
+        """The user's world state, loaded from disk on first use."""
+        with self.users_lock:
+            user = self.users.get(user_id) or self.evicted.get(user_id)
+            if user is not None:
+                self.users[user_id] = user
+                self.users.move_to_end(user_id)
+                return user
+        loaded = self.load_user(user_id)
+        with self.users_lock:
+            user = self.users.setdefault(user_id, loaded)  # Another thread may have loaded it meanwhile
+            self.users.move_to_end(user_id)
+            evicted = self.evict()
+        self.write_evicted(evicted)
+        return user
+
+    def evict(self):
+        """Drop the least recently used users beyond `max_loaded_users`, returning the changed ones."""
+        evicted = []
+        for user_id in list(self.users):
+            if len(self.users) <= self.max_loaded_users:
+                break
+            user = self.users[user_id]
+            if user.updating:  # A running update still needs its state in memory
+                continue
+            del self.users[user_id]
+            if user.dirty_since is not None:
+                self.evicted[user_id] = user  # Served from memory until its write reaches the disk
+                evicted.append(user)
+        return evicted
+
+    def write_evicted(self, evicted):
+        for user in evicted:
+            self.save_state(user)
+        with self.users_lock:
+            for user in evicted:
+                if self.evicted.get(user.user_id) is user:
+                    del self.evicted[user.user_id]
 
-    def load_state(self):
+    def get_state(self, user_id):
+        """A copy of the user's world state."""
+        user = self.get_user(user_id)
+        with user.lock:
+            return json.loads(json.dumps(user.state))
+
+    def get_prompt_message(self, user_id):
+        """The system message describing the user's world state, re-serialized only when it changed."""
+        user = self.get_user(user_id)
+        with user.lock:
+            version, message = user.prompt_message_cache
+            if version != user.state_version:
+                state = compact_json(user.state) if self.state_prompt == 'digest' else json.dumps(user.state, indent=2)
+                message = {"role": "system", "content": self.custom_instructions + " " + state}
+                user.prompt_message_cache = (user.state_version, message)
+            return message
+
+    def load_user(self, user_id, sequence=None):
+        """The user's state rebuilt from the last snapshot (at or before `sequence`) and the journal after it."""
         try:
-            with open(f'./states/{self.file_name}', 'r') as file:
-                proposed_state = json.load(file)
-                for k, v in proposed_state.items():
-                    self.state[k] = v
-        except FileNotFoundError:
-            self.state = {}  # Initialize with empty or default state
+            state, base, records, position = self.journal.load(user_id, sequence)
         except json.JSONDecodeError:
-            print("Error: Could not parse world state.")
+            print(f"Error: Could not parse world state for {user_id}.")
+            state, base, records, position = None, 0, [], (0, 0)
+        user = UserWorldState(user_id, None)
+        self.rebuild(user, state, base, records)
+        user.position = position
+        return user
 
-    def save_state(self):
-        self.state = flatten_to_nested(self.state)
-        try:
-            with open(f'./states/{self.file_name}', 'w') as file:
-                json.dump(self.state, file, indent=2)
-        except Exception as e:
-            print(f"Error saving world state: {str(e)}")
-        self.save_mutations()
+    def rebuild(self, user, state, base, records):
+        """Set the user's state to a snapshot (or the initial state) and the journal records after it."""
+        user.state = self.initial_state(user.user_id) if state is None else StateTree(state)
+        user.sequence, user.base, user.journal_length = base, base, len(records)
+        for record in records:
+            self.apply_record(user, record)
+            user.sequence = record['seq']
 
-    def load_mutations(self):
+    def initial_state(self, user_id):
+        """The default state, updated from a state file written before the journal existed."""
+        state = self.default_state()
+        if not os.path.exists(self.legacy_state_path(user_id)):
+            return state  # A new user starts from the default state; checked first so no lock file is created
         try:
-            with open(f'./states/mut_{self.file_name}', 'r') as file:
-                self.mutations_list = json.load(file)
+            for k, v in read_json(self.legacy_state_path(user_id)).items():
+                state[k] = v
         except FileNotFoundError:
-            self.mutations_list = []  # Initialize with empty or default state
+            return state  # Removed meanwhile
         except json.JSONDecodeError:
-            print("Error: Could not parse mutations.")
+            print(f"Error: Could not parse world state for {user_id}.")
+        return StateTree(flatten_to_nested(state))  # Old files may still hold dotted keys
 
-    def save_mutations(self):
-        try:
-            with open(f'./states/mut_{self.file_name}', 'w') as file:
-                json.dump(self.mutations_list, file, indent=2)
-        except Exception as e:
-            print(f"Error saving world state: {str(e)}")
+    def replay(self, user_id, sequence=None):
+        """The user's state as of journal record `sequence` (the latest on disk if None).
+
+        Only the records since the oldest kept snapshot can be replayed; earlier ones raise ValueError.
+        """
+        return self.load_user(user_id, sequence).state
+
+    def record(self, user, record):
+        """Apply a change to the user's state and queue it for the journal."""
+        with user.lock:
+            user.sequence += 1
+            record = {'seq': user.sequence, 'time': datetime.now().isoformat(), **record}
+            self.apply_record(user, record)
+            user.pending.append(record)
+            user.changed_paths.update(record.get('assign', {}))
+            user.changed_paths.update(mutation['key_name'] for mutation in record.get('mutations', [])
+                                      if isinstance(mutation, dict) and isinstance(mutation.get('key_name'), str))
+            if user.dirty_since is None:
+                user.dirty_since = time.monotonic()
+
+    def apply_record(self, user, record):
+        """Apply a journal record: plain assignments first, then its batch of mutations."""
+        with user.lock:
+            for key, value in record.get('assign', {}).items():
+                user.state.set_path(key, value)
+            if 'mutations' in record:
+                user.state["recent_mutation_errors"] = user.state.apply_batch(record['mutations'])
+            user.touch_state()
+
+    def save_state(self, user):
+        """Append the user's pending records to the journal, taking a snapshot when it is due."""
+        with user.lock:
+            records, user.pending = user.pending, []
+            dirty_since, user.dirty_since = user.dirty_since, None
+            try:
+                if records:
+                    with self.journal.locked(user.user_id):
+                        if self.journal.position(user.user_id) != user.position:
+                            self.catch_up(user, records)
+                        user.position = self.journal.append(user.user_id, user.base, records)
+                        user.journal_length += len(records)
+            except Exception as e:
+                print(f"Error saving world state: {str(e)}")
+                user.pending[:0] = records  # Retried with the next write-back, ahead of newer records
+                user.dirty_since = dirty_since
+                return
+            try:
+                if user.journal_length >= WORLD_STATE_SNAPSHOT_EVERY:
+                    with self.journal.locked(user.user_id):
+                        if self.journal.position(user.user_id) == user.position:  # Else another worker wrote since
+                            self.journal.snapshot(user.user_id, user.sequence, user.state)
+                            user.base, user.journal_length = user.sequence, 0
+                            user.position = self.journal.position(user.user_id)
+            except Exception as e:
+                print(f"Error saving world state snapshot: {str(e)}")  # The journal still holds every record
+
+    def catch_up(self, user, records):
+        """Rebuild the state from what other workers wrote, then re-apply this process's records after it.
+
+        The records are renumbered to follow the journal on disk, so every worker and a replay
+        see the same order. The caller holds the journal lock and the user's lock.
+        """
+        state, base, journal_records, user.position = self.journal.read(user.user_id)
+        self.rebuild(user, state, base, journal_records)
+        for record in records:
+            user.sequence += 1
+            record['seq'] = user.sequence
+            self.apply_record(user, record)
+
+    def write_back(self, max_age=0):
+        """Write back the loaded states that have been dirty for at least `max_age` seconds."""
+        now = time.monotonic()
+        with self.users_lock:
+            users = list(self.users.values())
+        for user in users:
+            if user.dirty_since is not None and now - user.dirty_since >= max_age:
+                self.save_state(user)
+
+    def flush(self):
+        """Write back every changed state."""
+        self.write_back()
 
     def update_interaction(self):
         self.interaction_count += 1
 
     def update_world_state(self, user_id, chat_history, last_request):
-        """Update the world state with input states."""
-        # Determine the appropriate mutation based on chat history
-        delta_time = datetime.now() - self.last_update
-        self.token_bank += ( delta_time.total_seconds() * self.tokens_per_second)
-        print(f"{self.file_name} bank : {self.token_bank} / {self.last_token_cost}")
-        if self.token_bank > self.last_token_cost:
-            self.last_update = datetime.now()
-            mutations = self.generate_mutation_from_interactions(chat_history, last_request)
-            for mutation in mutations:
-                self.apply_mutation(mutation)
-
-            self.update_interaction()
-            self.save_state()
-            return True
-        return False
-
-    def generate_mutation_from_interactions(self, chat_history, last_request):
-        """Generate mutations based on recent interactions."""
-        prompt = self.create_mutation_prompt(chat_history, last_request)
-        mutations = '{}'
+        """Update the user's world state with input states."""
+        user = self.get_user(user_id)
+        grant = self.reserve_update(user)
+        if grant is None:
+            return False
         try:
-            response = openai.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {"role": "system",
-                     "content": "You are an AI tasked with proposing mutations to an AI world state."},
-                    {"role": "user", "content": last_request},
-                    {"role": "user", "content": prompt},
-                ],
-                max_tokens=self.update_size,
+            self.update_emotional_state(user)
+            mutations = self.generate_mutation_from_interactions(user, chat_history, last_request)
+            self.finish_update(user, mutations)
+        finally:
+            self.settle_update(user, grant)
+        return True
+
+    async def update_world_state_async(self, user_id, chat_history, last_request):
+        """Update the user's world state without blocking the event loop."""
+        user = await asyncio.to_thread(self.get_user, user_id)
+        grant = self.reserve_update(user)
+        if grant is None:
+            return False
+        try:
+            self.update_emotional_state(user)
+            mutations = await self.generate_mutation_from_interactions_async(user, chat_history, last_request)
+            await asyncio.to_thread(self.finish_update, user, mutations)
+        finally:
+            self.settle_update(user, grant)
+        return True
+
+    def update_emotional_state(self, user):
+        """Copy the user's running mood from the emotion tracker into the state."""
+        if self.emotion_tracker is None:
+            return
+        emotion = self.emotion_tracker.get_emotional_state(user.user_id)
+        with user.lock:
+            if user.state.get('user_emotional_state') != emotion:
+                self.record(user, {'assign': {'user_emotional_state': emotion}})
+
+    def reserve_update(self, user):
+        """Ask the token scheduler for an update's tokens, returning its Grant or None when it must wait."""
+        with user.lock:
+            if user.updating:
+                return None  # Overlapping requests share the update that is already running
+            scheduler = get_scheduler()
+            grant = scheduler.try_acquire(self.call_site, user.user_id, self.last_token_cost)
+            print(f"{self.file_name} bank : {scheduler.bank(self.call_site)} / {self.last_token_cost}")
+            if grant is None:
+                return None
+            user.updating = True
+            user.update_tokens = 0
+            return grant
+
+    def settle_update(self, user, grant):
+        """Charge the update's tokens to the scheduler; a failed or cached update returns its reservation."""
+        with user.lock:
+            if user.update_tokens:
+                self.last_token_cost = user.update_tokens
+            grant.settle(user.update_tokens or None)
+            user.updating = False
+
+    def finish_update(self, user, mutations):
+        with user.lock:
+            user.changed_paths = set()  # Shown to this update; its own mutations are shown to the next
+        if mutations:
+            self.record(user, {'mutations': mutations})
+            with user.lock:
+                invalid = len(user.state.get("recent_mutation_errors", []))
+            with self.parse_counts_lock:
+                self.parse_counts['invalid_mutations'] += invalid
+        self.update_interaction()
+        with self.users_lock:
+            orphaned = self.users.get(user.user_id) is not user  # Evicted before the update began
+        if orphaned:
+            self.save_state(user)
+        self.write_back(WORLD_STATE_WRITE_BACK_SECONDS)
+
+    def generate_mutation_from_interactions(self, user, chat_history, last_request):
+        """Generate mutations based on recent interactions.
+
+        If the model first asks to see summarized values in full, it is asked once more with them expanded.
+        """
+        mutations, expand = self.request_mutations(user, chat_history, last_request)
+        if expand and not mutations:
+            mutations, _ = self.request_mutations(user, chat_history, last_request, expand)
+        return mutations
+
+    async def generate_mutation_from_interactions_async(self, user, chat_history, last_request):
+        """Generate mutations based on recent interactions, awaiting the completions."""
+        mutations, expand = await self.request_mutations_async(user, chat_history, last_request)
+        if expand and not mutations:
+            mutations, _ = await self.request_mutations_async(user, chat_history, last_request, expand)
+        return mutations
+
+    def request_mutations(self, user, chat_history, last_request, expanded=()):
+        try:
+            response = get_gateway().complete(
+                self.call_site,
+                **self.mutation_request(user, chat_history, last_request, expanded),
+            )
+        except Exception as e:
+            print(f"Error generating mutations: {str(e)}")
+            return [], []
+        return self.parse_mutation_response(user, response)
+
+    async def request_mutations_async(self, user, chat_history, last_request, expanded=()):
+        try:
+            response = await get_gateway().complete_async(
+                self.call_site,
+                **self.mutation_request(user, chat_history, last_request, expanded),
             )
-            # Extract and decode the mutation JSON from the response
-            mutations = response.choices[0].message.content.strip().replace('```json', '').replace('```', '')
-            self.last_token_cost = response.usage.total_tokens
-            self.token_bank -= self.last_token_cost
-            print(json.loads(mutations))
-            return json.loads(mutations)  # Convert to JSON
         except Exception as e:
             print(f"Error generating mutations: {str(e)}")
-            print(mutations)
-            return {}
+            return [], []
+        return self.parse_mutation_response(user, response)
 
-    def create_mutation_prompt(self, chat_history, special_instructions=""):
+    def mutation_request(self, user, chat_history, last_request, expanded=()):
+        params = dict(
+            model=self.model_name,
+            messages=self.create_mutation_messages(user, chat_history, last_request, expanded),
+            max_tokens=self.update_size,
+        )
+        if self.structured_output:
+            params['response_format'] = MUTATION_RESPONSE_FORMAT
+        return params
+
+    def create_mutation_messages(self, user, chat_history, last_request, expanded=()):
+        prompt = self.create_mutation_prompt(user, chat_history, last_request, expanded)
+        return [
+            {"role": "system",
+             "content": "You are an AI tasked with proposing mutations to an AI world state."},
+            {"role": "user", "content": last_request},
+            {"role": "user", "content": prompt},
+        ]
+
+    def parse_mutation_response(self, user, response):
+        """(mutations, paths the model asked to expand) of a reply, keeping the complete mutations when it
+        was cut off, and counting parse failures and wasted tokens."""
+        choice = response.choices[0]
+        text = choice.message.content or ''
+        mutations, parsed, end, expand = parse_mutations(text)
+        wasted = 0
+        if response.usage is not None:  # Cached completions cost nothing
+            with user.lock:
+                user.update_tokens += response.usage.total_tokens
+            if not parsed:
+                # Nothing recovered wastes the whole call; otherwise the tokens of the lost tail
+                wasted = response.usage.total_tokens if not mutations else round(
+                    response.usage.completion_tokens * (len(text) - end) / max(len(text), 1))
+        with self.parse_counts_lock:
+            self.parse_counts['replies'] += 1
+            self.parse_counts['parse_failures'] += not parsed
+            self.parse_counts['truncated_replies'] += choice.finish_reason == 'length'
+            self.parse_counts['recovered_mutations'] += len(mutations) if not parsed else 0
+            self.parse_counts['wasted_tokens'] += wasted
+        if not parsed:
+            print(f"Error parsing mutations, kept {len(mutations)}: {text}")
+        print(mutations)
+        return mutations, [path for path in expand if isinstance(path, str)]
+
+    def get_metrics(self):
+        """Mutation replies, parse failures (and their rate), recovered and invalid mutations, wasted tokens."""
+        with self.parse_counts_lock:
+            metrics = dict(self.parse_counts)
+        metrics['parse_failure_rate'] = metrics['parse_failures'] / metrics['replies'] if metrics['replies'] else 0.0
+        return metrics
+
+    def create_mutation_prompt(self, user, chat_history, special_instructions="", expanded=()):
         history_length = min(len(chat_history) - 1, self.max_history_length)
         """Create a prompt to suggest mutations based on user interactions."""
 
         recent_history = chat_history[-history_length:]
         formatted_history = json.dumps(recent_history)
+        with user.lock:
+            if self.state_prompt == 'digest':
+                formatted_state = self.format_state_digest(user, expanded)
+            else:
+                formatted_state = json.dumps(user.state)
 
         prompt = (
             f"{special_instructions}\n"
             f"{self.custom_instructions}"
             "The previous world state is"
-            f"{json.dumps(self.state)}"
+            f"{formatted_state}"
             f"The current time is {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}"
             f"Based on the following recent interactions, please suggest mutations to the world state"
             f" to bring it in line in the following history:\n"
@@ -177,64 +530,82 @@ class MutationWorldState:
             f"to make sure the types of the variables being mutated are consistent. "
             f"Use no more than {self.update_size} tokens."
             f"If the previous world state seems unweildy, make sure to prune irrelevant variables."
-            "You should return ONLY a json list that conforms to type Mutation[] as in the def below"
+            f"{self.output_instructions()}"
             f"{MUTATION_TYPE_DEF}"
 
         )
 
         return prompt
 
-    def apply_mutation(self, mutation):
+    def format_state_digest(self, user, expanded):
+        """The state as sorted `path: value` lines plus the paths changed since the last update."""
+        expanded = set(expanded)
+        digest = state_digest(user.state, expanded)
+        changed = changed_lines(user.state, user.changed_paths, expanded)
+        return (
+            " (one dotted key path per line; values shown as <...> are summarized)\n"
+            f"{digest}\n"
+            + (f"Changed since the last update:\n{changed}\n" if changed else "")
+        )
+
+    def output_instructions(self):
+        if self.structured_output:
+            expand = (" To see a summarized value in full before proposing mutations, return "
+                      "{\"mutations\": [], \"expand\": [\"key.path\"]}." if self.state_prompt == 'digest' else "")
+            return ("You should return ONLY a json object {\"mutations\": Mutation[]} whose list conforms to "
+                    "type Mutation[] as in the def below, with the most important mutations first." + expand)
+        return "You should return ONLY a json list that conforms to type Mutation[] as in the def below"
+
+    def apply_mutation(self, user, mutation):
         """
-        Apply a mutation based on the provided mutation structure.
+        Apply a mutation to the user's state based on the provided mutation structure.
         The mutation must contain the 'action' and 'value' keys with appropriate types.
         """
-        action = mutation.get('action')
-        value = mutation.get('value')
-        key = mutation.get('key_name')
-        target_exists = key in self.state
-        target_value = self.state[key] if target_exists else None
-        errors = []
-        if action in {'+', '-'}:
-            if isinstance(value, (int, float)):
-                if not isinstance(target_value, (int, float)):
-                    errors.append(f"Error: The target value for '+' or '-' is not a number: {target_value}")
-                else:
-                    self.state[key] += value if action == '+' else -value
-            else:
-                errors.append(
-                    "Error: The value for '+' or '-' must be a number." + json.dumps(mutation, indent=2))
-
-        elif action in {'add', 'remove'}:
-            if isinstance(value, str):
-                if action == 'add':
-                    if target_exists and not isinstance(target_value, list):
-                        self.state[key] = [target_value]
-                    elif key not in self.state:
-                        self.state[key] = []
-                    # Provide logic for how to add items, e.g., to a list or a dictionary
-                    self.state[key].append(value)  # Adjust to where you want to add
-                elif action == 'remove':
-                    # Example logic for removal
-                    if key in self.state:
-                        del self.state[key]
-            else:
-                errors.append("Error: The value for 'add' or 'remove' must be a string." + json.dumps(mutation, indent=2))
+        with user.lock:
+            user.state["recent_mutation_errors"] = user.state.apply_batch([mutation])
+            user.touch_state()
 
-        elif action in {'update', 'set'}:
-            # For update/set actions, it's contextual based on key_name
-            key_name = mutation.get('key_name')
-            if key_name:
-                self.state[key_name] = value  # Update or set the value directly
-            else:
-                errors.append("Error: Invalid key name for update/set action." + json.dumps(mutation, indent=2))
-        else:
-            errors.append("Error: Unrecognized action." + json.dumps(mutation, indent=2))
 
-        if errors:
-            mutation.update({'errors': errors})
-        self.mutations_list.append(mutation)
-        self.state["recent_mutation_errors"] = errors
+def parse_mutations(text):
+    """(mutations, whether the reply parsed completely, end of the parsed text, paths to expand) for a reply.
+
+    The reply holds `{"mutations": Mutation[]}` or a bare `Mutation[]`, possibly in a code fence.
+    If it does not parse, as when the reply was cut off at max_tokens, every complete mutation
+    before the damage is kept.
+    """
+    text = text.strip().replace('```json', '').replace('```', '')
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    else:
+        expand = []
+        if isinstance(value, dict) and 'mutations' in value:
+            expand = value.get('expand') if isinstance(value.get('expand'), list) else []
+            value = value['mutations']
+        if isinstance(value, dict):
+            value = [value]
+        if isinstance(value, list):
+            return value, True, len(text), expand
+        return [], False, 0, []
+    start = text.find('[')
+    if start < 0:
+        return [], False, 0, []
+    decoder = json.JSONDecoder()
+    mutations, end = [], start + 1
+    position = end
+    while True:
+        while position < len(text) and text[position] in ' \t\r\n,':
+            position += 1
+        if position >= len(text) or text[position] != '{':
+            break
+        try:
+            mutation, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            break
+        mutations.append(mutation)
+        end = position
+    return mutations, False, end, []
 
 
 def flatten_to_nested(flat_dict):
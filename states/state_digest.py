@@ -0,0 +1,58 @@
+import json
+
+DIGEST_VALUE_CHARS = 200  # Values whose JSON is longer are summarized unless expanded
+DIGEST_DEPTH = 2  # Levels of large dicts broken down into their keys before summarizing
+SUMMARY_PREVIEW_CHARS = 60
+MISSING = object()
+
+
+def compact_json(value):
+    """JSON without whitespace and with sorted keys, so equal states always render the same."""
+    return json.dumps(value, separators=(',', ':'), sort_keys=True, ensure_ascii=False, default=str)
+
+
+def summarize(value):
+    if isinstance(value, dict):
+        keys = sorted(map(str, value))
+        return f"<dict of {len(keys)} keys: {', '.join(keys[:8])}{', ...' if len(keys) > 8 else ''}>"
+    if isinstance(value, list):
+        return f"<list of {len(value)} items, first: {compact_json(value[0])[:SUMMARY_PREVIEW_CHARS]}>"
+    text = value if isinstance(value, str) else compact_json(value)
+    return f"<{len(text)} chars: {compact_json(text[:SUMMARY_PREVIEW_CHARS])}...>"
+
+
+def state_digest(state, expanded=()):
+    """One `path: value` line per key, sorted; large values become summaries unless their path is expanded."""
+    lines = []
+    add_lines(lines, state, '', set(expanded), 0)
+    return '\n'.join(lines)
+
+
+def add_lines(lines, node, prefix, expanded, depth):
+    for key in sorted(node, key=str):
+        path = f"{prefix}{key}"
+        value = node[key]
+        text = compact_json(value)
+        if len(text) <= DIGEST_VALUE_CHARS or path in expanded:
+            lines.append(f"{path}: {text}")
+        elif isinstance(value, dict) and (depth + 1 < DIGEST_DEPTH
+                                          or any(other.startswith(path + '.') for other in expanded)):
+            add_lines(lines, value, path + '.', expanded, depth + 1)
+        else:
+            lines.append(f"{path}: {summarize(value)}")
+
+
+def changed_lines(state, paths, expanded=()):
+    """The current value of each changed path, or a note that it was removed.
+
+    Large values are summarized unless their path is expanded, as in `state_digest`.
+    """
+    lines = []
+    for path in sorted(paths):
+        value = state.get_path(path, MISSING)
+        if value is MISSING:
+            lines.append(f"{path}: (removed)")
+            continue
+        text = compact_json(value)
+        lines.append(f"{path}: {text if len(text) <= DIGEST_VALUE_CHARS or path in expanded else summarize(value)}")
+    return '\n'.join(lines)
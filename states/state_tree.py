@@ -0,0 +1,146 @@
+import json
+
+ACTIONS = {'+', '-', 'add', 'remove', 'update', 'set'}
+NUMBER_ACTIONS = {'+', '-'}
+STRING_ACTIONS = {'add', 'remove'}
+
+# MUTATION_TYPE_DEF as a JSON schema, for completions with structured output. The root must be
+# an object, so the list comes wrapped as {"mutations": Mutation[]}.
+MUTATION_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'mutations': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'key_name': {'type': 'string', 'description': "Dotted path of the key to mutate"},
+                    'action': {'type': 'string', 'enum': sorted(ACTIONS)},
+                    'value': {'description': "A number for '+' and '-', a string for 'add' and 'remove', "
+                                             "anything for 'update' and 'set'"},
+                },
+                'required': ['key_name', 'action', 'value'],
+            },
+        },
+        'expand': {
+            'type': 'array',
+            'items': {'type': 'string'},
+            'description': "Key paths of summarized values to see in full before proposing mutations",
+        },
+    },
+    'required': ['mutations'],
+}
+
+
+class StateTree(dict):
+    """A nested world state addressed by dotted paths, so `"user.name"` lives at state['user']['name'].
+
+    Paths are resolved as they are used, which replaces the `flatten_to_nested` pass over the
+    whole state. A value found where a path needs a dict is kept under the `_` key of the new
+    dict, as `flatten_to_nested` did.
+    """
+
+    def parent(self, path, create=False):
+        """(dict holding the path's last part, that part); the dict is None if missing and not created."""
+        parts = path.split('.')
+        node = self
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                if not create:
+                    return None, parts[-1]
+                child = node[part] = {} if child is None and part not in node else {'_': child}
+            node = child
+        return node, parts[-1]
+
+    def has_path(self, path):
+        node, key = self.parent(path)
+        return node is not None and key in node
+
+    def get_path(self, path, default=None):
+        node, key = self.parent(path)
+        return node.get(key, default) if node is not None else default
+
+    def set_path(self, path, value):
+        node, key = self.parent(path, create=True)
+        node[key] = value
+
+    def add_path(self, path, value):
+        """Append to the list at the path, turning a single value into a list first."""
+        node, key = self.parent(path, create=True)
+        if key not in node:
+            node[key] = []
+        elif not isinstance(node[key], list):
+            node[key] = [node[key]]
+        node[key].append(value)
+
+    def remove_path(self, path, value=None):
+        """Remove `value` from the list at the path, or else the path itself."""
+        node, key = self.parent(path)
+        if node is None or key not in node:
+            return
+        if isinstance(node[key], list) and value in node[key]:
+            node[key].remove(value)
+        else:
+            del node[key]
+
+    def apply(self, mutation):
+        """Apply one mutation that passed `validate_mutations`; returns an error message or None."""
+        action, key, value = mutation['action'], mutation['key_name'], mutation.get('value')
+        if action in NUMBER_ACTIONS:
+            target = self.get_path(key)
+            if not isinstance(target, (int, float)):
+                return f"Error: The target value for '+' or '-' is not a number: {target}"
+            self.set_path(key, target + value if action == '+' else target - value)
+        elif action == 'add':
+            self.add_path(key, value)
+        elif action == 'remove':
+            self.remove_path(key, value)
+        else:
+            self.set_path(key, value)
+        return None
+
+    def apply_batch(self, mutations):
+        """Validate a batch of mutations once, then apply the valid ones.
+
+        Every rejected or failed mutation gets an `errors` list; all of them are returned.
+        """
+        valid, errors = validate_mutations(mutations)
+        for mutation in valid:
+            error = self.apply(mutation)
+            if error:
+                mutation['errors'] = [error]
+                errors.append(error)
+        return errors
+
+
+def validate_mutations(mutations):
+    """Check a batch against MUTATION_TYPE_DEF: (mutations that can be applied, error messages).
+
+    A single mutation object is accepted as a batch of one.
+    """
+    if isinstance(mutations, dict):
+        mutations = [mutations]
+    if not isinstance(mutations, list):
+        return [], ["Error: Mutations must be a list of Mutation objects."]
+    valid, errors = [], []
+    for mutation in mutations:
+        if not isinstance(mutation, dict):
+            errors.append("Error: A mutation must be an object: " + json.dumps(mutation))
+            continue
+        action, key, value = mutation.get('action'), mutation.get('key_name'), mutation.get('value')
+        if not isinstance(action, str) or action not in ACTIONS:  # A list or dict is not hashable
+            error = "Error: Unrecognized action."
+        elif not isinstance(key, str) or not key:
+            error = "Error: Invalid key name for the mutation."
+        elif action in NUMBER_ACTIONS and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            error = "Error: The value for '+' or '-' must be a number."
+        elif action in STRING_ACTIONS and not isinstance(value, str):
+            error = "Error: The value for 'add' or 'remove' must be a string."
+        else:
+            valid.append(mutation)
+            continue
+        error += " " + json.dumps(mutation)  # Only rejected mutations are serialized
+        mutation['errors'] = [error]
+        errors.append(error)
+    return valid, errors
@@ -1,8 +1,9 @@
 import json
-import openai
 from datetime import datetime
 
 from chatbot.emotional_state_handler import EmotionalStateHandler
+from utils.llm_gateway import get_gateway
+from utils.persistence import get_writer, read_json
 
 
 class WorldState:
@@ -30,9 +31,8 @@ class WorldState:
 
     def load_state(self):
         try:
-            with open(f'./states/{self.file_name}', 'r') as file:
-                proposed_state = json.load(file)
-                self.state.update(proposed_state)
+            proposed_state = read_json(f'./states/{self.file_name}')
+            self.state.update(proposed_state)
         except FileNotFoundError:
             self.state = {}  # Initialize with empty or default state
         except json.JSONDecodeError:
@@ -40,8 +40,7 @@ class WorldState:
 
     def save_state(self):
         try:
-            with open(f'./states/{self.file_name}', 'w') as file:
-                json.dump(self.state, file, indent=2)
+            get_writer().write_json(f'./states/{self.file_name}', self.state)
         except Exception as e:
             print(f"Error saving world state: {str(e)}")
 
@@ -54,7 +53,8 @@ class WorldState:
         prompt = self.create_generation_prompt(chat_history)
         generated_state = ''
         try:
-            response = openai.chat.completions.create(
+            response = get_gateway().complete(
+                "world_state",
                 model=self.model_name,
                 messages=[
                     {"role": "user", "content": request},
@@ -0,0 +1,117 @@
+import json
+import os
+from urllib.parse import quote
+
+from utils import serializer
+from utils.persistence import file_lock, write_atomic
+
+SNAPSHOT_PREFIX = 'snapshot-'
+JOURNAL_PREFIX = 'journal-'
+
+
+class WorldStateJournal:
+    """Snapshots of each user's world state and an append-only journal of the changes since.
+
+    A user's directory holds `snapshot-<seq>.json`, the state after the first `seq` journal
+    records, and `journal-<seq>.jsonl`, the records that followed it, one JSON object per line.
+    Taking a snapshot starts a new journal, and only the newest `snapshots_kept` snapshots are
+    kept along with their journals, so disk use and load time stay bounded while the recent
+    past can still be replayed. Journal sequence 0 has no snapshot file: it starts from the
+    default state. `position` tells a writer whether another worker process appended or took
+    a snapshot since it last read, so it can catch up before appending under the same lock.
+    """
+
+    def __init__(self, directory, snapshots_kept=3):
+        self.directory = directory
+        self.snapshots_kept = snapshots_kept
+
+    def user_directory(self, user_id):
+        return os.path.join(self.directory, quote(str(user_id), safe=''))
+
+    def path(self, user_id, prefix, sequence, extension):
+        return os.path.join(self.user_directory(user_id), f"{prefix}{sequence:012d}{extension}")
+
+    def bases(self, user_id):
+        """Sequence numbers with a snapshot or a journal, oldest first."""
+        try:
+            names = os.listdir(self.user_directory(user_id))
+        except FileNotFoundError:
+            return []
+        return sorted({int(name.split('-', 1)[1].split('.', 1)[0]) for name in names
+                       if name.startswith((SNAPSHOT_PREFIX, JOURNAL_PREFIX)) and not name.endswith('.tmp')})
+
+    def locked(self, user_id, exclusive=True):
+        """Hold the user's directory lock; `read`, `append` and `snapshot` expect the caller to hold it."""
+        return file_lock(self.user_directory(user_id), exclusive)
+
+    def load(self, user_id, sequence=None):
+        """`read` under a shared lock; a user without a directory is read without creating a lock file."""
+        if not os.path.isdir(self.user_directory(user_id)):
+            return None, 0, [], (0, 0)
+        with self.locked(user_id, exclusive=False):
+            return self.read(user_id, sequence)
+
+    def read(self, user_id, sequence=None):
+        """(snapshot state or None, its sequence, the journal records after it up to `sequence`, position)."""
+        bases = [base for base in self.bases(user_id) if sequence is None or base <= sequence]
+        if not bases:
+            if sequence is not None and self.bases(user_id):
+                raise ValueError(f"World state of {user_id} before sequence {sequence} is no longer kept")
+            return None, 0, [], self.position(user_id)
+        base = bases[-1]
+        try:
+            with open(self.path(user_id, SNAPSHOT_PREFIX, base, '.json'), 'r', encoding='utf-8') as file:
+                state = serializer.loads(file.read())
+        except FileNotFoundError:
+            state = None
+        position = self.position(user_id)
+        records = [record for record in self.read_journal(user_id, base)
+                   if sequence is None or record['seq'] <= sequence]
+        return state, base, records, position
+
+    def position(self, user_id):
+        """(latest base, size of its journal): it changes whenever any process appends or takes a snapshot."""
+        bases = self.bases(user_id)
+        base = bases[-1] if bases else 0
+        try:
+            return base, os.path.getsize(self.path(user_id, JOURNAL_PREFIX, base, '.jsonl'))
+        except FileNotFoundError:
+            return base, 0
+
+    def read_journal(self, user_id, base):
+        records = []
+        try:
+            with open(self.path(user_id, JOURNAL_PREFIX, base, '.jsonl'), 'r', encoding='utf-8') as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(serializer.loads(line))
+                    except json.JSONDecodeError:
+                        # A torn trailing line from an interrupted append; everything before it is intact.
+                        print(f"Error: Could not parse a world state record for {user_id}, skipping it.")
+        except FileNotFoundError:
+            pass
+        return records
+
+    def append(self, user_id, base, records):
+        """Append records to the journal that follows snapshot `base`, returning the new position."""
+        os.makedirs(self.user_directory(user_id), exist_ok=True)
+        with open(self.path(user_id, JOURNAL_PREFIX, base, '.jsonl'), 'a', encoding='utf-8') as file:
+            file.write(''.join(serializer.dumps(record) + '\n' for record in records))
+            file.flush()
+            return base, os.fstat(file.fileno()).st_size
+
+    def snapshot(self, user_id, sequence, state):
+        """Store the state after record `sequence`, start its journal and drop the oldest snapshots."""
+        os.makedirs(self.user_directory(user_id), exist_ok=True)
+        write_atomic(self.path(user_id, SNAPSHOT_PREFIX, sequence, '.json'), serializer.dumps(state))
+        open(self.path(user_id, JOURNAL_PREFIX, sequence, '.jsonl'), 'a').close()
+        bases = self.bases(user_id)
+        for base in bases[:max(0, len(bases) - self.snapshots_kept)]:
+            for name in (self.path(user_id, SNAPSHOT_PREFIX, base, '.json'),
+                         self.path(user_id, JOURNAL_PREFIX, base, '.jsonl')):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
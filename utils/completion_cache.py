@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", 24 * 3600))  # Seconds an entry stays valid
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", 10000))  # Least recently used go first
+CACHE_EMBEDDING_MODEL = "bert-base-uncased"
+SIMILARITY_CANDIDATES = 1000  # Most recent entries with the same context compared by similarity
+WHITESPACE = re.compile(r'\s+')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    context TEXT NOT NULL,
+    query TEXT NOT NULL,
+    embedding BLOB,
+    content TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS completions_context ON completions (context, last_used);
+CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used);
+"""
+
+
+class CompletionCache:
+    """Chat completions stored in SQLite, keyed by a hash of the model, parameters and normalized messages.
+
+    Message contents are normalized by collapsing whitespace. Entries expire `ttl` seconds
+    after they were created, and beyond `max_entries` the least recently used are evicted.
+    With `similarity` set, a request whose last user message differs from a cached one but
+    shares every other message and parameter is answered from the cache when the two last
+    user messages embed within that cosine similarity.
+
+    Any number of threads and worker processes can share one store. `stats` counts the
+    lookups of this process and the tokens the hits saved.
+    """
+
+    def __init__(self, path, ttl=COMPLETION_CACHE_TTL, max_entries=COMPLETION_CACHE_MAX_ENTRIES, similarity=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.local = threading.local()
+        self.stats_lock = threading.Lock()
+        self.counts = {'lookups': 0, 'hits': 0, 'similar_hits': 0, 'saved_prompt_tokens': 0,
+                       'saved_completion_tokens': 0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        """The calling thread's connection to the store."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def embeddings(self):
+        from utils.embedding_service import get_embedding_model
+
+        return get_embedding_model(CACHE_EMBEDDING_MODEL)
+
+    def get(self, params):
+        """The cached completion text for the request parameters, or None."""
+        if params.get('stream') or params.get('n', 1) != 1:
+            return None
+        key, context, query = request_keys(params)
+        now = time.time()
+        connection = self.connection()
+        row = connection.execute(
+            "SELECT key, content, prompt_tokens, completion_tokens FROM completions WHERE key = ? AND created > ?",
+            (key, now - self.ttl)).fetchone()
+        similar = False
+        if row is None and self.similarity:
+            row = self.find_similar(context, query, now)
+            similar = row is not None
+        with self.stats_lock:
+            self.counts['lookups'] += 1
+            if row is not None:
+                self.counts['hits'] += 1
+                self.counts['similar_hits'] += similar
+                self.counts['saved_prompt_tokens'] += row[2]
+                self.counts['saved_completion_tokens'] += row[3]
+        if row is None:
+            return None
+        connection.execute("UPDATE completions SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, row[0]))
+        return row[1]
+
+    def find_similar(self, context, query, now):
+        rows = self.connection().execute(
+            "SELECT key, content, prompt_tokens, completion_tokens, embedding FROM completions "
+            "WHERE context = ? AND created > ? AND embedding IS NOT NULL ORDER BY last_used DESC LIMIT ?",
+            (context, now - self.ttl, SIMILARITY_CANDIDATES)).fetchall()
+        if not rows:
+            return None
+        vectors = np.stack([np.frombuffer(row[4], dtype=np.float32) for row in rows])
+        scores = vectors @ self.embed(query)
+        best = int(np.argmax(scores))
+        return rows[best][:4] if scores[best] >= self.similarity else None
+
+    def embed(self, text):
+        vector = self.embeddings().embed_one(text)[0].astype(np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def put(self, params, content, usage=None):
+        """Store the completion text for the request parameters."""
+        if params.get('stream') or params.get('n', 1) != 1 or content is None:
+            return
+        key, context, query = request_keys(params)
+        if usage is not None and getattr(usage, 'prompt_tokens', None) is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            from chatbot.prompt_builder import count_tokens, message_tokens
+
+            prompt_tokens = sum(message_tokens(message) for message in params.get('messages', []))
+            completion_tokens = count_tokens(content)
+        embedding = self.embed(query).tobytes() if self.similarity and query else None
+        now = time.time()
+        connection = self.connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO completions (key, context, query, embedding, content, prompt_tokens, "
+            "completion_tokens, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, context, query, embedding, content, prompt_tokens, completion_tokens, now, now))
+        self.evict(now)
+
+    def evict(self, now):
+        connection = self.connection()
+        connection.execute("DELETE FROM completions WHERE created <= ?", (now - self.ttl,))
+        connection.execute(
+            "DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,))
+
+    def stats(self):
+        """Lookups, hits and saved tokens of this process, plus the size of the store."""
+        with self.stats_lock:
+            stats = dict(self.counts)
+        stats['hit_rate'] = stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+        entries, stored_hits, saved_prompt, saved_completion = self.connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(hits), 0), COALESCE(SUM(hits * prompt_tokens), 0),"
+            " COALESCE(SUM(hits * completion_tokens), 0) FROM completions").fetchone()
+        stats['entries'] = entries
+        stats['stored_hits'] = stored_hits  # Hits on the current entries, across every process
+        stats['stored_saved_prompt_tokens'] = saved_prompt
+        stats['stored_saved_completion_tokens'] = saved_completion
+        return stats
+
+    def clear(self):
+        self.connection().execute("DELETE FROM completions")
+
+
+def normalize_content(content):
+    if isinstance(content, str):
+        return WHITESPACE.sub(' ', content).strip()
+    return content
+
+
+def request_keys(params):
+    """(key of the whole request, key of everything but the last user message, that message's text)."""
+    messages = [{**message, 'content': normalize_content(message.get('content'))} for message in params.get('messages', [])]
+    query_index = next((i for i in range(len(messages) - 1, -1, -1) if messages[i].get('role') == 'user'), None)
+    query = messages[query_index]['content'] if query_index is not None else ''
+    other_params = {name: value for name, value in params.items() if name not in ('messages', 'stream')}
+    context_messages = [message if i != query_index else {**message, 'content': None} for i, message in enumerate(messages)]
+    return (digest([other_params, messages]), digest([other_params, context_messages]),
+            query if isinstance(query, str) else json.dumps(query))
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def completion_content(response):
+    return response.choices[0].message.content
+
+
+def cached_response(params, content):
+    """A ChatCompletion carrying cached text, for call sites that read `choices[0].message.content`."""
+    from openai.types.chat import ChatCompletion
+
+    return ChatCompletion.model_validate({
+        'id': 'cached', 'object': 'chat.completion', 'created': int(time.time()), 'model': params.get('model', ''),
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+    })
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_completion_cache():
+    """The process-wide completion cache, or None unless COMPLETION_CACHE names its SQLite store.
+
+    Read on first use so settings from a .env file apply. COMPLETION_CACHE_SIMILARITY is the
+    cosine similarity above which a differently worded request reuses a cached completion.
+    """
+    global _cache
+    path = os.getenv("COMPLETION_CACHE")
+    if not path:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            similarity = os.getenv("COMPLETION_CACHE_SIMILARITY")
+            _cache = CompletionCache(path, similarity=float(similarity) if similarity else None)
+        return _cache
@@ -0,0 +1,151 @@
+import os
+import queue
+import re
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+EMBEDDING_PRECISION = os.getenv("EMBEDDING_PRECISION", "fp32")  # 'fp32' or 'int8' (dynamic quantization on CPU)
+MAX_BATCH_SIZE = 32
+BATCH_WINDOW = 0.005  # Seconds to wait for more concurrent requests before running a batch
+
+
+class EmbeddingModel:
+    """A transformer encoder shared by every component that embeds text.
+
+    torch, transformers and the weights are only loaded when the first text is embedded.
+    Texts embedded concurrently from different threads are run through the model as one
+    padded batch. Vectors are the attention-masked mean of the last hidden state, returned
+    as float32 NumPy arrays.
+    """
+
+    def __init__(self, name, revision='main', precision=EMBEDDING_PRECISION, max_batch_size=MAX_BATCH_SIZE,
+                 batch_window=BATCH_WINDOW):
+        self.name = name
+        self.revision = revision
+        self._resolved_revision = None
+        self.precision = precision
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.tokenizer = None
+        self.model = None
+        self.device = None
+        self.load_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.worker = None
+        self.batch_count = 0
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def load(self):
+        """Load the tokenizer and model once, picking the precision for the device."""
+        with self.load_lock:
+            if self.model is not None:
+                return
+            import torch
+            from transformers import AutoModel, AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(self.name, revision=self.revision)
+            model = AutoModel.from_pretrained(self.name, revision=self.revision)
+            model.eval()
+            if torch.cuda.is_available():
+                self.device = 'cuda'
+                model = model.half().to(self.device)
+            else:
+                # Half precision is emulated on most CPUs and slower than fp32; int8 trades a little accuracy for speed.
+                self.device = 'cpu'
+                if self.precision == 'int8':
+                    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            self.tokenizer = tokenizer
+            self.model = model
+
+    def resolved_revision(self):
+        """The commit the revision points to in the local Hugging Face cache, without loading anything."""
+        if self._resolved_revision is None:
+            self._resolved_revision = self.revision
+            if not re.fullmatch(r'[0-9a-f]{40}', self.revision):
+                try:
+                    from huggingface_hub.constants import HF_HUB_CACHE
+
+                    ref_path = os.path.join(HF_HUB_CACHE, f"models--{self.name.replace('/', '--')}", 'refs', self.revision)
+                    with open(ref_path) as file:
+                        self._resolved_revision = file.read().strip()
+                except (ImportError, OSError):
+                    pass  # Not downloaded yet: key the cache on the revision name
+        return self._resolved_revision
+
+    def embed(self, texts):
+        """Embed a string or a list of strings, returning an (N x D) array."""
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        self.start_worker()
+        future = Future()
+        self.requests.put((list(texts), future))
+        return future.result()
+
+    def embed_one(self, text):
+        """Embed a single string, returning a (1 x D) array."""
+        return self.embed([text])
+
+    def start_worker(self):
+        with self.load_lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name=f"embeddings-{self.name}", daemon=True)
+                self.worker.start()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0][0])
+            while size < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=self.batch_window)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        texts = [text for request_texts, _ in batch for text in request_texts]
+        try:
+            self.load()
+            vectors = np.concatenate([self.encode(texts[start:start + self.max_batch_size])
+                                      for start in range(0, len(texts), self.max_batch_size)])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batch_count += 1
+        start = 0
+        for request_texts, future in batch:
+            future.set_result(vectors[start:start + len(request_texts)])
+            start += len(request_texts)
+
+    def encode(self, texts):
+        import torch
+
+        inputs = self.tokenizer(texts, return_tensors='pt', padding=True, truncation=True).to(self.device)
+        with torch.inference_mode():
+            hidden = self.model(**inputs).last_hidden_state
+            mask = inputs['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        return pooled.float().cpu().numpy()
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_embedding_model(name):
+    """Return the process-wide embedding model for a Hugging Face model name."""
+    with _models_lock:
+        model = _models.get(name)
+        if model is None:
+            model = _models[name] = EmbeddingModel(name)
+        return model
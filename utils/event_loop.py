@@ -0,0 +1,35 @@
+import asyncio
+import threading
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """Return the process-wide event loop, starting it in a daemon thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="chatbot-event-loop", daemon=True).start()
+        return _loop
+
+
+def run_async(coroutine, timeout=None):
+    """Run a coroutine on the shared loop from synchronous code and wait for its result."""
+    loop = get_event_loop()
+    if _running_loop() is loop:
+        raise RuntimeError("run_async cannot be called from the shared event loop; await the coroutine instead.")
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result(timeout)
+
+
+def spawn(coroutine):
+    """Schedule a coroutine on the shared loop without waiting for it."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
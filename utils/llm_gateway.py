@@ -0,0 +1,377 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+
+import httpx
+import openai
+
+from utils.completion_cache import cached_response, get_completion_cache
+from utils.token_scheduler import get_scheduler
+
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", 500))  # 0 disables the limit
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", 200000))  # Prompt plus max_tokens, as OpenAI counts them
+LLM_MAX_CONNECTIONS = 64  # Pooled connections to the API shared by every call site
+LLM_TIMEOUT = 60.0
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # Seconds; attempt n waits a random time up to BACKOFF_BASE * 2 ** n
+BACKOFF_MAX = 30.0
+DEFAULT_MAX_TOKENS = 1024  # Assumed completion size for the token budget when a call does not set max_tokens
+LATENCY_SAMPLES = 1000  # Recent latencies kept per call site for percentiles
+
+
+class TransientError(Exception):
+    """A failure worth retrying, raised by backends other than OpenAI's."""
+
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError, TransientError)
+
+
+class OpenAIBackend:
+    """The OpenAI API through one pooled HTTP client per process (and one async client per event loop)."""
+
+    def __init__(self, api_key=None, max_connections=LLM_MAX_CONNECTIONS, timeout=LLM_TIMEOUT):
+        self.api_key = api_key
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = timeout
+        self._client = None
+        self.async_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncOpenAI
+        self.lock = threading.Lock()
+
+    def key(self):
+        return self.api_key or openai.api_key or os.getenv("OPENAI_API_KEY")
+
+    @property
+    def client(self):
+        with self.lock:
+            if self._client is None:
+                # The gateway retries, so the SDK does not
+                self._client = openai.OpenAI(api_key=self.key(), max_retries=0, timeout=self.timeout,
+                                             http_client=httpx.Client(limits=self.limits, timeout=self.timeout))
+            return self._client
+
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.async_clients.get(loop)
+            if client is None:
+                client = self.async_clients[loop] = openai.AsyncOpenAI(
+                    api_key=self.key(), max_retries=0, timeout=self.timeout,
+                    http_client=httpx.AsyncClient(limits=self.limits, timeout=self.timeout))
+            return client
+
+    def create(self, **params):
+        return self.client.chat.completions.create(**params)
+
+    async def create_async(self, **params):
+        return await self.async_client().chat.completions.create(**params)
+
+
+class FakeBackend:
+    """Answers locally after `latency` seconds, for running the whole bot offline.
+
+    `answer(messages)` returns the reply text; the default recognizes the bot's mutation and
+    summary prompts and otherwise echoes the last user message. A `failure_rate` share of calls
+    raise TransientError to exercise retries.
+    """
+
+    def __init__(self, latency=0.0, answer=None, failure_rate=0.0):
+        self.latency = latency
+        self.answer = answer or fake_answer
+        self.failure_rate = failure_rate
+
+    def reply(self, params):
+        if random.random() < self.failure_rate:
+            raise TransientError("Simulated transient failure")
+        from chatbot.prompt_builder import count_tokens, message_tokens
+
+        content = self.answer(params.get('messages', []))
+        usage = {'prompt_tokens': sum(message_tokens(message) for message in params.get('messages', [])),
+                 'completion_tokens': count_tokens(content)}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if params.get('stream'):
+            return fake_stream(params, content, usage)
+        response = cached_response(params, content)
+        return response.model_copy(update={'id': 'fake', 'usage': openai.types.CompletionUsage(**usage)})
+
+    def create(self, **params):
+        time.sleep(self.latency)
+        return self.reply(params)
+
+    async def create_async(self, **params):
+        await asyncio.sleep(self.latency)
+        return self.reply(params)
+
+
+def fake_answer(messages):
+    last = str(messages[-1].get('content', '')) if messages else ''
+    if 'mutations' in last:
+        return '[]'
+    if messages and 'summar' in str(messages[0].get('content', '')):
+        return 'Summary of the conversation so far.'
+    request = next((str(message.get('content', '')) for message in reversed(messages) if message.get('role') == 'user'), '')
+    return f"Fake reply to: {request[:200]}"
+
+
+def fake_stream(params, content, usage):
+    from openai.types.chat import ChatCompletionChunk
+
+    words = content.split(' ')
+    for i, word in enumerate(words):
+        yield ChatCompletionChunk.model_validate({
+            'id': 'fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': params.get('model', ''),
+            'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word}, 'finish_reason': None}]})
+    yield ChatCompletionChunk.model_validate({
+        'id': 'fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': params.get('model', ''),
+        'choices': [], 'usage': usage})
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budgets shared by every call in the process.
+
+    Both are token buckets holding a minute's worth. A call takes its share up front and waits
+    while the buckets are in debt, so callers are served in the order they arrived; tokens a
+    call reserved but did not use are returned afterwards.
+    """
+
+    def __init__(self, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.capacity = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.levels = dict(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        for name, capacity in self.capacity.items():
+            if capacity:
+                self.levels[name] = min(capacity, self.levels[name] + elapsed * capacity / 60)
+
+    def reserve(self, tokens):
+        """Take one request and `tokens` from the budgets, returning the seconds to wait before sending."""
+        with self.lock:
+            self.refill(time.monotonic())
+            wait = 0.0
+            for name, amount in (('requests', 1), ('tokens', tokens)):
+                capacity = self.capacity[name]
+                if capacity:
+                    self.levels[name] -= min(amount, capacity)  # A call larger than the budget waits for a full bucket
+                    wait = max(wait, -self.levels[name] * 60 / capacity)
+            return wait
+
+    def refund(self, tokens):
+        with self.lock:
+            self.refill(time.monotonic())
+            if self.capacity['tokens']:
+                self.levels['tokens'] = min(self.capacity['tokens'], self.levels['tokens'] + tokens)
+
+    def snapshot(self):
+        with self.lock:
+            self.refill(time.monotonic())
+            return {name: {'level': self.levels[name], 'capacity': capacity}
+                    for name, capacity in self.capacity.items() if capacity}
+
+
+class LLMGateway:
+    """The one way the chatbot calls a chat completion model.
+
+    Every call names its call site. A call is answered from the completion cache when
+    possible; otherwise it waits for the rate limiter, goes to the backend and is retried
+    with exponential backoff and full jitter on rate limits, timeouts, connection errors and
+    server errors. Calls, retries, errors, tokens and latency are kept per call site.
+    """
+
+    def __init__(self, backend=None, rate_limiter=None, max_retries=MAX_RETRIES):
+        self.backend = backend or default_backend()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.sites = {}  # call site -> metrics
+        self.lock = threading.Lock()
+
+    def complete(self, call_site, **params):
+        """A chat completion, blocking the calling thread."""
+        content = self.cache_lookup(call_site, params)
+        if content is not None:
+            return cached_response(params, content)
+        estimate = self.estimate_tokens(params)
+        start = time.perf_counter()
+        response = self.send(call_site, params, estimate, start)
+        self.finish(call_site, params, response, estimate, start)
+        return response
+
+    async def complete_async(self, call_site, **params):
+        """A chat completion, awaiting every wait on the running event loop."""
+        content = await asyncio.to_thread(self.cache_lookup, call_site, params)
+        if content is not None:
+            return cached_response(params, content)
+        estimate = self.estimate_tokens(params)
+        start = time.perf_counter()
+        response = await self.send_async(call_site, params, estimate, start)
+        await asyncio.to_thread(self.finish, call_site, params, response, estimate, start)
+        return response
+
+    def stream(self, call_site, **params):
+        """Yield the text deltas of a streamed completion; a cached answer is replayed as one delta.
+
+        Failures before the first delta are retried like any other call.
+        """
+        lookup = {name: value for name, value in params.items() if name not in ('stream', 'stream_options')}
+        content = self.cache_lookup(call_site, lookup)
+        if content is not None:
+            yield content
+            return
+        params = dict(params, stream=True, stream_options={'include_usage': True})
+        estimate = self.estimate_tokens(params)
+        start = time.perf_counter()
+        stream = self.send(call_site, params, estimate, start)
+        deltas, usage = [], None
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, 'usage', None) or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    deltas.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        except Exception:
+            self.record_error(call_site, start)
+            raise
+        self.finish(call_site, lookup, None, estimate, start, ''.join(deltas), usage)
+
+    def send(self, call_site, params, estimate, start):
+        """Call the backend within the rate limits, retrying transient failures."""
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self.rate_limiter.reserve(estimate))
+            try:
+                return self.backend.create(**params)
+            except Exception as e:
+                self.rate_limiter.refund(estimate)  # The request still counts; the tokens were not used
+                if not isinstance(e, RETRYABLE_ERRORS) or attempt == self.max_retries:
+                    self.record_error(call_site, start)
+                    raise
+                self.record_retry(call_site)
+                time.sleep(backoff_delay(attempt, e))
+
+    async def send_async(self, call_site, params, estimate, start):
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self.rate_limiter.reserve(estimate))
+            try:
+                return await self.backend.create_async(**params)
+            except Exception as e:
+                self.rate_limiter.refund(estimate)
+                if not isinstance(e, RETRYABLE_ERRORS) or attempt == self.max_retries:
+                    self.record_error(call_site, start)
+                    raise
+                self.record_retry(call_site)
+                await asyncio.sleep(backoff_delay(attempt, e))
+
+    def cache_lookup(self, call_site, params):
+        cache = get_completion_cache()
+        if cache is None:
+            return None
+        try:
+            content = cache.get(params)
+        except Exception as e:  # The cache never fails a completion
+            print(f"Error reading completion cache: {str(e)}")
+            return None
+        if content is not None:
+            with self.lock:
+                self.site(call_site)['cache_hits'] += 1
+        return content
+
+    def finish(self, call_site, params, response, estimate, start, content=None, usage=None):
+        """Record a successful call, return unused reserved tokens and cache the answer."""
+        latency = time.perf_counter() - start
+        if response is not None:
+            usage = getattr(response, 'usage', None)
+            try:
+                content = response.choices[0].message.content
+            except (AttributeError, IndexError):
+                content = None
+        prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+        if usage is not None:
+            self.rate_limiter.refund(max(0, estimate - prompt_tokens - completion_tokens))
+        scheduler = get_scheduler()
+        if not scheduler.is_background(call_site):  # Background consumers settle their own grants
+            scheduler.record_foreground(prompt_tokens + completion_tokens if usage is not None else estimate)
+        with self.lock:
+            site = self.site(call_site)
+            site['calls'] += 1
+            site['prompt_tokens'] += prompt_tokens
+            site['completion_tokens'] += completion_tokens
+            site['latency_total'] += latency
+            site['latencies'].append(latency)
+        cache = get_completion_cache()
+        if cache is not None and content is not None:
+            try:
+                cache.put(params, content, usage)
+            except Exception as e:
+                print(f"Error writing completion cache: {str(e)}")
+
+    def record_retry(self, call_site):
+        with self.lock:
+            self.site(call_site)['retries'] += 1
+
+    def record_error(self, call_site, start):
+        with self.lock:
+            site = self.site(call_site)
+            site['errors'] += 1
+            site['latency_total'] += time.perf_counter() - start
+
+    def site(self, call_site):
+        site = self.sites.get(call_site)
+        if site is None:
+            site = self.sites[call_site] = {
+                'calls': 0, 'cache_hits': 0, 'retries': 0, 'errors': 0, 'prompt_tokens': 0,
+                'completion_tokens': 0, 'latency_total': 0.0, 'latencies': deque(maxlen=LATENCY_SAMPLES),
+            }
+        return site
+
+    def estimate_tokens(self, params):
+        from chatbot.prompt_builder import message_tokens
+
+        prompt_tokens = sum(message_tokens(message) for message in params.get('messages', []))
+        return prompt_tokens + (params.get('max_tokens') or DEFAULT_MAX_TOKENS)
+
+    def metrics(self):
+        """Per call site counts, tokens and latency percentiles (in seconds), plus the rate limit budgets."""
+        with self.lock:
+            sites = {name: dict(site, latencies=sorted(site['latencies'])) for name, site in self.sites.items()}
+        for site in sites.values():
+            latencies = site.pop('latencies')
+            site['latency_p50'] = latencies[len(latencies) // 2] if latencies else None
+            site['latency_p95'] = latencies[int(len(latencies) * 0.95)] if latencies else None
+        return {'call_sites': sites, 'rate_limits': self.rate_limiter.snapshot()}
+
+
+def backoff_delay(attempt, error=None):
+    """Full-jitter exponential backoff, never shorter than a Retry-After the server sent."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    response = getattr(error, 'response', None)
+    try:
+        retry_after = float(response.headers.get('retry-after')) if response is not None else 0.0
+    except (TypeError, ValueError):
+        retry_after = 0.0
+    return max(delay, min(retry_after, BACKOFF_MAX))
+
+
+def default_backend():
+    """The backend named by LLM_BACKEND: 'openai' (default) or 'fake', whose latency is LLM_FAKE_LATENCY seconds."""
+    if os.getenv("LLM_BACKEND", "openai") == 'fake':
+        return FakeBackend(latency=float(os.getenv("LLM_FAKE_LATENCY", 0)))
+    return OpenAIBackend()
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """Return the process-wide LLM gateway, creating it on first use."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway()
+        return _gateway
@@ -0,0 +1,185 @@
+import atexit
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from utils import serializer
+
+try:
+    import fcntl
+except ImportError:  # Windows: writes are still serialized within the process
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path, exclusive=True):
+    """Hold an advisory lock on `<path>.lock` so other processes do not read or write `path` meanwhile."""
+    if fcntl is None:
+        yield
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_json(path):
+    """Load a JSON file while holding a shared lock on it."""
+    with file_lock(path, exclusive=False):
+        with open(path, 'r', encoding='utf-8') as file:
+            return serializer.loads(file.read())
+
+
+PERSISTENCE_FLUSH_SECONDS = float(os.getenv("PERSISTENCE_FLUSH_SECONDS", 1.0))  # Longest a change waits to be written
+
+
+def write_atomic(path, text):
+    """Replace `path` with `text` so readers and crashes only ever see the old or the new file.
+
+    The text goes to a temporary file next to it, is flushed to the disk and renamed over the
+    target. The caller holds the path's file lock if other writers may race with it.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    if hasattr(os, 'O_DIRECTORY'):  # Make the rename itself durable
+        descriptor = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+
+class PersistenceWriter:
+    """Write-behind persistence for files shared by every request and every worker process.
+
+    Saving only marks a path dirty; a background thread writes the dirty paths every
+    `flush_seconds`, and `flush()` (also run at exit) writes them at once. Marks of one path
+    coalesce, so a file saved on every response is written at most once per interval with
+    its latest contents. Each write holds the path's file lock and goes through
+    `write_atomic`, so concurrent writers and crashes never leave a truncated file.
+    """
+
+    def __init__(self, flush_seconds=PERSISTENCE_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self.dirty = {}  # path -> (data, serialized text or None, lock, pretty)
+        self.writing = {}  # The entries of the flush in progress
+        self.written_versions = {}  # path -> version of the VersionedDict it was last written from
+        self.counts = {'marked': 0, 'coalesced': 0, 'written': 0, 'unchanged': 0, 'errors': 0}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # One flush at a time keeps the writes of a path in order
+        self.thread = threading.Thread(target=self.run, name="persistence-writer", daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, path, data, lock=None, pretty=False):
+        """Save `data` to `path` with the next flush, serialized then while holding `lock`.
+
+        The object is read at flush time, so the caller passes the live object and no copy is
+        made on the hot path. An object with a `version`, like a VersionedDict, is only
+        rewritten when the version changed.
+        """
+        self.mark(path, (data, None, lock, pretty))
+
+    def write_text(self, path, text):
+        self.mark(path, (None, text, None, False))
+
+    def write_json(self, path, data, pretty=False):
+        """Serialize `data` now, for objects the caller keeps changing, and write it with the next flush."""
+        self.write_text(path, serializer.dumps(data, pretty))
+
+    def mark(self, path, entry):
+        with self.lock:
+            self.counts['marked'] += 1
+            self.counts['coalesced'] += path in self.dirty
+            self.dirty[path] = entry
+
+    def read_json(self, path):
+        """Load a JSON file as it will be once the writes marked so far are flushed."""
+        with self.lock:
+            entry = self.dirty.get(path) or self.writing.get(path)
+        if entry is None:
+            return read_json(path)
+        data, text, lock, pretty = entry
+        if text is None:
+            with lock or nullcontext():
+                text = serializer.dumps(data)
+        return serializer.loads(text)
+
+    def flush(self):
+        """Write every path marked dirty so far; returns once they are on disk."""
+        with self.flush_lock:
+            with self.lock:
+                pending, self.dirty = self.dirty, {}
+                self.writing = pending
+            for path, entry in pending.items():
+                try:
+                    self.write(path, *entry)
+                except Exception as e:
+                    print(f"Error writing {path}: {str(e)}")
+                    with self.lock:
+                        self.counts['errors'] += 1
+                        self.dirty.setdefault(path, entry)  # Retried with the next flush unless saved again
+            with self.lock:
+                self.writing = {}
+
+    def write(self, path, data, text, lock, pretty):
+        version = None
+        if text is None:
+            with lock or nullcontext():
+                if hasattr(data, 'version'):
+                    version = data.version  # Unique across dicts, see VersionedDict
+                    if self.written_versions.get(path) == version:
+                        with self.lock:
+                            self.counts['unchanged'] += 1
+                        return
+                text = serializer.dumps(data, pretty)
+        with file_lock(path):
+            write_atomic(path, text)
+        with self.lock:
+            self.counts['written'] += 1
+        if version is not None:
+            self.written_versions[path] = version
+        else:
+            self.written_versions.pop(path, None)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, dirty=len(self.dirty), flush_seconds=self.flush_seconds)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Return the process-wide persistence writer, starting it on first use."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = PersistenceWriter()
+            atexit.register(_writer.flush)
+        return _writer
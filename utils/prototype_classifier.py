@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class PrototypeClassifier:
+    """Nearest-prototype classification by cosine similarity.
+
+    The prototypes are kept as one L2-normalized (K x D) matrix, so scoring a batch of N inputs
+    is a single (N x D) @ (D x K) matmul with no per-label Python work.
+    """
+
+    def __init__(self, labels, vectors):
+        self.labels = list(labels)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(self.labels), -1)
+        self.matrix = normalize(vectors)
+
+    def scores(self, vectors):
+        """Cosine similarity of each input row against every prototype, as an (N x K) array."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[np.newaxis, :]
+        return normalize(vectors) @ self.matrix.T
+
+    def top_k(self, vectors, k=1):
+        """The k best (label, score) pairs for each input row, best first."""
+        scores = self.scores(vectors)
+        k = min(k, len(self.labels))
+        if k == len(self.labels):
+            best = np.argsort(-scores, axis=1)
+        else:
+            best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            order = np.take_along_axis(scores, best, axis=1).argsort(axis=1)[:, ::-1]
+            best = np.take_along_axis(best, order, axis=1)
+        return [[(self.labels[j], float(row_scores[j])) for j in row_best[:k]]
+                for row_best, row_scores in zip(best, scores)]
+
+    def classify(self, vectors):
+        """The best label for each input row."""
+        return [self.labels[j] for j in self.scores(vectors).argmax(axis=1)]
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
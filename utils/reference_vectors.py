@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_DIRECTORY = os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache")
+
+
+def cache_key(model, phrases):
+    """Hash of everything the vectors depend on: model, revision, precision and the phrases in order."""
+    payload = json.dumps([model.name, model.resolved_revision(), model.precision, list(phrases)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def cache_path(model, phrases, directory=None):
+    safe_name = model.name.replace('/', '--')
+    return os.path.join(directory or CACHE_DIRECTORY, f"{safe_name}-{cache_key(model, phrases)}.npy")
+
+
+def load_reference_vectors(model, phrases, directory=None):
+    """Return an (N x D) array of the phrases' embeddings, memory-mapped from the on-disk cache.
+
+    The cache file is built on the first call for this model and phrase set; later calls and
+    other processes map it in without loading the model at all.
+    """
+    phrases = list(phrases)
+    path = cache_path(model, phrases, directory)
+    try:
+        vectors = np.load(path, mmap_mode='r')
+        if vectors.shape[0] == len(phrases):
+            return vectors
+        print(f"Warning: Reference vector cache {path} has the wrong shape, rebuilding it.")
+    except FileNotFoundError:
+        pass
+    except ValueError as e:
+        print(f"Warning: Could not read reference vector cache {path} ({str(e)}), rebuilding it.")
+    return build_reference_vectors(model, phrases, directory)
+
+
+def build_reference_vectors(model, phrases, directory=None):
+    """Embed the phrases and write them to the cache atomically."""
+    phrases = list(phrases)
+    path = cache_path(model, phrases, directory)
+    vectors = np.ascontiguousarray(model.embed(phrases), dtype=np.float32)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        np.save(file, vectors)
+    os.replace(temp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def reference_phrase_sets():
+    """Every (model, phrases) pair the chatbot embeds as reference vectors, for prebuilding."""
+    from agents.file_system_agent import FILE_INTENT_PHRASES, FILE_SYSTEM_EMBEDDING_MODEL, OPEN_FILE_PHRASES
+    from chatbot.emotional_state_handler import EMOTION_EMBEDDING_MODEL, EMOTIONAL_PHRASES
+    from chatbot.intent_recognizer import INTENT_EMBEDDING_MODEL, INTENT_MAP
+    from utils.embedding_service import get_embedding_model
+
+    return [
+        (get_embedding_model(EMOTION_EMBEDDING_MODEL), list(EMOTIONAL_PHRASES.values())),
+        (get_embedding_model(INTENT_EMBEDDING_MODEL), list(INTENT_MAP.values())),
+        (get_embedding_model(FILE_SYSTEM_EMBEDDING_MODEL), list(OPEN_FILE_PHRASES)),
+        (get_embedding_model(FILE_SYSTEM_EMBEDDING_MODEL), list(FILE_INTENT_PHRASES.values())),
+    ]
+
+
+def prebuild_reference_vectors(directory=None, force=False):
+    """Build the cache for every reference phrase set, returning the paths written or found."""
+    paths = []
+    for model, phrases in reference_phrase_sets():
+        path = cache_path(model, phrases, directory)
+        if force or not os.path.exists(path):
+            build_reference_vectors(model, phrases, directory)
+        paths.append(path)
+    return paths
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+
+try:
+    import orjson
+except ImportError:  # Optional: the fastest backend when installed
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class StdlibSerializer:
+    """The json module, writing compact UTF-8 unless asked to pretty-print."""
+
+    name = 'json'
+
+    def dumps(self, value, pretty=False):
+        if pretty:
+            return json.dumps(value, indent=2, ensure_ascii=False)
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+    def loads(self, text):
+        return json.loads(text)
+
+
+class OrjsonSerializer:
+    name = 'orjson'
+
+    def dumps(self, value, pretty=False):
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(value, option=option).decode('utf-8')
+
+    def loads(self, text):
+        return orjson.loads(text)  # orjson.JSONDecodeError is a json.JSONDecodeError
+
+
+class MsgspecSerializer:
+    name = 'msgspec'
+
+    def __init__(self):
+        self.encoder = msgspec.json.Encoder()
+        self.decoder = msgspec.json.Decoder()
+
+    def dumps(self, value, pretty=False):
+        encoded = self.encoder.encode(value)
+        return (msgspec.json.format(encoded, indent=2) if pretty else encoded).decode('utf-8')
+
+    def loads(self, text):
+        try:
+            return self.decoder.decode(text)
+        except msgspec.DecodeError as e:  # Callers handle the json module's error
+            raise json.JSONDecodeError(str(e), text if isinstance(text, str) else '', 0) from e
+
+
+SERIALIZERS = {'json': StdlibSerializer, 'orjson': OrjsonSerializer, 'msgspec': MsgspecSerializer}
+
+
+def available_serializers():
+    """Names of the backends that can be used here, fastest first."""
+    return [name for name, installed in (('orjson', orjson), ('msgspec', msgspec), ('json', json)) if installed]
+
+
+def make_serializer(name=None):
+    name = name or available_serializers()[0]
+    if name not in available_serializers():
+        raise ValueError(f"JSON backend {name!r} is not available; choose one of {available_serializers()}")
+    return SERIALIZERS[name]()
+
+
+_serializer = None
+_serializer_lock = threading.Lock()
+
+
+def get_serializer():
+    """The process-wide JSON backend: JSON_BACKEND if set, else orjson, msgspec or the stdlib, whichever is installed."""
+    global _serializer
+    with _serializer_lock:
+        if _serializer is None:
+            _serializer = make_serializer(os.getenv("JSON_BACKEND") or None)
+        return _serializer
+
+
+def dumps(value, pretty=False):
+    """Serialize for a file: compact by default, and readable by every backend."""
+    return get_serializer().dumps(value, pretty)
+
+
+def loads(text):
+    return get_serializer().loads(text)
+
+
+def pretty_file(path):
+    """The indented text of a JSON file, or of each record of a JSON-lines file, for people to read.
+
+    The result is not meant to be loaded back: indented JSON lines are no longer one record per line.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        text = file.read()
+    try:
+        return dumps(loads(text), pretty=True) + '\n'
+    except json.JSONDecodeError:
+        return '\n'.join(dumps(loads(line), pretty=True) + '\n' for line in text.splitlines() if line.strip())
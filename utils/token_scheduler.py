@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+
+# Token throughput shared by every LLM consumer of the process (by default the gateway's limit);
+# 0 leaves only the per-consumer banks
+SCHEDULER_TOKENS_PER_MINUTE = int(os.getenv("SCHEDULER_TOKENS_PER_MINUTE", os.getenv("LLM_TOKENS_PER_MINUTE", 200000)))
+FOREGROUND_RESERVE = 0.25  # Share of the budget background work leaves free for user-facing completions
+USER_BACKGROUND_SHARE = 0.25  # Share of the budget one user's background work may use per minute
+ACQUIRE_POLL_SECONDS = 1.0
+BACKGROUND_WAIT_SECONDS = 5.0  # Longest a background worker blocks for tokens before rescheduling its job
+
+
+class Consumer:
+    """A background LLM consumer: its priority and its own bank of tokens, refilled per second."""
+
+    def __init__(self, name, priority, tokens_per_second=None):
+        self.name = name
+        self.priority = priority
+        self.tokens_per_second = tokens_per_second  # None: limited by the shared budget only
+        self.bank = 0.0
+        self.granted = 0
+        self.deferred = 0
+        self.tokens_used = 0
+        self.last_cost = None
+
+
+class Grant:
+    """Tokens reserved for one background call; settle it with the tokens the call used."""
+
+    def __init__(self, scheduler, consumer, user_id, estimate):
+        self.scheduler = scheduler
+        self.consumer = consumer
+        self.user_id = user_id
+        self.estimate = estimate
+        self.settled = False
+
+    def settle(self, tokens=None):
+        """Replace the reservation with the actual usage; without `tokens` the reservation is returned."""
+        if not self.settled:
+            self.settled = True
+            self.scheduler.settle(self, tokens)
+
+
+class TokenScheduler:
+    """Shares LLM token throughput between user-facing completions and background work.
+
+    One bucket holds a minute of the shared budget. Foreground completions are never held
+    back: their usage is simply taken from the bucket. Background consumers (world-state
+    updates, summaries, ethics reviews) only get what is left above `FOREGROUND_RESERVE`,
+    higher priorities first: a call is deferred while a consumer of higher priority is
+    waiting for the same tokens. Each user's background work also draws on a per-user bucket,
+    so one busy user cannot use up everyone's summaries and updates, and a consumer with a
+    `tokens_per_second` rate additionally needs its own bank to cover its last call.
+    """
+
+    def __init__(self, tokens_per_minute=SCHEDULER_TOKENS_PER_MINUTE, foreground_reserve=FOREGROUND_RESERVE,
+                 user_share=USER_BACKGROUND_SHARE):
+        self.capacity = tokens_per_minute
+        self.reserve = tokens_per_minute * foreground_reserve
+        self.user_capacity = tokens_per_minute * user_share
+        self.level = float(tokens_per_minute)
+        self.user_levels = {}  # user_id -> tokens left in the user's background bucket
+        self.consumers = {}
+        self.waiting = {}  # id(waiter) -> (consumer name, priority, user_id, estimate, monotonic start)
+        self.foreground_tokens = 0
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def register(self, name, priority, tokens_per_second=None):
+        """Declare a background consumer; the name is the call site its completions use."""
+        with self.condition:
+            consumer = self.consumers.get(name)
+            if consumer is None:
+                consumer = self.consumers[name] = Consumer(name, priority, tokens_per_second)
+            else:
+                consumer.priority, consumer.tokens_per_second = priority, tokens_per_second
+            return consumer
+
+    def is_background(self, name):
+        return name in self.consumers
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.capacity:
+            self.level = min(self.capacity, self.level + elapsed * self.capacity / 60)
+            refill = elapsed * self.user_capacity / 60
+            for user_id, level in list(self.user_levels.items()):
+                level += refill
+                if level >= self.user_capacity:
+                    del self.user_levels[user_id]  # Full buckets are implied
+                else:
+                    self.user_levels[user_id] = level
+        for consumer in self.consumers.values():
+            if consumer.tokens_per_second:
+                consumer.bank += elapsed * consumer.tokens_per_second
+
+    def record_foreground(self, tokens):
+        """Take the tokens a user-facing completion used from the shared budget."""
+        with self.condition:
+            self.refill()
+            self.foreground_tokens += tokens
+            if self.capacity:
+                self.level -= tokens
+
+    def try_acquire(self, name, user_id, estimate):
+        """Reserve tokens for a background call if the budgets allow it now, else return None."""
+        with self.condition:
+            return self._try_acquire(name, user_id, estimate, None)
+
+    def _try_acquire(self, name, user_id, estimate, waiter_key):
+        self.refill()
+        consumer = self.consumers[name]
+        if consumer.tokens_per_second is not None and consumer.bank <= (consumer.last_cost or estimate):
+            consumer.deferred += waiter_key is None
+            return None
+        if self.capacity:
+            needed = min(estimate, self.capacity - self.reserve)
+            ahead = sum(waiting[3] for key, waiting in self.waiting.items()
+                        if key != waiter_key and waiting[1] > consumer.priority)
+            user_level = self.user_levels.get(user_id, self.user_capacity)
+            if self.level - self.reserve - ahead < needed or user_level < min(estimate, self.user_capacity):
+                consumer.deferred += waiter_key is None  # A blocked acquire counts once
+                return None
+            self.level -= estimate
+            self.user_levels[user_id] = user_level - estimate
+        consumer.bank -= estimate
+        consumer.granted += 1
+        return Grant(self, consumer, user_id, estimate)
+
+    def acquire(self, name, user_id, estimate, timeout=None):
+        """Block until the budgets allow a background call, returning its Grant (None on timeout)."""
+        waiter = object()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            grant = self._try_acquire(name, user_id, estimate, id(waiter))
+            if grant is not None:
+                return grant
+            self.consumers[name].deferred += 1
+            self.waiting[id(waiter)] = (name, self.consumers[name].priority, user_id, estimate, time.monotonic())
+            try:
+                while grant is None:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self.condition.wait(ACQUIRE_POLL_SECONDS if remaining is None else min(remaining, ACQUIRE_POLL_SECONDS))
+                    grant = self._try_acquire(name, user_id, estimate, id(waiter))
+                return grant
+            finally:
+                del self.waiting[id(waiter)]
+
+    def settle(self, grant, tokens):
+        with self.condition:
+            self.refill()
+            used = grant.estimate if tokens is None else tokens
+            refund = grant.estimate - (0 if tokens is None else tokens)
+            if self.capacity:
+                self.level = min(self.capacity, self.level + refund)
+                if grant.user_id in self.user_levels:
+                    self.user_levels[grant.user_id] = min(self.user_capacity, self.user_levels[grant.user_id] + refund)
+            grant.consumer.bank += refund
+            if tokens is not None:
+                grant.consumer.last_cost = tokens
+                grant.consumer.tokens_used += used
+            self.condition.notify_all()
+
+    def bank(self, name):
+        with self.condition:
+            self.refill()
+            return self.consumers[name].bank
+
+    def snapshot(self):
+        """Bucket levels, per-consumer grants and deferrals, and the background calls waiting now."""
+        with self.condition:
+            self.refill()
+            now = time.monotonic()
+            return {
+                'shared': {'level': self.level, 'capacity': self.capacity, 'foreground_reserve': self.reserve,
+                           'foreground_tokens': self.foreground_tokens} if self.capacity else None,
+                'consumers': {consumer.name: {
+                    'priority': consumer.priority, 'bank': consumer.bank if consumer.tokens_per_second else None,
+                    'granted': consumer.granted, 'deferred': consumer.deferred, 'tokens_used': consumer.tokens_used,
+                    'last_cost': consumer.last_cost,
+                } for consumer in self.consumers.values()},
+                'user_levels': {str(user_id): level for user_id, level in self.user_levels.items()},
+                'waiting': [{'consumer': name, 'priority': priority, 'user_id': user_id, 'estimate': estimate,
+                             'seconds': now - since} for name, priority, user_id, estimate, since in self.waiting.values()],
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide token scheduler, creating it on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TokenScheduler()
+        return _scheduler
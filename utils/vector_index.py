@@ -0,0 +1,242 @@
+import json
+import os
+
+import numpy as np
+
+from utils import serializer
+from utils.persistence import file_lock, write_atomic
+from utils.prototype_classifier import normalize
+
+SEARCH_CHUNK_ROWS = 65536  # Rows scored per matmul, bounding the temporary memory of an exact search
+DEQUANTIZE_CHUNK_ROWS = 2048  # int8 rows converted per matmul; small enough for the floats to stay in cache
+IVF_NPROBE = 16  # Clusters scored per query once an index is clustered
+IVF_ITERATIONS = 10
+IVF_TRAINING_ROWS = 65536  # Rows sampled to train the cluster centroids
+
+
+class VectorIndex:
+    """Append-only on-disk store of unit vectors with cosine top-k search.
+
+    Vectors are kept as rows of a flat binary file that is memory-mapped for search, so an
+    index opens without reading it and the page cache is shared between worker processes.
+    Every row has a JSON entry in `entries.jsonl`, found through a memory-mapped array of
+    byte offsets, so only the entries of search results are ever parsed.
+
+    Search is exact by default: a chunked matmul over every row. For large stores rows can be
+    stored as int8 with a per-row scale (`precision='int8'`, a quarter of the size), and
+    `build_ivf` clusters the rows so a search only scores the `nprobe` clusters nearest to the
+    query, plus the rows added since the clusters were built.
+    """
+
+    def __init__(self, directory, precision='fp32'):
+        self.directory = directory
+        self.settings_path = os.path.join(directory, 'index.json')
+        self.dim = None  # Set by the first rows added
+        self.precision = precision
+        self.load_settings()
+        self.count = 0
+        self.vectors = None
+        self.scales = None
+        self.offsets = None
+        self.ivf = None  # (centroids, row ids grouped by cluster, cluster start offsets, rows covered)
+        self.ivf_mtime = None
+
+    def load_settings(self):
+        """Adopt the dimension and precision the index was created with, if it exists."""
+        try:
+            with open(self.settings_path) as file:
+                settings = json.load(file)
+        except FileNotFoundError:
+            return
+        self.dim = settings['dim']
+        self.precision = settings['precision']
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def vector_dtype(self):
+        return np.int8 if self.precision == 'int8' else np.float32
+
+    def __len__(self):
+        self.refresh()
+        return self.count
+
+    def refresh(self):
+        """Map in rows other processes appended since the last call."""
+        if self.dim is None:
+            self.load_settings()
+            if self.dim is None:
+                return
+        try:
+            count = os.path.getsize(self.path('offsets.i64')) // 8
+        except FileNotFoundError:
+            count = 0
+        if count != self.count:
+            # Offsets are appended last, so every row they count is complete
+            self.vectors = np.memmap(self.path('vectors.bin'), dtype=self.vector_dtype, mode='r', shape=(count, self.dim))
+            if self.precision == 'int8':
+                self.scales = np.memmap(self.path('scales.f32'), dtype=np.float32, mode='r', shape=(count,))
+            self.offsets = np.memmap(self.path('offsets.i64'), dtype=np.int64, mode='r', shape=(count,))
+            self.count = count
+        self.load_ivf()
+
+    def add(self, vectors, entries):
+        """Append rows and their JSON-serializable entries."""
+        vectors = normalize(np.asarray(vectors, dtype=np.float32).reshape(len(entries), -1))
+        if not len(entries):
+            return
+        with file_lock(self.path('vectors.bin')):
+            self.load_settings()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                write_atomic(self.settings_path, serializer.dumps({'dim': self.dim, 'precision': self.precision}))
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+            self.discard_partial_rows()
+
+            if self.precision == 'int8':
+                scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+                rows = np.round(vectors / scales[:, np.newaxis]).astype(np.int8)
+                with open(self.path('scales.f32'), 'ab') as file:
+                    file.write(scales.astype(np.float32).tobytes())
+            else:
+                rows = vectors
+            with open(self.path('vectors.bin'), 'ab') as file:
+                file.write(rows.tobytes())
+
+            with open(self.path('entries.jsonl'), 'ab') as file:
+                position = file.tell()
+                lines = [(serializer.dumps(entry) + '\n').encode('utf-8') for entry in entries]
+                file.write(b''.join(lines))
+            offsets = position + np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.int64)
+            with open(self.path('offsets.i64'), 'ab') as file:
+                file.write(offsets.tobytes())
+        self.refresh()
+
+    def discard_partial_rows(self):
+        """Cut rows an interrupted add wrote without their offsets, so new rows line up again."""
+        try:
+            count = os.path.getsize(self.path('offsets.i64')) // 8
+        except FileNotFoundError:
+            count = 0
+        files = [('vectors.bin', self.dim * np.dtype(self.vector_dtype).itemsize)]
+        if self.precision == 'int8':
+            files.append(('scales.f32', 4))
+        for name, row_bytes in files + [('offsets.i64', 8)]:
+            try:
+                if os.path.getsize(self.path(name)) > count * row_bytes:
+                    os.truncate(self.path(name), count * row_bytes)
+            except FileNotFoundError:
+                pass
+
+    def get_entries(self, rows):
+        entries = []
+        with open(self.path('entries.jsonl'), 'rb') as file:
+            for row in rows:
+                file.seek(int(self.offsets[row]))
+                entries.append(serializer.loads(file.readline()))
+        return entries
+
+    def row_scores(self, query, start, stop):
+        """Cosine similarity of the query against rows [start, stop), in chunks."""
+        scores = np.empty(stop - start, dtype=np.float32)
+        chunk_rows = DEQUANTIZE_CHUNK_ROWS if self.precision == 'int8' else SEARCH_CHUNK_ROWS
+        for chunk_start in range(start, stop, chunk_rows):
+            chunk_stop = min(chunk_start + chunk_rows, stop)
+            scores[chunk_start - start:chunk_stop - start] = self.score_rows(query, slice(chunk_start, chunk_stop))
+        return scores
+
+    def score_rows(self, query, rows):
+        if self.precision == 'int8':
+            return (self.vectors[rows].astype(np.float32) @ query) * self.scales[rows]
+        return self.vectors[rows] @ query
+
+    def search(self, query, k=5, nprobe=IVF_NPROBE):
+        """The k most similar rows as (score, entry) pairs, best first.
+
+        Clustered rows are searched approximately through the `nprobe` nearest clusters;
+        pass `nprobe=None` to score every row exactly.
+        """
+        self.refresh()
+        if not self.count or k <= 0:
+            return []
+        query = normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+
+        if self.ivf is not None and nprobe:
+            centroids, members, starts, covered = self.ivf
+            probes = top_rows(centroids @ query, nprobe)
+            rows = np.concatenate([members[starts[probe]:starts[probe + 1]] for probe in probes]
+                                  + [np.arange(covered, self.count)])
+            rows.sort()  # Sequential reads from the map
+            scores = self.score_rows(query, rows) if len(rows) else np.empty(0, dtype=np.float32)
+        else:
+            rows = None
+            scores = self.row_scores(query, 0, self.count)
+
+        best = top_rows(scores, k)
+        best_rows = best if rows is None else rows[best]
+        return list(zip((float(score) for score in scores[best]), self.get_entries(best_rows)))
+
+    def build_ivf(self, clusters=None, iterations=IVF_ITERATIONS, training_rows=IVF_TRAINING_ROWS, seed=0):
+        """Cluster every row with spherical k-means and save the clusters next to the rows."""
+        self.refresh()
+        count = self.count
+        if not count:
+            return
+        clusters = min(count, clusters or max(1, int(np.sqrt(count))))
+        random = np.random.default_rng(seed)
+        sample = np.sort(random.choice(count, min(count, max(training_rows, clusters)), replace=False))
+        training = normalize(self.dequantize(sample))
+        centroids = training[random.choice(len(training), clusters, replace=False)]
+        for _ in range(iterations):
+            assignments = (training @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, training)
+            empty = ~sums.any(axis=1)
+            sums[empty] = training[random.choice(len(training), int(empty.sum()))]  # Re-seed empty clusters
+            centroids = normalize(sums)
+
+        assignments = np.empty(count, dtype=np.int32)
+        for start in range(0, count, SEARCH_CHUNK_ROWS):
+            stop = min(start + SEARCH_CHUNK_ROWS, count)
+            assignments[start:stop] = (self.dequantize(slice(start, stop)) @ centroids.T).argmax(axis=1)
+        members = np.argsort(assignments, kind='stable').astype(np.int64)
+        starts = np.searchsorted(assignments[members], np.arange(clusters + 1)).astype(np.int64)
+
+        path = self.path('ivf.npz')
+        temp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(temp_path, centroids=centroids.astype(np.float32), members=members, starts=starts, covered=count)
+        with file_lock(self.path('vectors.bin')):
+            os.replace(temp_path, path)
+        self.load_ivf()
+
+    def dequantize(self, rows):
+        if self.precision == 'int8':
+            return self.vectors[rows].astype(np.float32) * self.scales[rows][:, np.newaxis]
+        return np.asarray(self.vectors[rows])
+
+    def load_ivf(self):
+        try:
+            mtime = os.stat(self.path('ivf.npz')).st_mtime_ns
+        except FileNotFoundError:
+            self.ivf = self.ivf_mtime = None
+            return
+        if mtime != self.ivf_mtime:
+            with np.load(self.path('ivf.npz')) as ivf:
+                self.ivf = (ivf['centroids'], ivf['members'], ivf['starts'], int(ivf['covered']))
+            self.ivf_mtime = mtime
+
+    def unclustered_rows(self):
+        """Rows added since the clusters were built, which every search scores exactly."""
+        self.refresh()
+        return self.count - (self.ivf[3] if self.ivf is not None else 0)
+
+
+def top_rows(scores, k):
+    """Indices of the k highest scores, highest first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind='stable')]
@@ -0,0 +1,55 @@
+import itertools
+
+_versions = itertools.count(1)
+
+
+class VersionedDict(dict):
+    """A dict that records a new version number whenever it changes.
+
+    Version numbers come from one global counter, so two different dicts never share one and a
+    cache keyed on `version` alone notices when an attribute is replaced by another dict.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = next(_versions)
+
+    def touch(self):
+        self.version = next(_versions)
+
+    def __setitem__(self, key, value):
+        if key in self and self[key] is value:
+            return
+        super().__setitem__(key, value)
+        self.touch()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.touch()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.touch()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.touch()
+        return super().setdefault(key, default)
+
+    def pop(self, key, *args):
+        if key in self:
+            self.touch()
+        return super().pop(key, *args)
+
+    def popitem(self):
+        item = super().popitem()
+        self.touch()
+        return item
+
+    def clear(self):
+        super().clear()
+        self.touch()
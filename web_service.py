@@ -1,5 +1,11 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 from chatbot.ethical_ai_chatbot import EthicalAIChatbot
+from utils.completion_cache import get_completion_cache
+from utils.event_loop import run_async
+from utils.llm_gateway import get_gateway
+from utils.persistence import get_writer
+from utils.token_scheduler import get_scheduler
+import json
 import re
 
 app = Flask(__name__)
@@ -15,15 +21,32 @@ def chat():
     """Handle user input and return chatbot response."""
     user_id = request.json.get('user_id')
     message = request.json.get('message')
-    bot.handle_request(user_id, sanitize_input(message))
-    response = bot.chat_history.get_history(user_id)[-1]['response']
+    response = run_async(bot.handle_request_async(user_id, sanitize_input(message)))
     return jsonify({'response': response})
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream the chatbot response to the client as Server-Sent Events."""
+    user_id = request.json.get('user_id')
+    message = sanitize_input(request.json.get('message'))
+
+    def events():
+        deltas = []
+        for delta in bot.handle_request_stream(user_id, message):
+            deltas.append(delta)
+            yield f"data: {json.dumps({'delta': delta})}\n\n"
+        yield f"event: done\ndata: {json.dumps({'response': ''.join(deltas)})}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/world_state', methods=['GET'])
 def get_world_state():
-    """Return the current world state."""
-    state = bot.world_states[0].state  # Assuming you're interested in the first world state
-    return jsonify(state)
+    """Return the user's world states, by file name."""
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'error': "user_id is required"}), 400
+    return jsonify({world_state.file_name: world_state.get_state(user_id) for world_state in bot.world_states})
 
 
 @app.route('/chat_history', methods=['GET'])
@@ -46,6 +69,29 @@ def get_user_directory():
     directory_tree = bot.file_system_agent.file_system.current_directory_tree(full=True)
     return jsonify(directory_tree)
 
+@app.route('/completion_cache', methods=['GET'])
+def get_completion_cache_stats():
+    """Return the completion cache hit rate and saved tokens of this worker."""
+    cache = get_completion_cache()
+    return jsonify(cache.stats() if cache is not None else {'enabled': False})
+
+@app.route('/llm_gateway', methods=['GET'])
+def get_llm_gateway_metrics():
+    """Return the calls, retries, tokens and latency of each LLM call site in this worker."""
+    return jsonify(get_gateway().metrics())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Return the token scheduler's bucket levels and deferred background work, world-state parse
+    failures and wasted tokens, the gateway and cache metrics and the persistence writer's counts."""
+    cache = get_completion_cache()
+    return jsonify({
+        'token_scheduler': get_scheduler().snapshot(),
+        'world_states': {world_state.file_name: world_state.get_metrics() for world_state in bot.world_states},
+        'llm_gateway': get_gateway().metrics(),
+        'completion_cache': cache.stats() if cache is not None else {'enabled': False},
+        'persistence': get_writer().stats(),
+    })
 
 
 def sanitize_input(user_input):